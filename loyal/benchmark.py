@@ -0,0 +1,99 @@
+"""
+Helpers shared by the benchmark management commands.
+"""
+
+from contextlib import contextmanager
+import json
+import math
+
+from django.db import connection
+from django.utils import timezone
+
+
+def percentile(values, pct):
+    """
+    Percentile of a list of values using the nearest rank method.
+    """
+
+    if not values:
+        return None
+
+    ordered = sorted(values)
+    rank = int(math.ceil(pct / 100.0 * len(ordered))) - 1
+    return ordered[max(rank, 0)]
+
+
+def summarize(timings):
+    """
+    Summary of a list of timings in seconds, returned in milliseconds.
+    """
+
+    return {
+        'samples': len(timings),
+        'p50_ms': round(percentile(timings, 50) * 1000, 3),
+        'p95_ms': round(percentile(timings, 95) * 1000, 3),
+        'p99_ms': round(percentile(timings, 99) * 1000, 3),
+    }
+
+
+def sql_time(queries):
+    """
+    Total time in seconds of the queries captured by the debug cursor.
+    """
+
+    return sum(float(query['time']) for query in queries)
+
+
+@contextmanager
+def test_database():
+    """
+    Run the benchmark on a new test database, like the test runner does, so we never touch real data.
+    """
+
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+def new_report(kind, **extra):
+    report = {
+        'benchmark': kind,
+        'date': timezone.now().isoformat(),
+        'database': connection.vendor,
+    }
+    report.update(extra)
+    return report
+
+
+def write_report(report, filename):
+    with open(filename, 'w') as report_file:
+        json.dump(report, report_file, indent=2, sort_keys=True)
+
+
+def read_report(filename):
+    with open(filename) as report_file:
+        return json.load(report_file)
+
+
+def compare_results(old, new, metrics, threshold):
+    """
+    Compare two {name: {metric: value}} dictionaries.
+    Returns (name, metric, old value, new value, ratio) for every metric of every name present in both,
+    flagging as regressions the ratios above the threshold.
+    """
+
+    comparison = []
+    for name in sorted(set(old) & set(new)):
+        for metric in metrics:
+            old_value = old[name].get(metric)
+            new_value = new[name].get(metric)
+            if old_value is None or new_value is None:
+                continue
+
+            ratio = float(new_value) / old_value if old_value else (1.0 if not new_value else float('inf'))
+            comparison.append((name, metric, old_value, new_value, ratio, ratio > threshold))
+
+    return comparison
@@ -0,0 +1,69 @@
+"""
+Helpers shared by the management commands that load or dump many rows at once.
+"""
+
+from itertools import islice
+import time
+
+from django.core.management.base import CommandError
+from django.core.management.color import no_style
+from django.db import connection
+from loyal import routers
+from loyal.models import Customer, Product, Sale, Stamp, Voucher
+
+
+# File name, model and columns of every table in CSV imports and exports, in the order they must be loaded.
+# Customer balances are not included, they are always rebuilt after loading.
+CSV_TABLES = (
+    ('customers', Customer, ('id', 'first_name', 'last_name', 'email')),
+    ('sales', Sale, ('id', 'customer_id', 'date')),
+    ('products', Product, ('id', 'kind', 'serial_num', 'date', 'sale_id')),
+    ('vouchers', Voucher, ('id', 'owned_by_id', 'redeemed_with_id', 'date')),
+    ('stamps', Stamp, ('id', 'owned_by_id', 'obtained_with_id', 'grouped_in_id', 'date')),
+)
+
+
+def check_unsharded():
+    """
+    Bulk loads and dumps only go to the default database, which with sharding isn't where most customers are.
+    """
+
+    if routers.is_sharded():
+        raise CommandError("This command doesn't support sharding, unset LOYAL_SHARD_URLS to run it")
+
+
+def chunks(iterable, size):
+    """
+    Split an iterable in lists of the given size.
+    """
+
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def reset_sequences(models):
+    """
+    Make the DB sequences of the models catch up after inserting rows with explicit primary keys.
+    """
+
+    cursor = connection.cursor()
+    for sql in connection.ops.sequence_reset_sql(no_style(), models):
+        cursor.execute(sql)
+
+
+def can_copy():
+    """
+    Whether we can use COPY, only available with PostgreSQL.
+    """
+
+    return connection.vendor == 'postgresql'
+
+
+def report_throughput(stdout, num_rows, start, what="rows"):
+    elapsed = time.time() - start
+    stdout.write("OK: {0} {1} in {2:.2f}s ({3:.0f} rows/s)".format(num_rows, what, elapsed,
+                                                                  num_rows / elapsed if elapsed else 0))
@@ -0,0 +1,223 @@
+"""
+Cache of the serialized customer detail payloads.
+
+Entries are stored by customer with the version they were built from, so an entry is only used while the
+customer's version doesn't change, even if another process changed it. Saving or deleting anything that belongs
+to a customer also removes its entry right away.
+
+The backend is chosen with LOYAL_CUSTOMER_CACHE: 'local' for an LRU cache of LOYAL_CUSTOMER_CACHE_SIZE entries in
+each process, the alias of a cache in CACHES to use a file based or shared one, or empty to disable it.
+"""
+
+from collections import OrderedDict
+import threading
+
+from django.conf import settings
+from django.core.cache import get_cache
+from django.core.cache.backends.filebased import FileBasedCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from loyal.models import Customer, Product, Sale, Stamp, Voucher
+
+
+class LRUCache(object):
+    """
+    In memory cache that evicts the least recently used entry when it's full.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.evictions = 0
+
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.pop(key, None)
+            if value is not None:
+                self.entries[key] = value
+            return value
+
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
+
+class SharedCache(object):
+    """
+    One of the caches in CACHES, which takes care of the size and eviction itself.
+    The file based and local memory caches cull entries when they have more than MAX_ENTRIES, and the entries
+    culled while this process sets one are counted as evictions. Other backends, like memcached, evict on the
+    server without telling the client, so their evictions stay None.
+    """
+
+    COUNTED_BACKENDS = (FileBasedCache, LocMemCache)
+
+    def __init__(self, alias):
+        self.cache = get_cache(alias)
+        self.evictions = None
+        if isinstance(self.cache, self.COUNTED_BACKENDS):
+            self._count_evictions()
+
+
+    def _count_evictions(self):
+        # Both backends remove the culled entries one by one with _delete() from _cull()
+        cull, delete = self.cache._cull, self.cache._delete
+        culling = threading.local()
+
+        def counted_cull(*args):
+            culling.active = True
+            try:
+                return cull(*args)
+            finally:
+                culling.active = False
+
+        def counted_delete(*args):
+            if getattr(culling, 'active', False):
+                self.evictions += 1
+            return delete(*args)
+
+        self.evictions = 0
+        self.cache._cull, self.cache._delete = counted_cull, counted_delete
+
+
+    def get(self, key):
+        return self.cache.get(key)
+
+
+    def set(self, key, value):
+        self.cache.set(key, value, None)
+
+
+    def delete(self, key):
+        self.cache.delete(key)
+
+
+    def clear(self):
+        self.cache.clear()
+
+
+
+class PayloadCache(object):
+    """
+    Serialized payloads by customer, with hit, miss and invalidation counters.
+    Hyperlinks are absolute, so payloads are only used for the same base URL they were built for.
+    """
+
+    def __init__(self, backend, prefix):
+        self.backend = backend
+        self.prefix = prefix
+        self.reset()
+
+
+    def _key(self, customer_id):
+        return "{0}:{1}".format(self.prefix, customer_id)
+
+
+    def get(self, customer, base_url):
+        if self.backend is None:
+            return None
+
+        entry = self.backend.get(self._key(customer.pk))
+        if entry is not None and entry[:2] == (customer.version, base_url):
+            self.hits += 1
+            return entry[2]
+
+        self.misses += 1
+        return None
+
+
+    def set(self, customer, base_url, data):
+        if self.backend is not None:
+            self.backend.set(self._key(customer.pk), (customer.version, base_url, data))
+
+
+    def invalidate(self, *customer_ids):
+        if self.backend is None:
+            return
+
+        for customer_id in customer_ids:
+            if customer_id is not None:
+                self.backend.delete(self._key(customer_id))
+                self.invalidations += 1
+
+
+    def reset(self):
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'enabled': self.backend is not None,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': round(float(self.hits) / lookups, 3) if lookups else None,
+            'invalidations': self.invalidations,
+            'evictions': getattr(self.backend, 'evictions', None),
+            'entries': len(self.backend) if isinstance(self.backend, LRUCache) else None,
+        }
+
+
+
+def _backend():
+    name = getattr(settings, 'LOYAL_CUSTOMER_CACHE', 'local')
+    if not name:
+        return None
+    if name == 'local':
+        return LRUCache(getattr(settings, 'LOYAL_CUSTOMER_CACHE_SIZE', 10000))
+    return SharedCache(name)
+
+
+customer_cache = PayloadCache(_backend(), 'loyal:customer-detail')
+
+
+@receiver([post_save, post_delete], sender=Customer)
+def _customer_changed(sender, instance, **kwargs):
+    customer_cache.invalidate(instance.pk)
+
+
+@receiver([post_save, post_delete], sender=Stamp)
+@receiver([post_save, post_delete], sender=Voucher)
+def _owned_changed(sender, instance, **kwargs):
+    # Rows moved to another customer change the previous owner too
+    saved = instance._saved_balance
+    customer_cache.invalidate(instance.owned_by_id, saved[0] if saved else None)
+
+
+@receiver([post_save, post_delete], sender=Sale)
+def _sale_changed(sender, instance, **kwargs):
+    saved = instance._saved_balance
+    customer_cache.invalidate(instance.customer_id, saved[0] if saved else None)
+
+
+@receiver([post_save, post_delete], sender=Product)
+def _product_changed(sender, instance, **kwargs):
+    sale_ids = set([instance._saved_sale_id, instance.sale_id]) - set([None])
+    if sale_ids and customer_cache.backend is not None:
+        customer_cache.invalidate(*Sale.objects.filter(pk__in=sale_ids).values_list('customer', flat=True))
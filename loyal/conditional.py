@@ -0,0 +1,69 @@
+import calendar
+import time
+
+from django.http import Http404
+from django.utils.http import http_date, parse_etags, parse_http_date_safe, quote_etag
+from rest_framework import status
+from rest_framework.response import Response
+
+from loyal.models import Customer
+
+
+class CustomerConditionalMixin(object):
+    """
+    Answers GET requests about a customer with ETag and Last-Modified headers from the customer's version, and
+    with 304 Not Modified when the client already has the current one, before running any other query.
+    Dates only have whole seconds, so while the customer's last change is in the current second there's no
+    Last-Modified and If-Modified-Since is ignored: another change in the same second would have the same date.
+    The ETag covers it meanwhile.
+    The customer is loaded once and kept for the view in self.customer.
+    """
+
+    customer = None
+
+
+    def get_customer(self):
+        if self.customer is None:
+            try:
+                self.customer = Customer.objects.get(pk=self.kwargs.get('pk', None))
+            except Customer.DoesNotExist:
+                raise Http404
+
+        return self.customer
+
+
+    def get_etag(self, customer):
+        # The same version is rendered differently by every renderer
+        return '{0}-{1}-{2}'.format(customer.pk, customer.version, self.request.accepted_renderer.format)
+
+
+    def not_modified(self, request, etag, last_modified):
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        if if_none_match is not None:
+            etags = parse_etags(if_none_match)
+            return etag in etags or '*' in etags
+
+        if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+        return if_modified_since is not None and last_modified is not None and last_modified <= if_modified_since
+
+
+    def get(self, request, *args, **kwargs):
+        # If the customer changes after this, the response has a newer version than the ETag, so
+        # the client will just get it again next time
+        customer = self.get_customer()
+        etag = self.get_etag(customer)
+        last_modified = calendar.timegm(customer.modified.utctimetuple())
+        if last_modified >= int(time.time()):
+            last_modified = None
+
+        if self.not_modified(request, etag, last_modified):
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            response = super(CustomerConditionalMixin, self).get(request, *args, **kwargs)
+
+        if response.status_code in (status.HTTP_200_OK, status.HTTP_304_NOT_MODIFIED):
+            response['ETag'] = quote_etag(etag)
+            if last_modified is not None:
+                response['Last-Modified'] = http_date(last_modified)
+
+        return response
@@ -0,0 +1,69 @@
+"""
+Persistent database connections.
+
+Django keeps a connection open between the requests of a process for CONN_MAX_AGE seconds, set with
+LOYAL_CONN_MAX_AGE, and closes it when a request starts or finishes once it's older than that or after an error
+left it unusable. With LOYAL_CONN_HEALTH_CHECKS a connection reused by a new request is also checked with a cheap
+query first, so a connection the server dropped while it was idle is replaced instead of failing the request.
+
+We count the connections opened and reused by this process, shown in /metrics/.
+"""
+
+from django.conf import settings
+from django.core.signals import request_started
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+
+class ConnectionStats(object):
+    """
+    Counters of the database connections of this process.
+    """
+
+    def __init__(self):
+        self.reset()
+
+
+    def reset(self):
+        self.opened = 0
+        self.reused = 0
+        self.health_checks = 0
+        self.unusable = 0
+
+
+    def stats(self):
+        requests = self.opened + self.reused
+        return {
+            'max_age': dict((conn.alias, conn.settings_dict.get('CONN_MAX_AGE')) for conn in connections.all()),
+            'health_checks_enabled': getattr(settings, 'LOYAL_CONN_HEALTH_CHECKS', True),
+            'opened': self.opened,
+            'reused': self.reused,
+            'reuse_ratio': round(float(self.reused) / requests, 3) if requests else None,
+            'health_checks': self.health_checks,
+            'unusable': self.unusable,
+        }
+
+
+
+connection_stats = ConnectionStats()
+
+
+@receiver(connection_created)
+def _connection_created(sender, connection, **kwargs):
+    connection_stats.opened += 1
+
+
+@receiver(request_started)
+def _check_connections(sender, **kwargs):
+    # Django has already closed the connections that are too old or broken, the rest are reused
+    for conn in connections.all():
+        if conn.connection is None:
+            continue
+
+        connection_stats.reused += 1
+        if getattr(settings, 'LOYAL_CONN_HEALTH_CHECKS', True):
+            connection_stats.health_checks += 1
+            if not conn.is_usable():
+                connection_stats.unusable += 1
+                conn.close()
@@ -0,0 +1,153 @@
+"""
+API documentation.
+
+django-rest-swagger introspects every view and serializer for each request to /docs/, but the description only
+changes with the code. We generate it once and keep it in memory, and store it in LOYAL_API_DOCS_FILE tagged with the
+code version, so the next processes only have to read it. It can be built when deploying with the build_api_docs
+command, otherwise the first process that needs it builds it.
+"""
+
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+from django.conf import settings
+import rest_framework
+from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
+import rest_framework_swagger
+from rest_framework_swagger.docgenerator import DocumentationGenerator
+from rest_framework_swagger.views import SwaggerApiView, SwaggerResourcesView
+
+
+def code_version():
+    """
+    LOYAL_CODE_VERSION, like the commit being deployed, or else a hash of the Python sources of the project and the
+    versions of the packages that generate the docs.
+    """
+
+    version = getattr(settings, 'LOYAL_CODE_VERSION', '')
+    if version:
+        return version
+
+    digest = hashlib.sha1(rest_framework.VERSION + rest_framework_swagger.VERSION)
+    for package in ('loyal', 'yoyo_test'):
+        for root, directories, filenames in os.walk(os.path.join(settings.BASE_DIR, package)):
+            directories.sort()
+            for filename in sorted(filenames):
+                if filename.endswith('.py'):
+                    digest.update(filename)
+                    with open(os.path.join(root, filename), 'rb') as source:
+                        digest.update(source.read())
+    return digest.hexdigest()
+
+
+def generate():
+    """
+    Describe every resource like django-rest-swagger does, except for the basePath, which depends on the request.
+    """
+
+    resources = SwaggerResourcesView().get_resources()
+    apis = {}
+    for path in resources:
+        resource_apis = SwaggerApiView().get_api_for_resource(path)
+        generator = DocumentationGenerator()
+        apis[path] = {'apis': generator.generate(resource_apis), 'models': generator.get_models(resource_apis)}
+
+    return {'version': code_version(), 'resources': resources, 'apis': apis}
+
+
+
+class ApiDocs(object):
+    """
+    The description of the API of the running code, loaded or built once per process.
+    """
+
+    def __init__(self):
+        self._docs = None
+        self._lock = threading.Lock()
+
+
+    def reset(self):
+        self._docs = None
+
+
+    def load(self, filename):
+        """
+        Read the stored description, if there's one for the current code version.
+        """
+
+        try:
+            with open(filename) as docs_file:
+                docs = json.load(docs_file, object_pairs_hook=OrderedDict)
+        except (IOError, ValueError):
+            return None
+        return docs if docs.get('version') == code_version() else None
+
+
+    def build(self):
+        return json.loads(json.dumps(generate(), cls=JSONEncoder), object_pairs_hook=OrderedDict)
+
+
+    def store(self, docs, filename):
+        """
+        Write the description to filename, replacing it at once so other processes never read half of it.
+        """
+
+        descriptor, temporary = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)))
+        with os.fdopen(descriptor, 'w') as docs_file:
+            json.dump(docs, docs_file)
+        os.chmod(temporary, 0644)
+        os.rename(temporary, filename)
+
+
+    def get(self):
+        if self._docs is None:
+            with self._lock:
+                if self._docs is None:
+                    filename = getattr(settings, 'LOYAL_API_DOCS_FILE', None)
+                    docs = self.load(filename) if filename else None
+                    if docs is None:
+                        docs = self.build()
+                        if filename:
+                            try:
+                                self.store(docs, filename)
+                            except (IOError, OSError):
+                                # We can still serve it from memory
+                                pass
+                    self._docs = docs
+        return self._docs
+
+
+
+api_docs = ApiDocs()
+
+
+class CachedSwaggerResourcesView(SwaggerResourcesView):
+    """
+    List of the resources of the API, from the stored description.
+    """
+
+    def get_resources(self):
+        return api_docs.get()['resources']
+
+
+
+class CachedSwaggerApiView(SwaggerApiView):
+    """
+    Description of one resource of the API, from the stored description.
+    """
+
+    def get(self, request, path):
+        docs = api_docs.get()['apis'].get(path)
+        if docs is None:
+            return super(CachedSwaggerApiView, self).get(request, path)
+
+        return Response({
+            'apis': docs['apis'],
+            'models': docs['models'],
+            'basePath': self.api_full_uri.rstrip('/'),
+        })
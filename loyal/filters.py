@@ -0,0 +1,29 @@
+from django.core.exceptions import ValidationError
+from rest_framework import exceptions
+from rest_framework.fields import DateTimeField
+from rest_framework.filters import BaseFilterBackend
+
+
+class DateRangeFilter(BaseFilterBackend):
+    """
+    Filters a list by the date_field of the view (date by default) with the query parameters:
+        since: Only objects from this date on
+        until: Only objects before this date
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        date_field = getattr(view, 'date_field', 'date')
+
+        for param, lookup in (('since', '__gte'), ('until', '__lt')):
+            value = request.QUERY_PARAMS.get(param)
+            if not value:
+                continue
+
+            try:
+                value = DateTimeField().from_native(value)
+            except ValidationError as e:
+                raise exceptions.ParseError("{0}: {1}".format(param, " ".join(e.messages)))
+
+            queryset = queryset.filter(**{date_field + lookup: value})
+
+        return queryset
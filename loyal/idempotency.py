@@ -0,0 +1,75 @@
+from collections import OrderedDict
+import hashlib
+import json
+
+from django.db import router, transaction
+from rest_framework import status
+from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
+
+from loyal.models import IdempotencyKey
+
+
+class IdempotentPostMixin(object):
+    """
+    POST requests sent with an Idempotency-Key header run once: the response is stored with the key and
+    retries with the same key get the stored response, with an Idempotent-Replayed header, without running again.
+    The request and storing its response happen in one transaction, so if it fails nothing is stored and it can
+    be retried, and concurrent requests with the same key wait for the first one to finish.
+    With sharding the key is stored in the shard of the customer of the request, in the same transaction as its
+    changes, so keys are only unique per shard.
+    A key reused for another endpoint gets a 409, and for the same endpoint with other data a 422. The data is
+    compared once parsed, so the same form sent with another multipart boundary is still a retry.
+    """
+
+    idempotency_header = 'HTTP_IDEMPOTENCY_KEY'
+
+    # Unprocessable Entity, rest_framework.status doesn't have it
+    HTTP_422_UNPROCESSABLE_ENTITY = 422
+
+    # Rendered by the renderer of each request, so only the headers set by the view are stored
+    replayed_headers = ('Location',)
+
+
+    def replay(self, stored):
+        response = json.loads(stored.response, object_pairs_hook=OrderedDict)
+        replayed = Response(response['data'], status=stored.status_code, headers=response['headers'])
+        replayed['Idempotent-Replayed'] = 'true'
+        return replayed
+
+
+    def body_hash(self, request):
+        data = request.DATA
+        if hasattr(data, 'lists'):
+            data = dict(data.lists())
+        return hashlib.sha256(json.dumps(data, sort_keys=True, cls=JSONEncoder)).hexdigest()
+
+
+    def post(self, request, *args, **kwargs):
+        key = request.META.get(self.idempotency_header)
+        if key is None:
+            return super(IdempotentPostMixin, self).post(request, *args, **kwargs)
+
+        if not key or len(key) > IdempotencyKey._meta.get_field('key').max_length:
+            return Response({'detail': "Invalid Idempotency-Key"}, status=status.HTTP_400_BAD_REQUEST)
+
+        with transaction.atomic(using=router.db_for_write(IdempotencyKey)):
+            body_hash = self.body_hash(request)
+            stored, claimed = IdempotencyKey.claim(key, request.path, body_hash)
+            if not claimed:
+                if stored.path != request.path:
+                    return Response({'detail': "Idempotency-Key already used for another request"},
+                                    status=status.HTTP_409_CONFLICT)
+                if stored.body_hash != body_hash:
+                    return Response({'detail': "Idempotency-Key already used with other data"},
+                                    status=self.HTTP_422_UNPROCESSABLE_ENTITY)
+                return self.replay(stored)
+
+            response = super(IdempotentPostMixin, self).post(request, *args, **kwargs)
+
+            headers = dict((name, response[name]) for name in self.replayed_headers if response.has_header(name))
+            stored.status_code = response.status_code
+            stored.response = json.dumps({'data': response.data, 'headers': headers}, cls=JSONEncoder)
+            stored.save(update_fields=['status_code', 'response'])
+
+        return response
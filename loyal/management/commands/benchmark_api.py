@@ -0,0 +1,169 @@
+from optparse import make_option
+import os
+import time
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.core.urlresolvers import RegexURLResolver, reverse
+from django.db import connection, reset_queries
+from django.test.client import Client
+from django.test.utils import CaptureQueriesContext
+from loyal import benchmark
+from loyal.models import Customer, Product, Stamp, Voucher
+
+
+class Command(BaseCommand):
+    help = ('Measure latency, number of queries and SQL time of every GET endpoint of the loyal API\n'
+            'on test databases of several sizes, writing a JSON report that can be compared with a previous one.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--sizes', dest='sizes', default='100,1000',
+                    help='Comma separated number of customers of each dataset'),
+        make_option('--requests', type='int', dest='requests', default=50,
+                    help='Requests per endpoint'),
+        make_option('--seed', type='int', dest='seed', default=2048,
+                    help='Seed used to populate the datasets'),
+        make_option('--output', dest='output', default='benchmark_api.json',
+                    help='File where the JSON report is written'),
+        make_option('--compare', dest='compare', default=None,
+                    help='Previous JSON report to compare with'),
+        make_option('--threshold', type='float', dest='threshold', default=1.2,
+                    help='Ratio over the previous report considered a regression'),
+    )
+
+    # Which model the pk of each namespace refers to
+    NAMESPACE_MODELS = {
+        'customer': Customer,
+        'product': Product,
+        'stamp': Stamp,
+        'voucher': Voucher,
+    }
+
+    METRICS = ('p50_ms', 'p95_ms', 'p99_ms', 'queries', 'sql_ms')
+
+
+    def _endpoints(self, patterns, namespace='loyal'):
+        """
+        Walk the URL patterns of the loyal app, yielding the name, namespace and whether it needs a pk
+        of every endpoint that can be read with a GET.
+        """
+
+        for pattern in patterns:
+            if isinstance(pattern, RegexURLResolver):
+                for endpoint in self._endpoints(pattern.url_patterns, namespace + ":" + pattern.namespace):
+                    yield endpoint
+                continue
+
+            view_class = getattr(pattern.callback, 'cls', None)
+            if view_class is not None and not hasattr(view_class, 'get'):
+                continue
+
+            yield namespace + ":" + pattern.name, namespace.split(":")[-1], 'pk' in pattern.regex.groupindex
+
+
+    def _sample_pks(self):
+        """
+        We benchmark the customer with the longest history and the latest row of the other models.
+        """
+
+        customer = Customer.objects.order_by('-total_stamps', '-num_purchases').values_list('pk', flat=True)[:1]
+        pks = {'customer': customer[0] if customer else None}
+
+        for namespace, model in self.NAMESPACE_MODELS.items():
+            if namespace not in pks:
+                pks[namespace] = model.objects.order_by('-pk').values_list('pk', flat=True)[:1]
+                pks[namespace] = pks[namespace][0] if pks[namespace] else None
+
+        return pks
+
+
+    def _measure(self, client, url):
+        timings = []
+        queries = []
+        sql_times = []
+
+        # Warm up
+        client.get(url)
+
+        for _ in xrange(self.requests):
+            reset_queries()
+            with CaptureQueriesContext(connection) as captured:
+                start = time.time()
+                response = client.get(url)
+                timings.append(time.time() - start)
+
+            queries.append(len(captured))
+            sql_times.append(benchmark.sql_time(captured))
+
+        result = benchmark.summarize(timings)
+        result.update({
+            'url': url,
+            'status': response.status_code,
+            'queries': max(queries),
+            'sql_ms': round(benchmark.percentile(sql_times, 50) * 1000, 3),
+        })
+        return result
+
+
+    def _benchmark_size(self, num_customers):
+        call_command('flush', interactive=False, verbosity=0)
+        call_command('populate_db', customers=num_customers, seed=self.seed, stdout=self.devnull)
+
+        from loyal import urls
+        pks = self._sample_pks()
+        client = Client()
+        results = {}
+
+        for name, namespace, needs_pk in self._endpoints(urls.urlpatterns):
+            args = [pks.get(namespace)] if needs_pk else []
+            if None in args:
+                continue
+
+            results[name] = self._measure(client, reverse(name, args=args))
+            self.stdout.write("  {0:<35} p50 {p50_ms:>8.2f}ms  p95 {p95_ms:>8.2f}ms  p99 {p99_ms:>8.2f}ms  "
+                              "{queries:>3} queries  {sql_ms:>7.2f}ms SQL".format(name, **results[name]))
+
+        return results
+
+
+    def _compare(self, report):
+        previous = benchmark.read_report(self.compare)
+        regressions = 0
+
+        for size in sorted(set(previous['sizes']) & set(report['sizes']), key=int):
+            self.stdout.write("Comparing {0} customers with {1}".format(size, self.compare))
+            comparison = benchmark.compare_results(previous['sizes'][size], report['sizes'][size],
+                                                   self.METRICS, self.threshold)
+            for name, metric, old_value, new_value, ratio, regression in comparison:
+                if regression:
+                    regressions += 1
+                    self.stdout.write("  REGRESSION {0} {1}: {2} -> {3} (x{4:.2f})".format(
+                        name, metric, old_value, new_value, ratio))
+
+        self.stdout.write("{0} regressions found".format(regressions))
+
+
+    def handle(self, *args, **options):
+        try:
+            sizes = [int(size) for size in options['sizes'].split(",")]
+        except ValueError:
+            raise CommandError("--sizes must be a comma separated list of numbers")
+
+        self.requests = options['requests']
+        self.seed = options['seed']
+        self.compare = options['compare']
+        self.threshold = options['threshold']
+        self.devnull = open(os.devnull, 'w')
+
+        report = benchmark.new_report('api', requests=self.requests, seed=self.seed, sizes={})
+
+        with benchmark.test_database():
+            for size in sizes:
+                self.stdout.write("Benchmarking with {0} customers".format(size))
+                report['sizes'][str(size)] = self._benchmark_size(size)
+
+        benchmark.write_report(report, options['output'])
+        self.stdout.write("Report written to {0}".format(options['output']))
+
+        if self.compare:
+            self._compare(report)
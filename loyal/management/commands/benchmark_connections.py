@@ -0,0 +1,82 @@
+from optparse import make_option
+import os
+import time
+
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.client import RequestFactory
+from loyal import benchmark
+from loyal.connections import connection_stats
+from loyal.models import Customer
+
+
+class Command(BaseCommand):
+    help = ('Measure requests per second of the customer detail endpoint opening a database connection for every\n'
+            'request and reusing persistent connections, on a test database, writing a JSON report.\n'
+            'Requests go through the WSGI handler like in gunicorn, so connections are closed as they would be.\n'
+            'Opening connections is almost free with SQLite, run it with PostgreSQL to see the difference.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--requests', type='int', dest='requests', default=500,
+                    help='Requests in each phase'),
+        make_option('--max-age', type='int', dest='max_age', default=600,
+                    help='CONN_MAX_AGE of the phase with persistent connections'),
+        make_option('--output', dest='output', default='benchmark_connections.json',
+                    help='File where the JSON report is written'),
+    )
+
+
+    def _measure(self, phase, max_age, url, num_requests):
+        handler = WSGIHandler()
+        environ = RequestFactory()._base_environ(PATH_INFO=url, REQUEST_METHOD='GET')
+
+        def start_response(status, headers):
+            pass
+
+        connection.close()
+        connection.settings_dict['CONN_MAX_AGE'] = max_age
+        connection_stats.reset()
+
+        timings = []
+        start = time.time()
+        for _ in xrange(num_requests):
+            request_start = time.time()
+            response = handler(dict(environ), start_response)
+            ''.join(response)
+            # Closing the response finishes the request, when Django closes connections that are too old
+            response.close()
+            timings.append(time.time() - request_start)
+        elapsed = time.time() - start
+
+        results = benchmark.summarize(timings)
+        results['max_age'] = max_age
+        results['requests_per_s'] = round(num_requests / elapsed, 1)
+        results['connections'] = connection_stats.stats()
+
+        self.stdout.write("  {0:<8} {requests_per_s:>8.1f} req/s  p50 {p50_ms:>8.3f}ms  p99 {p99_ms:>8.3f}ms  "
+                          "{1} connections opened".format(phase, connection_stats.opened, **results))
+        return results
+
+
+    def handle(self, *args, **options):
+        report = benchmark.new_report('connections', requests=options['requests'])
+        old_max_age = connection.settings_dict.get('CONN_MAX_AGE', 0)
+
+        with benchmark.test_database():
+            call_command('populate_db', customers=10, stdout=open(os.devnull, 'w'))
+            url = reverse('loyal:customer:customer-detail', args=[Customer.objects.values_list('pk', flat=True)[0]])
+
+            try:
+                report['without'] = self._measure("without", 0, url, options['requests'])
+                report['with'] = self._measure("with", options['max_age'], url, options['requests'])
+            finally:
+                connection.settings_dict['CONN_MAX_AGE'] = old_max_age
+
+        report['speedup'] = round(report['with']['requests_per_s'] / report['without']['requests_per_s'], 2)
+        self.stdout.write("Persistent connections serve {0}x the requests per second".format(report['speedup']))
+
+        benchmark.write_report(report, options['output'])
+        self.stdout.write("Report written to {0}".format(options['output']))
@@ -0,0 +1,145 @@
+from optparse import make_option
+import os
+import random
+import re
+import time
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.core.management.color import no_style
+from django.core.management.sql import custom_sql_for_model
+from django.db import connection
+from django.db.models import Max, Min
+from loyal import benchmark
+from loyal.models import Customer, Sale, Stamp, Voucher
+
+
+class Command(BaseCommand):
+    help = ('Show the query plans and timings of the hot loyalty queries with and without their indexes,\n'
+            'on a test database populated with populate_db, writing a JSON report.\n'
+            'Customers get about 5 stamps each, so --customers 2000000 gives about 10M stamps.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--customers', type='int', dest='customers', default=20000,
+                    help='Number of customers of the dataset'),
+        make_option('--queries', type='int', dest='queries', default=200,
+                    help='Times each query is run in each phase'),
+        make_option('--seed', type='int', dest='seed', default=2048,
+                    help='Seed used to populate the dataset and pick the customers'),
+        make_option('--output', dest='output', default='benchmark_indexes.json',
+                    help='File where the JSON report is written'),
+    )
+
+    CREATE_INDEX = re.compile(r'CREATE INDEX "?(\w+)"?', re.IGNORECASE)
+
+
+    def _queries(self):
+        """
+        The hot queries, for a given customer.
+        """
+
+        def available_stamps(customer_id):
+            return Stamp.objects.filter(owned_by=customer_id, grouped_in__isnull=True).order_by('pk')[:10]
+
+        def available_vouchers(customer_id):
+            return (Voucher.objects.filter(owned_by=customer_id, redeemed_with__isnull=True)
+                           .order_by('date', 'pk')[:1])
+
+        def latest_sales(customer_id):
+            return Sale.objects.filter(customer=customer_id).order_by('-date', '-pk')[:20]
+
+        def latest_stamps(customer_id):
+            return Stamp.objects.filter(owned_by=customer_id).order_by('-date', '-pk')[:20]
+
+        return [(query.__name__, query) for query in (available_stamps, available_vouchers, latest_sales,
+                                                       latest_stamps)]
+
+
+    def _indexes(self):
+        """
+        Name and CREATE INDEX statement of the indexes being benchmarked: the partial ones from loyal/sql and
+        those from index_together.
+        """
+
+        style = no_style()
+        statements = []
+        for model in (Customer, Sale, Stamp, Voucher):
+            statements += custom_sql_for_model(model, style, connection)
+            for fields in model._meta.index_together:
+                statements += connection.creation.sql_indexes_for_fields(
+                    model, [model._meta.get_field(name) for name in fields], style)
+
+        return [(self.CREATE_INDEX.search(sql).group(1), sql) for sql in statements if self.CREATE_INDEX.search(sql)]
+
+
+    def _analyze(self):
+        connection.cursor().execute("ANALYZE")
+
+
+    def _plan(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        explain = "EXPLAIN ANALYZE " if connection.vendor == 'postgresql' else "EXPLAIN QUERY PLAN "
+
+        cursor = connection.cursor()
+        cursor.execute(explain + sql, params)
+        return [" ".join(str(column) for column in row) for row in cursor.fetchall()]
+
+
+    def _measure(self, phase):
+        self.stdout.write("Measuring {0} indexes".format(phase))
+        results = {}
+
+        cursor = connection.cursor()
+        for name, query in self._queries():
+            # We only time the DB, building the SQL is the same with or without indexes
+            timings = []
+            for customer_id in self.customer_ids:
+                sql, params = query(customer_id).query.sql_with_params()
+                start = time.time()
+                cursor.execute(sql, params)
+                cursor.fetchall()
+                timings.append(time.time() - start)
+
+            results[name] = benchmark.summarize(timings)
+            results[name]['plan'] = self._plan(query(self.customer_ids[0]))
+
+            self.stdout.write("  {0:<20} p50 {p50_ms:>8.3f}ms  p95 {p95_ms:>8.3f}ms  p99 {p99_ms:>8.3f}ms".format(
+                name, **results[name]))
+            for line in results[name]['plan']:
+                self.stdout.write("      " + line)
+
+        return results
+
+
+    def handle(self, *args, **options):
+        rand = random.Random(options['seed'])
+        report = benchmark.new_report('indexes', customers=options['customers'], queries=options['queries'],
+                                      seed=options['seed'])
+
+        with benchmark.test_database():
+            self.stdout.write("Populating {0} customers".format(options['customers']))
+            call_command('populate_db', customers=options['customers'], seed=options['seed'],
+                         stdout=open(os.devnull, 'w'))
+            report['stamps'] = Stamp.objects.count()
+
+            limits = Customer.objects.aggregate(first=Min('pk'), last=Max('pk'))
+            self.customer_ids = [rand.randint(limits['first'], limits['last']) for _ in xrange(options['queries'])]
+
+            indexes = self._indexes()
+            report['indexes'] = [name for name, _ in indexes]
+
+            cursor = connection.cursor()
+            for name, _ in indexes:
+                cursor.execute("DROP INDEX " + connection.ops.quote_name(name))
+            self._analyze()
+            report['without'] = self._measure("without")
+
+            start = time.time()
+            for _, sql in indexes:
+                cursor.execute(sql)
+            self._analyze()
+            report['index_creation_s'] = round(time.time() - start, 3)
+            report['with'] = self._measure("with")
+
+        benchmark.write_report(report, options['output'])
+        self.stdout.write("Report written to {0}".format(options['output']))
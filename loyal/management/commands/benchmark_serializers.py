@@ -0,0 +1,150 @@
+from optparse import make_option
+import gc
+import json
+import os
+import time
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.client import RequestFactory
+from loyal import benchmark
+from loyal.models import Product, Stamp, Voucher
+from loyal.serializers import (ProductSerializer, ProductValuesSerializer, StampListSerializer, StampValuesSerializer,
+                               VoucherListSerializer, VoucherValuesSerializer)
+
+
+def _memory_status(key):
+    # Size in bytes of a line of /proc/self/status, like VmRSS or VmHWM (the peak)
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith(key + ':'):
+                return int(line.split()[1]) * 1024
+    return None
+
+
+def _reset_peak_memory():
+    # Since Linux 4.0 writing 5 to clear_refs resets VmHWM to the current size
+    with open('/proc/self/clear_refs', 'w') as clear_refs:
+        clear_refs.write('5')
+
+
+class Command(BaseCommand):
+    help = ('Measure rows per second and peak memory serializing the whole product, stamp and voucher lists with\n'
+            'their ModelSerializers and with the serializers of values_list() rows, on a test database populated\n'
+            'with populate_db, writing a JSON report.\n'
+            'Every run reads and serializes the list in a forked process, so the peak memory is only its own.\n'
+            'Peak memory needs Linux 4.0 or later.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--customers', type='int', dest='customers', default=500,
+                    help='Customers created by populate_db'),
+        make_option('--runs', type='int', dest='runs', default=3,
+                    help='Runs of each serializer, the fastest is reported'),
+        make_option('--output', dest='output', default='benchmark_serializers.json',
+                    help='File where the JSON report is written'),
+    )
+
+    LISTS = (
+        ('products', Product, 'loyal:product:product-list', ProductSerializer, ProductValuesSerializer),
+        ('stamps', Stamp, 'loyal:stamp:stamp-list', StampListSerializer, StampValuesSerializer),
+        ('vouchers', Voucher, 'loyal:voucher:voucher-list', VoucherListSerializer, VoucherValuesSerializer),
+    )
+
+
+    def _serialize_models(self, serializer_class, queryset, context):
+        return serializer_class(list(queryset), many=True, context=context).data
+
+
+    def _serialize_values(self, serializer_class, queryset, context):
+        return serializer_class(serializer_class.fetch(queryset), many=True, context=context).data
+
+
+    def _measure_in_child(self, serialize):
+        gc.collect()
+        try:
+            _reset_peak_memory()
+            baseline = _memory_status('VmRSS')
+        except IOError:
+            baseline = None
+
+        start = time.time()
+        data = serialize()
+        elapsed = time.time() - start
+
+        peak = _memory_status('VmHWM') if baseline is not None else None
+        return {'rows': len(data), 'seconds': elapsed, 'peak_bytes': peak - baseline if peak else None}
+
+
+    def _run(self, serialize):
+        """
+        Run serialize() in a forked process and return its measures.
+        """
+
+        read_end, write_end = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_end)
+            status = 1
+            try:
+                if connection.vendor != 'sqlite':
+                    # Leave the connection to the parent and open a new one, the in-memory SQLite one can't be
+                    connection.connection = None
+                with os.fdopen(write_end, 'w') as pipe:
+                    json.dump(self._measure_in_child(serialize), pipe)
+                status = 0
+            finally:
+                # Skip the cleanup of the parent, like destroying the test database
+                os._exit(status)
+
+        os.close(write_end)
+        with os.fdopen(read_end) as pipe:
+            output = pipe.read()
+        _, status = os.waitpid(pid, 0)
+        if status:
+            raise CommandError("Benchmark process failed")
+        return json.loads(output)
+
+
+    def _measure(self, name, phase, serialize, runs):
+        measures = [self._run(serialize) for _ in xrange(runs)]
+        fastest = min(measures, key=lambda measure: measure['seconds'])
+        peaks = [measure['peak_bytes'] for measure in measures if measure['peak_bytes'] is not None]
+
+        results = {
+            'rows': fastest['rows'],
+            'rows_per_s': round(fastest['rows'] / fastest['seconds'], 1),
+            'peak_memory_kb': max(peaks) // 1024 if peaks else None,
+        }
+        self.stdout.write("  {0:<8} {1:<7} {rows_per_s:>10.1f} rows/s  peak memory {2}".format(
+            name, phase, '{0} KB'.format(results['peak_memory_kb']) if peaks else 'unknown', **results))
+        return results
+
+
+    def handle(self, *args, **options):
+        report = benchmark.new_report('serializers', runs=options['runs'], customers=options['customers'])
+
+        with open(os.devnull, 'w') as devnull, benchmark.test_database():
+            call_command('populate_db', customers=options['customers'], stdout=devnull)
+
+            for name, model, view_name, serializer_class, values_serializer_class in self.LISTS:
+                queryset = model.objects.order_by('pk')
+                context = {'request': RequestFactory().get(reverse(view_name))}
+                report[name] = {
+                    'model': self._measure(name, 'model', lambda: self._serialize_models(
+                        serializer_class, queryset, context), options['runs']),
+                    'values': self._measure(name, 'values', lambda: self._serialize_values(
+                        values_serializer_class, queryset, context), options['runs']),
+                }
+
+                model_results, values_results = report[name]['model'], report[name]['values']
+                report[name]['speedup'] = round(values_results['rows_per_s'] / model_results['rows_per_s'], 2)
+                if model_results['peak_memory_kb'] and values_results['peak_memory_kb']:
+                    report[name]['memory_ratio'] = round(
+                        float(values_results['peak_memory_kb']) / model_results['peak_memory_kb'], 2)
+                self.stdout.write("  {0:<8} values_list() rows serialize {1}x faster".format(
+                    name, report[name]['speedup']))
+
+        benchmark.write_report(report, options['output'])
+        self.stdout.write("Report written to {0}".format(options['output']))
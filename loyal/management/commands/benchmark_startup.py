@@ -0,0 +1,120 @@
+from optparse import make_option
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from loyal import benchmark
+
+
+SETUP_SCRIPT = """
+from loyal.models import Customer
+customer = Customer(first_name='Startup', last_name='Benchmark', email='startup@example.com')
+customer.save()
+print(customer.pk)
+"""
+
+# Runs in a new interpreter, timing from before Django is imported
+MEASURE_SCRIPT = """
+import time
+start = time.time()
+import json
+import sys
+from wsgiref.util import setup_testing_defaults
+from yoyo_test.wsgi import application
+loaded = time.time()
+
+statuses = []
+environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': sys.argv[1]}
+setup_testing_defaults(environ)
+response = application(environ, lambda status, headers: statuses.append(status))
+''.join(response)
+response.close()
+done = time.time()
+
+print(json.dumps({'status': statuses[0], 'load': loaded - start, 'first_request': done - loaded}))
+"""
+
+
+class Command(BaseCommand):
+    help = ('Measure the time a new process takes to answer its first request to the customer detail endpoint,\n'
+            'with all the apps and with LOYAL_API_ONLY, on a temporary SQLite database, writing a JSON report.\n'
+            'Every run is a new Python process, like a gunicorn worker started without preloading the app.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--runs', type='int', dest='runs', default=5,
+                    help='Processes started for each profile'),
+        make_option('--output', dest='output', default='benchmark_startup.json',
+                    help='File where the JSON report is written'),
+    )
+
+    PROFILES = (
+        ('full', ''),
+        ('api_only', '1'),
+    )
+
+
+    def _run(self, script, env, *args):
+        process = subprocess.Popen([sys.executable, '-c', script] + list(args), cwd=settings.BASE_DIR, env=env,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = process.communicate()
+        if process.returncode:
+            raise CommandError("Benchmark process failed:\n" + err)
+        return out.strip().splitlines()[-1]
+
+
+    def _measure(self, profile, env, url, runs):
+        wall = []
+        loads = []
+        first_requests = []
+        for _ in xrange(runs):
+            start = time.time()
+            result = json.loads(self._run(MEASURE_SCRIPT, env, url))
+            wall.append(time.time() - start)
+            if not result['status'].startswith('200'):
+                raise CommandError("{0} answered {1}".format(url, result['status']))
+            loads.append(result['load'])
+            first_requests.append(result['first_request'])
+
+        results = benchmark.summarize(wall)
+        results['load_p50_ms'] = round(benchmark.percentile(loads, 50) * 1000, 3)
+        results['first_request_p50_ms'] = round(benchmark.percentile(first_requests, 50) * 1000, 3)
+
+        self.stdout.write("  {0:<8} first 200 after {p50_ms:>8.1f}ms  (loading {load_p50_ms:.1f}ms, "
+                          "first request {first_request_p50_ms:.1f}ms)".format(profile, **results))
+        return results
+
+
+    def handle(self, *args, **options):
+        report = benchmark.new_report('startup', runs=options['runs'])
+
+        directory = tempfile.mkdtemp()
+        try:
+            env = dict(os.environ,
+                       DJANGO_SETTINGS_MODULE='yoyo_test.settings',
+                       PYTHONPATH=settings.BASE_DIR,
+                       DATABASE_URL='sqlite:///' + os.path.join(directory, 'startup.sqlite3'),
+                       LOYAL_API_ONLY='')
+            for key in ('LOYAL_REPLICA_URLS', 'LOYAL_SHARD_URLS'):
+                env.pop(key, None)
+
+            with open(os.devnull, 'w') as devnull:
+                subprocess.check_call([sys.executable, 'manage.py', 'syncdb', '--noinput'], cwd=settings.BASE_DIR,
+                                      env=env, stdout=devnull)
+            url = '/loyal/customer/{0}/'.format(self._run(SETUP_SCRIPT, env))
+
+            for profile, api_only in self.PROFILES:
+                report[profile] = self._measure(profile, dict(env, LOYAL_API_ONLY=api_only), url, options['runs'])
+        finally:
+            shutil.rmtree(directory)
+
+        report['speedup'] = round(report['full']['p50_ms'] / report['api_only']['p50_ms'], 2)
+        self.stdout.write("API-only processes answer their first request {0}x faster".format(report['speedup']))
+
+        benchmark.write_report(report, options['output'])
+        self.stdout.write("Report written to {0}".format(options['output']))
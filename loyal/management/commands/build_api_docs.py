@@ -0,0 +1,23 @@
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from loyal.docs import api_docs
+
+
+class Command(BaseCommand):
+    help = ('Generate the API docs served in /docs/ and store them for the current version of the code,\n'
+            'so the web processes don\'t have to generate them. Run it when deploying.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--output', dest='output', default=None,
+                    help='File where the docs are written, LOYAL_API_DOCS_FILE by default'),
+    )
+
+
+    def handle(self, *args, **options):
+        filename = options['output'] or settings.LOYAL_API_DOCS_FILE
+        docs = api_docs.build()
+        api_docs.store(docs, filename)
+        self.stdout.write("API docs of {0} resources for version {1} written to {2}".format(
+            len(docs['resources']), docs['version'], filename))
@@ -0,0 +1,88 @@
+import csv
+from optparse import make_option
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from loyal.bulk import CSV_TABLES, can_copy, check_unsharded, report_throughput
+
+
+class Command(BaseCommand):
+    args = '<directory>'
+    help = ('Write customers, sales, products, vouchers and stamps to CSV files in a directory, one per table,\n'
+            'that can be loaded with import_loyalty.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size', default=10000,
+                    help='Rows read with each query'),
+    )
+
+
+    def _copy(self, model, columns, csv_file):
+        """
+        Dump the table with COPY, returns the number of rows written.
+        """
+
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+        cursor.copy_expert("COPY (SELECT {0} FROM {1} ORDER BY {2}) TO STDOUT WITH CSV HEADER".format(
+            ", ".join(map(qn, columns)), qn(model._meta.db_table), qn(model._meta.pk.column)), csv_file)
+        return cursor.rowcount
+
+
+    def _write(self, model, columns, csv_file):
+        """
+        Dump the table in batches of rows following the primary key, returns the number of rows written.
+        """
+
+        writer = csv.writer(csv_file)
+        writer.writerow(columns)
+
+        num_rows = 0
+        last_pk = None
+        while True:
+            queryset = model.objects.order_by('pk').values_list(*columns)
+            if last_pk is not None:
+                queryset = queryset.filter(pk__gt=last_pk)
+
+            rows = list(queryset[:self.batch_size])
+            for row in rows:
+                writer.writerow([self._to_csv(value) for value in row])
+
+            num_rows += len(rows)
+            if len(rows) < self.batch_size:
+                return num_rows
+            last_pk = rows[-1][0]
+
+
+    def _to_csv(self, value):
+        if value is None:
+            return ''
+        if hasattr(value, 'isoformat'):
+            return value.isoformat()
+        if isinstance(value, unicode):
+            return value.encode('utf-8')
+        return value
+
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Usage: export_loyalty <directory>")
+        check_unsharded()
+
+        directory = args[0]
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.batch_size = options['batch_size']
+        dump = self._copy if can_copy() else self._write
+
+        for name, model, columns in CSV_TABLES:
+            self.stdout.write("Writing {0} ".format(name), ending='')
+            self.stdout.flush()
+
+            start = time.time()
+            with open(os.path.join(directory, name + '.csv'), 'wb') as csv_file:
+                num_rows = dump(model, columns, csv_file)
+            report_throughput(self.stdout, num_rows, start)
@@ -0,0 +1,140 @@
+import csv
+from cStringIO import StringIO
+from optparse import make_option
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, models, transaction
+from loyal.bulk import CSV_TABLES, can_copy, check_unsharded, chunks, report_throughput, reset_sequences
+from loyal.models import Customer, Stamp
+
+
+class Command(BaseCommand):
+    args = '<directory>'
+    help = ('Load customers, sales, products, vouchers and stamps from the CSV files of a directory, as written by\n'
+            'export_loyalty, in a single transaction. Missing files are skipped.\n'
+            'Sold widgets without a stamp get one, stamps are grouped in vouchers and balances are rebuilt.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size', default=10000,
+                    help='Rows loaded with each query'),
+    )
+
+
+    def _read(self, csv_file, columns):
+        """
+        Check the header of a CSV file, returns the columns in the file and a reader for the rows.
+        """
+
+        reader = csv.reader(csv_file)
+        header = next(reader, [])
+
+        unknown = set(header) - set(columns)
+        if unknown or not header:
+            raise CommandError("{0} must have a header with some of the columns {1}, found {2}".format(
+                csv_file.name, ", ".join(columns), ", ".join(sorted(unknown)) or "none"))
+
+        return header, reader
+
+
+    def _defaults(self, model, header):
+        """
+        Columns missing in the file and the value they must get, with COPY nobody else will fill them.
+        """
+
+        defaults = []
+        for field in model._meta.local_fields:
+            if field.primary_key or field.column in header:
+                continue
+
+            defaults.append((field.column, field.get_db_prep_save(field.get_default(), connection)))
+
+        return defaults
+
+
+    def _copy(self, model, header, rows):
+        """
+        Load the rows with COPY. Empty values are loaded as NULL, except in text columns that can't be NULL.
+        """
+
+        qn = connection.ops.quote_name
+        defaults = self._defaults(model, header)
+        columns = list(header) + [column for column, _ in defaults]
+
+        buf = StringIO()
+        writer = csv.writer(buf)
+        default_values = [value for _, value in defaults]
+        for row in rows:
+            writer.writerow(row + default_values)
+        buf.seek(0)
+
+        fields = dict((field.column, field) for field in model._meta.local_fields)
+        not_null = [qn(column) for column in columns
+                    if not fields[column].null and isinstance(fields[column], models.CharField)]
+
+        sql = "COPY {0} ({1}) FROM STDIN WITH CSV".format(qn(model._meta.db_table), ", ".join(map(qn, columns)))
+        if not_null:
+            sql += " FORCE NOT NULL " + ", ".join(not_null)
+
+        connection.cursor().copy_expert(sql, buf)
+
+
+    def _bulk_create(self, model, header, rows):
+        columns = dict((field.column, field) for field in model._meta.local_fields)
+        fields = [columns[column] for column in header]
+
+        objects = []
+        for row in rows:
+            values = {}
+            for field, value in zip(fields, row):
+                value = value.decode('utf-8')
+                values[field.attname] = None if value == '' and field.null else value
+            objects.append(model(**values))
+
+        model.objects.bulk_create(objects)
+
+
+    def _load(self, name, model, columns, filename):
+        self.stdout.write("Loading {0} ".format(name), ending='')
+        self.stdout.flush()
+
+        start = time.time()
+        num_rows = 0
+
+        load = self._copy if can_copy() else self._bulk_create
+        with open(filename, 'rb') as csv_file:
+            header, reader = self._read(csv_file, columns)
+            for batch in chunks(reader, self.batch_size):
+                load(model, header, batch)
+                num_rows += len(batch)
+
+        report_throughput(self.stdout, num_rows, start)
+
+
+    def _step(self, description, function, what):
+        self.stdout.write(description + " ", ending='')
+        self.stdout.flush()
+
+        start = time.time()
+        report_throughput(self.stdout, function(), start, what)
+
+
+    def handle(self, *args, **options):
+        if len(args) != 1 or not os.path.isdir(args[0]):
+            raise CommandError("Usage: import_loyalty <directory>")
+        check_unsharded()
+
+        self.batch_size = options['batch_size']
+
+        with transaction.atomic():
+            for name, model, columns in CSV_TABLES:
+                filename = os.path.join(args[0], name + '.csv')
+                if os.path.exists(filename):
+                    self._load(name, model, columns, filename)
+
+            reset_sequences([model for _, model, _ in CSV_TABLES])
+
+            self._step("Stamping sold widgets", Stamp.create_missing_stamps, "stamps")
+            self._step("Grouping stamps in vouchers", Stamp.group_all_into_vouchers, "vouchers")
+            self._step("Rebuilding balances", Customer.rebuild_balances, "customers")
@@ -1,191 +1,304 @@
-#    from django.db.models import Count
+from array import array
+from bisect import bisect_right
+from optparse import make_option
+import random
+import time
 
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+from loyal.bulk import check_unsharded, chunks, report_throughput, reset_sequences
 from loyal.models import Customer, Product, Sale, Stamp, Voucher
-import sys
-
-import random
 import names as gen_names
-from django.utils import timezone
+
+
+
+class NameGenerator(object):
+    """
+    Generates names with the same distribution as the names package, but loading the name files only once
+    and using our own random generator so the results only depend on the seed.
+    """
+
+    def __init__(self, rand):
+        self.rand = rand
+        self.names = dict((kind, self._load(filename)) for kind, filename in gen_names.FILES.items())
+
+
+    def _load(self, filename):
+        names = []
+        cummulatives = []
+        with open(filename) as name_file:
+            for line in name_file:
+                name, _, cummulative, _ = line.split()
+                names.append(name.capitalize())
+                cummulatives.append(float(cummulative))
+
+        return names, cummulatives
+
+
+    def _get_name(self, kind):
+        names, cummulatives = self.names[kind]
+        position = bisect_right(cummulatives, self.rand.random() * 90)
+        return names[position] if position < len(names) else ""
+
+
+    def get_first_name(self):
+        return self._get_name(self.rand.choice(('first:male', 'first:female')))
+
+
+    def get_last_name(self):
+        return self._get_name('last')
+
+
 
 class Command(BaseCommand):
-    args = '<foo bar ...>'
-    help = 'our help string comes here'
+    help = ('Populate the DB with random customers, products, sales, stamps and vouchers.\n'
+            'The same seed and sizes always generate the same data.')
 
-    num_customers = 100
-    num_products = num_customers * 10
+    option_list = BaseCommand.option_list + (
+        make_option('--customers', type='int', dest='customers', default=100,
+                    help='Number of customers to create'),
+        make_option('--products', type='int', dest='products', default=None,
+                    help='Number of products to create, 10 per customer by default'),
+        make_option('--seed', type='int', dest='seed', default=2048,
+                    help='Seed for the random generator'),
+        make_option('--batch-size', type='int', dest='batch_size', default=1000,
+                    help='Rows inserted with each query'),
+        make_option('--transaction-size', type='int', dest='transaction_size', default=50000,
+                    help='Rows inserted in each transaction'),
+    )
 
+    # We'll only sell 80% of the products
+    SOLD_RATIO = 0.8
+    MAX_PRODUCTS_PER_SALE = 9
 
-    def _create_customers(self):
-        print "Adding {0} customers ".format(self.num_customers),
-        for _ in xrange(self.num_customers):
-            name = gen_names.get_first_name()
-            surname = gen_names.get_last_name()
-            user = Customer(first_name=name, last_name=surname, email=name+"@"+surname+".com")
-            user.save()
-            sys.stdout.write('.')
+    # We'll redeem 50% of the vouchers
+    REDEEM_RATIO = 0.5
 
-        print "OK"
 
+    def _insert(self, model, objects, description):
+        """
+        Insert the objects with batched bulk_create, committing every transaction_size rows,
+        and report the throughput.
+        """
 
+        self.stdout.write("{0} ".format(description), ending='')
+        self.stdout.flush()
 
-    def _create_products(self):
-        print "Adding {0} products ".format(self.num_products),
-        serial_num_int = 1
+        start = time.time()
+        num_rows = 0
 
-        # Products are manufactured more than 30 days ago
-        min_delta = - timezone.timedelta(days=30).total_seconds()
-        max_delta = 2 * min_delta
-        now = timezone.now()
+        for chunk in chunks(objects, self.transaction_size):
+            with transaction.atomic():
+                for batch in chunks(chunk, self.batch_size):
+                    model.objects.bulk_create(batch)
+                    num_rows += len(batch)
 
-        for _ in xrange(self.num_products):
-            # Random product type
-            product_type = random.randint(0, len(Product.PRODUCT_CHOICES)-1)
+        report_throughput(self.stdout, num_rows, start)
+
+
+    def _first_id(self, model):
+        """
+        We set the primary keys ourselves to link the rows without reading them back.
+        """
+
+        return (model.objects.aggregate(last=Max('pk'))['last'] or 0) + 1
 
-            # Get how it must be stored in the DB
-            kind = Product.PRODUCT_CHOICES[product_type][0]
 
-            sale = None
+    def _random_age(self, min_days, max_days):
+        return self.rand.randint(min_days * 86400, max_days * 86400)
 
-            # Generate a 10 digit serial number
-            serial_num = "{0:0>10d}".format(serial_num_int)
-            serial_num_int += 1
 
-            # Create a random date
-            date = now - timezone.timedelta(seconds=random.randint(max_delta,min_delta))
+    def _random_date(self, min_days, max_days):
+        return self.now - timezone.timedelta(seconds=self._random_age(min_days, max_days))
 
-            #Create the product
-            product = Product(kind=kind, sale=sale, date=date, serial_num=serial_num)
-            product.save()
 
-            sys.stdout.write('.')
+    def _random_customer(self):
+        return self.first_customer + self.rand.randint(0, self.num_customers - 1)
 
-        print "OK"
 
+    def _customers(self):
+        for i in xrange(self.num_customers):
+            name = self.names.get_first_name()
+            surname = self.names.get_last_name()
+            yield Customer(pk=self.first_customer + i, first_name=name, last_name=surname,
+                           email=name + "@" + surname + ".com")
+
+
+    def _sales(self):
+        """
+        Decide which products are sold and in which sale, creating the sales as we go.
+        All sales will be in the last 30 days.
+        """
+
+        self.kinds = bytearray(self.num_products)
+        self.product_sale = array('l', [0]) * self.num_products
+        self.sale_customer = array('l')
+        self.sale_age = array('l')
+
+        sale_id = self.first_sale - 1
+        left_in_sale = 0
+
+        for i in xrange(self.num_products):
+            # Random product type
+            self.kinds[i] = self.rand.choice(Product.PRODUCT_CHOICES)[0]
+
+            if self.rand.random() >= self.SOLD_RATIO:
+                continue
 
+            # Start a new sale for a random customer
+            if not left_in_sale:
+                sale_id += 1
+                left_in_sale = self.rand.randint(1, self.MAX_PRODUCTS_PER_SALE)
+                customer_id = self._random_customer()
+                self.sale_customer.append(customer_id)
+                self.sale_age.append(self._random_age(0, 30))
+                yield Sale(pk=sale_id, customer_id=customer_id,
+                           date=self.now - timezone.timedelta(seconds=self.sale_age[-1]))
 
-    def _create_sales_and_stamps(self):
-        # All sales will be in the last 30 days
-        max_delta = - timezone.timedelta(days=30).total_seconds()
-        now = timezone.now()
+            self.product_sale[i] = sale_id
+            left_in_sale -= 1
 
-        # We'll only sell 80% of the total number of products
-        products_to_sell = int(0.8 * self.num_products)
 
-        # We'll generate a random number of sales
-        num_sales = random.randint(self.num_customers, products_to_sell/5)
-        products_sold = 0
+    def _products(self):
+        """
+        Products are manufactured between 30 and 60 days ago, with a 10 digit serial number.
+        """
 
-        print "Creating {0} sales ".format(num_sales),
+        for i in xrange(self.num_products):
+            product_id = self.first_product + i
+            sale_id = self.product_sale[i] or None
+            yield Product(pk=product_id, kind=self.kinds[i], date=self._random_date(30, 60),
+                          serial_num="{0:0>10d}".format(product_id), sale_id=sale_id)
 
-        for i in xrange(num_sales):
-            # Create random sale
-            date = now - timezone.timedelta(seconds=random.randint(max_delta,0))
-            customer_num = random.randint(1, self.num_customers)
-            customer = Customer.objects.get(pk=customer_num)
-            sale = Sale(customer=customer, date=date)
-            sale.save()
 
-            # Attach products to customer
-            randomize_products = products_to_sell - (num_sales - i)
-            num_products = random.randint(1, randomize_products)
+    def _stamp_owners(self):
+        """
+        Yield the owner, product and sale of every stamp in creation order: first those from selling widgets,
+        then one free stamp per customer given to random customers.
+        """
 
-            if customer_num == 1:
-                import pdb
-                pdb.set_trace()
+        for i in xrange(self.num_products):
+            sale_id = self.product_sale[i]
+            if sale_id and self.kinds[i] == Product.WIDGET:
+                yield self.sale_customer[sale_id - self.first_sale], self.first_product + i, sale_id
 
-            for i in xrange(products_sold+1, products_sold+num_products+1):
-                product = Product.objects.get(pk=i)
-                product.sale = sale
-                product.save()
+        for customer_id in self.free_stamps:
+            yield customer_id, None, None
 
-                # If it's a Widget we should add a Stamp
-                if product.kind == Product.WIDGET:
-                    stamp = Stamp(owned_by=customer, obtained_with=product, grouped_in=None)
-                    stamp.save()
 
-            products_to_sell -= num_products
-            products_sold += num_products
+    def _plan_vouchers(self):
+        """
+        Every STAMPS_PER_VOUCHER stamps of a customer are grouped in a voucher, so knowing how many stamps
+        each customer gets we can give their vouchers consecutive ids.
+        """
 
-            sys.stdout.write('.')
+        self.free_stamps = [self._random_customer() for _ in xrange(self.num_customers)]
 
-        print "OK"
+        stamps_per_customer = array('l', [0]) * self.num_customers
+        for customer_id, _, _ in self._stamp_owners():
+            stamps_per_customer[customer_id - self.first_customer] += 1
 
-    def _create_vocheurs(self):
-        for customer in Customer.objects.values_list('pk',flat=True).all():
-            stamps = Stamp.objects.filter(given_with__sold_in__customer=customer)
-            for i in xrange(9, stamps.count(), 10):
-                to_voucher = stamps[i-9:i+1]
-                voucher = Voucher(redeemed_in=None)
-                voucher.save()
-                for x in to_voucher:
-                    x.for_voch = voucher
-                    x.save()
+        self.customer_vouchers = array('l', [0]) * self.num_customers
+        self.first_customer_voucher = array('l', [0]) * self.num_customers
+        voucher_id = self.first_voucher
+        for i, num_stamps in enumerate(stamps_per_customer):
+            self.first_customer_voucher[i] = voucher_id
+            self.customer_vouchers[i] = num_stamps // Stamp.STAMPS_PER_VOUCHER
+            voucher_id += self.customer_vouchers[i]
 
-        #r = Stamp.objects.value('given_with__sold_in__customer__pk').annotate(count=Count('pk'))
-        #Sale.customer
-        pass
+        self.free_vouchers = [self._random_customer() for _ in xrange(self.num_customers // 2)]
+        self.num_vouchers = voucher_id - self.first_voucher + len(self.free_vouchers)
 
 
-    def _create_free_stamps(self):
-        free_stamps = self.num_customers
-        print "Creating {0} free stamps".format(free_stamps),
+    def _vouchers(self):
+        """
+        Create the vouchers that group stamps and the free ones, redeeming some of them with unsold products.
+        """
 
-        for _ in xrange(free_stamps):
-            # Pick a random customer
-            customer_id = random.randint(1, self.num_customers)
-            customer = Customer.objects.get(pk=customer_id)
+        unsold_products = (self.first_product + i for i in xrange(self.num_products) if not self.product_sale[i])
 
-            # Create a free stamp for that user
-            stamp = Stamp(owned_by=customer)
-            stamp.save()
-            sys.stdout.write('.')
+        def owners():
+            for i in xrange(self.num_customers):
+                for _ in xrange(self.customer_vouchers[i]):
+                    yield self.first_customer + i
+            for customer_id in self.free_vouchers:
+                yield customer_id
 
-        print "OK"
+        for voucher_id, customer_id in enumerate(owners(), self.first_voucher):
+            redeemed_with = None
+            if self.rand.random() < self.REDEEM_RATIO:
+                redeemed_with = next(unsold_products, None)
 
+            yield Voucher(pk=voucher_id, owned_by_id=customer_id, redeemed_with_id=redeemed_with)
 
-    def _create_free_vouchers(self):
-        free_vouchers = self.num_customers / 2
-        print "Creating {0} free vouchers".format(free_vouchers),
 
-        for _ in xrange(free_vouchers):
-            # Pick a random customer
-            customer_id = random.randint(1, self.num_customers)
-            customer = Customer.objects.get(pk=customer_id)
+    def _stamps(self):
+        """
+        Create the stamps, grouping them in the customer's vouchers as long as there are enough of them.
+        Stamps from purchases have the date of the sale, free stamps are from the last 30 days.
+        """
 
-            # Add a free voucher to the customer
-            voucher = Voucher(owned_by=customer)
-            voucher.save()
-            sys.stdout.write('.')
+        stamps_given = array('l', [0]) * self.num_customers
 
-        print "OK"
+        for stamp_id, (customer_id, product_id, sale_id) in enumerate(self._stamp_owners(), self.first_stamp):
+            i = customer_id - self.first_customer
+            voucher = stamps_given[i] // Stamp.STAMPS_PER_VOUCHER
+            stamps_given[i] += 1
 
+            grouped_in = None
+            if voucher < self.customer_vouchers[i]:
+                grouped_in = self.first_customer_voucher[i] + voucher
 
-    def _redeem_vocheurs(self):
-        # We'll redeem 50% of the vouchers
-        num_vouchers = Voucher.objects.count()
-        num_redeem = num_vouchers / 2
+            age = self.sale_age[sale_id - self.first_sale] if sale_id else self._random_age(0, 30)
+            yield Stamp(pk=stamp_id, owned_by_id=customer_id, obtained_with_id=product_id, grouped_in_id=grouped_in,
+                        date=self.now - timezone.timedelta(seconds=age))
 
-        print "Redeeming {0} vouchers from {1}".format(num_redeem, num_vouchers),
 
-        # Get the products that will be acquired with those vouchers
-        products = list(Product.objects.filter(voucher__isnull=True)[:num_redeem])
-        for voucher in Voucher.objects.all()[:num_redeem]:
-            voucher.redeemed_with = products.pop()
-            voucher.save()
-            sys.stdout.write('.')
+    def _rebuild_balances(self):
+        self.stdout.write("Rebuilding balances ", ending='')
+        self.stdout.flush()
 
+        start = time.time()
+        last_customer = self.first_customer + self.num_customers - 1
+        for first_id in xrange(self.first_customer, last_customer + 1, self.transaction_size):
+            with transaction.atomic():
+                Customer.rebuild_balances(first_id, min(first_id + self.transaction_size, last_customer + 1) - 1)
 
-        print "OK"
+        report_throughput(self.stdout, self.num_customers, start, "customers")
 
 
     def handle(self, *args, **options):
-        random.seed(2048)
-
-        print "Populating DB"
-        self._create_customers()
-        self._create_products()
-        self._create_sales_and_stamps()
-        self._create_free_stamps()
-        self._create_free_vouchers()
-        self._redeem_vocheurs()
+        check_unsharded()
+        self.rand = random.Random(options['seed'])
+        self.names = NameGenerator(self.rand)
+        self.now = timezone.now()
+
+        self.num_customers = options['customers']
+        if self.num_customers < 1:
+            raise CommandError("We need at least 1 customer")
+        self.num_products = options['products']
+        if self.num_products is None:
+            self.num_products = self.num_customers * 10
+        self.batch_size = options['batch_size']
+        self.transaction_size = options['transaction_size']
+
+        self.first_customer = self._first_id(Customer)
+        self.first_sale = self._first_id(Sale)
+        self.first_product = self._first_id(Product)
+        self.first_voucher = self._first_id(Voucher)
+        self.first_stamp = self._first_id(Stamp)
+
+        self.stdout.write("Populating DB")
+        self._insert(Customer, self._customers(), "Adding {0} customers".format(self.num_customers))
+        self._insert(Sale, self._sales(), "Creating sales")
+        self._insert(Product, self._products(), "Adding {0} products".format(self.num_products))
+
+        self._plan_vouchers()
+        self._insert(Voucher, self._vouchers(), "Creating {0} vouchers".format(self.num_vouchers))
+        self._insert(Stamp, self._stamps(), "Creating stamps")
+
+        # We have set the primary keys ourselves, so the DB sequences must catch up
+        reset_sequences([Customer, Sale, Product, Voucher, Stamp])
+        self._rebuild_balances()
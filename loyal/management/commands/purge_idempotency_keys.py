@@ -0,0 +1,28 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from loyal import routers
+from loyal.models import IdempotencyKey
+
+
+class Command(BaseCommand):
+    help = 'Delete the expired idempotency keys, LOYAL_IDEMPOTENCY_TTL seconds after they were received'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size', default=1000,
+                    help='Number of keys deleted in each transaction'),
+    )
+
+
+    def handle(self, *args, **options):
+        # Short transactions, so requests storing new keys don't wait for the purge
+        purged = 0
+        for alias in routers.shards():
+            with routers.shard(alias):
+                while True:
+                    deleted = IdempotencyKey.purge_expired(options['batch_size'])
+                    purged += deleted
+                    if deleted < options['batch_size']:
+                        break
+
+        self.stdout.write("Purged {0} idempotency keys".format(purged))
@@ -0,0 +1,37 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Max, Min
+from loyal import routers
+from loyal.models import Customer
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the loyalty balance of the customers from the stamps, vouchers and sales tables'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size', default=10000,
+                    help='Number of customer ids rebuilt in each transaction'),
+    )
+
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        rebuilt = 0
+
+        for shard in routers.shards():
+            limits = Customer.objects.using(shard).aggregate(first=Min('pk'), last=Max('pk'))
+            if limits['first'] is None:
+                continue
+
+            # Rebuild in ranges of ids so we don't hold locks on the whole table
+            for first_id in xrange(limits['first'], limits['last'] + 1, batch_size):
+                with transaction.atomic(using=shard):
+                    rebuilt += Customer.rebuild_balances(first_id, first_id + batch_size - 1, using=shard)
+
+        if not rebuilt:
+            self.stdout.write("No customers to rebuild")
+            return
+
+        self.stdout.write("Rebuilt balances of {0} customers".format(rebuilt))
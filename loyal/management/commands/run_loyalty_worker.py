@@ -0,0 +1,50 @@
+from optparse import make_option
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from loyal.models import RegroupJob
+
+
+class Command(BaseCommand):
+    help = ('Convert stamps into vouchers for the customers enqueued when LOYAL_DEFERRED_VOUCHERS is enabled.\n'
+            'Several workers can run at the same time, customers are locked while their stamps are grouped.\n'
+            'Jobs that fail are logged and retried later, waiting longer after every failure.\n'
+            'While the queue is empty the wait doubles up to --max-interval, and without LOYAL_DEFERRED_VOUCHERS\n'
+            'the worker only checks every --max-interval for the jobs left from when it was enabled.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size', default=100,
+                    help='Number of jobs taken from the queue at a time'),
+        make_option('--interval', type='float', dest='interval', default=1.0,
+                    help='Seconds to wait for new jobs when the queue becomes empty'),
+        make_option('--max-interval', type='float', dest='max_interval', default=30.0,
+                    help='Most seconds to wait for new jobs while the queue stays empty'),
+        make_option('--once', action='store_true', dest='once', default=False,
+                    help='Exit when the queue is empty instead of waiting for new jobs'),
+    )
+
+
+    def handle(self, *args, **options):
+        run = 0
+        interval = options['interval']
+        try:
+            while True:
+                done = RegroupJob.run_batch(options['batch_size'])
+                run += done
+                if done:
+                    interval = options['interval']
+                if done < options['batch_size']:
+                    if options['once']:
+                        break
+                    if not getattr(settings, 'LOYAL_DEFERRED_VOUCHERS', False):
+                        # Nothing is enqueued anymore
+                        interval = options['max_interval']
+                    # A stamp waits at most this long, plus the jobs ahead of it, to be grouped
+                    time.sleep(interval)
+                    if not done:
+                        interval = min(interval * 2, options['max_interval'])
+        except KeyboardInterrupt:
+            pass
+
+        self.stdout.write("Ran {0} regroup jobs".format(run))
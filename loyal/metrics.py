@@ -0,0 +1,276 @@
+"""
+In memory request metrics.
+
+For every URL name we keep histograms of the number of queries, SQL time, view time outside the DB and the
+serializers, serializer time, renderer time, response time and total time of the requests served by this process
+during the last few minutes. Histograms have fixed buckets, so recording a request is a handful of additions and
+memory doesn't grow with traffic.
+"""
+
+from bisect import bisect_left
+from collections import deque
+import threading
+import time
+
+from django.conf import settings
+
+
+# Upper bounds of the buckets, the last bucket has no upper bound
+TIME_BUCKETS_MS = (0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+QUERY_BUCKETS = (0, 1, 2, 3, 4, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+METRICS = (
+    ('queries', QUERY_BUCKETS),
+    ('sql_ms', TIME_BUCKETS_MS),
+    ('view_python_ms', TIME_BUCKETS_MS),
+    ('serializer_ms', TIME_BUCKETS_MS),
+    ('renderer_ms', TIME_BUCKETS_MS),
+    ('response_ms', TIME_BUCKETS_MS),
+    ('total_ms', TIME_BUCKETS_MS),
+)
+
+
+class Histogram(object):
+    """
+    Histogram with fixed buckets, that only knows percentiles up to the upper bound of their bucket.
+    """
+
+    __slots__ = ('buckets', 'counts', 'count', 'total', 'max')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+
+    def add(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+
+    def merge(self, other):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+
+    def percentile(self, pct):
+        if not self.count:
+            return None
+
+        rank = pct / 100.0 * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                # Values in the last bucket are only bounded by the maximum we have seen
+                return min(self.buckets[i], self.max) if i < len(self.buckets) else self.max
+
+        return self.max
+
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': round(float(self.total) / self.count, 3) if self.count else None,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+            'max': round(self.max, 3),
+        }
+
+
+
+class RequestMetrics(object):
+    """
+    Rolling histograms per URL name.
+    Time is split in slots of slot_seconds and we keep the last num_slots slots.
+    """
+
+    def __init__(self, slot_seconds=60, num_slots=5):
+        self.slot_seconds = slot_seconds
+        self.slots = deque(maxlen=num_slots)
+        self.lock = threading.Lock()
+
+
+    def _current_slot(self):
+        slot_start = int(time.time() // self.slot_seconds) * self.slot_seconds
+        if not self.slots or self.slots[-1][0] != slot_start:
+            self.slots.append((slot_start, {}))
+        return self.slots[-1][1]
+
+
+    def record(self, url_name, **values):
+        with self.lock:
+            slot = self._current_slot()
+            histograms = slot.get(url_name)
+            if histograms is None:
+                histograms = slot[url_name] = dict((metric, Histogram(buckets)) for metric, buckets in METRICS)
+
+            for metric, value in values.items():
+                histograms[metric].add(value)
+
+
+    def summary(self):
+        """
+        Merge the histograms of the slots still inside the window.
+        """
+
+        oldest = time.time() - self.slot_seconds * self.slots.maxlen
+        merged = {}
+
+        with self.lock:
+            for slot_start, slot in self.slots:
+                if slot_start + self.slot_seconds <= oldest:
+                    continue
+
+                for url_name, histograms in slot.items():
+                    url_merged = merged.setdefault(url_name, dict((metric, Histogram(buckets))
+                                                                  for metric, buckets in METRICS))
+                    for metric, histogram in histograms.items():
+                        url_merged[metric].merge(histogram)
+
+        return dict((url_name, dict((metric, histogram.summary()) for metric, histogram in histograms.items()))
+                    for url_name, histograms in merged.items())
+
+
+    def reset(self):
+        with self.lock:
+            self.slots.clear()
+
+
+
+class SQLStats(threading.local):
+    """
+    Queries executed and time spent in the DB by the request being served in this thread.
+    """
+
+    active = False
+    queries = 0
+    sql_time = 0.0
+
+    def start(self):
+        self.active = True
+        self.queries = 0
+        self.sql_time = 0.0
+
+    def stop(self):
+        self.active = False
+
+
+
+class SerializerStats(threading.local):
+    """
+    Time spent outside the DB building the data of serializers by the request being served in this thread.
+    Serializers used by others, like the one of the results of a page, are counted once with the outer one.
+    """
+
+    active = False
+    depth = 0
+    time = 0.0
+
+    def start(self):
+        self.active = True
+        self.depth = 0
+        self.time = 0.0
+
+    def stop(self):
+        self.active = False
+
+
+
+class TimedCursor(object):
+    """
+    Cursor wrapper that only counts queries and adds up their time, unlike the debug cursor that keeps
+    the SQL of every query.
+    """
+
+    def __init__(self, cursor, stats):
+        self.cursor = cursor
+        self.stats = stats
+
+
+    def _timed(self, method, *args):
+        if not self.stats.active:
+            return method(*args)
+
+        start = time.time()
+        try:
+            return method(*args)
+        finally:
+            self.stats.sql_time += time.time() - start
+            self.stats.queries += 1
+
+
+    def execute(self, sql, params=None):
+        return self._timed(self.cursor.execute, sql, params)
+
+
+    def executemany(self, sql, param_list):
+        return self._timed(self.cursor.executemany, sql, param_list)
+
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+
+
+def instrument_connection(connection):
+    """
+    Make every cursor of the connection report to sql_stats.
+    Connections are per thread, so this is done the first time each one is used in a request.
+    """
+
+    if getattr(connection, '_metrics_instrumented', False):
+        return
+
+    original_cursor = connection.cursor
+    connection.cursor = lambda: TimedCursor(original_cursor(), sql_stats)
+    connection._metrics_instrumented = True
+
+
+
+def _timed_data(data):
+    def timed(self):
+        if not serializer_stats.active or serializer_stats.depth:
+            return data.fget(self)
+
+        serializer_stats.depth += 1
+        start, start_sql = time.time(), sql_stats.sql_time
+        try:
+            return data.fget(self)
+        finally:
+            serializer_stats.depth -= 1
+            serializer_stats.time += (time.time() - start) - (sql_stats.sql_time - start_sql)
+
+    timed._metrics_instrumented = True
+    return property(timed)
+
+
+def instrument_serializers(*classes):
+    """
+    Make the data property of the serializer classes, and of their subclasses, report to serializer_stats.
+    """
+
+    for cls in classes:
+        data = cls.__dict__['data']
+        if not getattr(data.fget, '_metrics_instrumented', False):
+            cls.data = _timed_data(data)
+
+
+
+request_metrics = RequestMetrics(slot_seconds=getattr(settings, 'LOYAL_METRICS_SLOT_SECONDS', 60),
+                                 num_slots=getattr(settings, 'LOYAL_METRICS_SLOTS', 5))
+sql_stats = SQLStats()
+serializer_stats = SerializerStats()
@@ -0,0 +1,148 @@
+import random
+import time
+
+from django.conf import settings
+from django.core.signals import request_finished
+from django.db import connections
+from django.dispatch import receiver
+from rest_framework.serializers import BaseSerializer
+from loyal import routers
+from loyal.metrics import instrument_connection, instrument_serializers, request_metrics, serializer_stats, sql_stats
+from loyal.serializers.values_serializer import ValuesSerializer
+
+
+class QueryMetricsMiddleware(object):
+    """
+    Records the number of queries, SQL time, view time outside the DB, serializer time, renderer time, response time
+    and total time of every request in loyal.metrics.request_metrics, by URL name.
+    The view_python time is what the view does outside the DB and the serializers: its own logic and whatever else it
+    calls. The serializer time is building the data of the serializers, outside the DB too, and the renderer time is
+    rendering the response. The response time goes from the view returning to this middleware getting the response,
+    which is rendering plus the response processing of the other middleware.
+    It should be the first middleware so the total time covers the other ones.
+    """
+
+    def __init__(self):
+        instrument_serializers(BaseSerializer, ValuesSerializer)
+
+
+    def process_request(self, request):
+        for connection in connections.all():
+            instrument_connection(connection)
+
+        sql_stats.start()
+        serializer_stats.start()
+        request._metrics_start = time.time()
+
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request._metrics_view = (time.time(), sql_stats.sql_time)
+
+
+    def process_template_response(self, request, response):
+        # The other middleware have processed it already, rendering comes next
+        request._metrics_rendering = (time.time(), sql_stats.sql_time)
+        response.add_post_render_callback(lambda rendered: setattr(request, '_metrics_rendered', time.time()))
+        return response
+
+
+    def process_response(self, request, response):
+        if not hasattr(request, '_metrics_start'):
+            return response
+
+        end = time.time()
+        sql_stats.stop()
+        serializer_stats.stop()
+
+        view_start, view_start_sql = getattr(request, '_metrics_view', (end, sql_stats.sql_time))
+        view_end, view_end_sql = getattr(request, '_metrics_rendering', (end, sql_stats.sql_time))
+        view_python = (view_end - view_start) - (view_end_sql - view_start_sql) - serializer_stats.time
+
+        resolver_match = getattr(request, 'resolver_match', None)
+        url_name = resolver_match.view_name if resolver_match else '<unresolved>'
+
+        metrics = {}
+        if hasattr(request, '_metrics_rendered'):
+            metrics['renderer_ms'] = (request._metrics_rendered - view_end) * 1000
+
+        request_metrics.record(url_name,
+                               queries=sql_stats.queries,
+                               sql_ms=sql_stats.sql_time * 1000,
+                               view_python_ms=max(view_python, 0) * 1000,
+                               serializer_ms=serializer_stats.time * 1000,
+                               response_ms=(end - view_end) * 1000,
+                               total_ms=(end - request._metrics_start) * 1000,
+                               **metrics)
+        return response
+
+
+
+class ReplicaMiddleware(object):
+    """
+    Chooses the database the reads of each request go to, with loyal.routers.ReplicaRouter.
+    GET and HEAD requests read from a random replica, unless they are for a customer, or a product, stamp or voucher,
+    pinned to the default database because it was written recently. When other requests finish, the customers they
+    have written are pinned, and so is the object of a detail view they have changed.
+    Processes don't start if the pins aren't shared by all of them.
+    """
+
+    SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+    CUSTOMER_NAMESPACE = 'loyal:customer'
+    # Detail views of the rows that can be changed through them
+    DETAIL_NAMESPACES = ('loyal:product', 'loyal:stamp', 'loyal:voucher')
+
+    def __init__(self):
+        routers.check_pin_cache()
+
+
+    def process_request(self, request):
+        routers.start_request()
+
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        replicas = getattr(settings, 'LOYAL_REPLICAS', ())
+        if not replicas or request.method not in self.SAFE_METHODS:
+            return None
+
+        namespace = request.resolver_match.namespace
+        if namespace == self.CUSTOMER_NAMESPACE or namespace in self.DETAIL_NAMESPACES:
+            if routers.is_pinned(namespace, view_kwargs.get('pk')):
+                return None
+
+        routers.read_from(random.choice(replicas))
+        return None
+
+
+    def process_response(self, request, response):
+        if not getattr(settings, 'LOYAL_REPLICAS', ()):
+            return response
+
+        written = routers.written_customers()
+        if written:
+            routers.pin(self.CUSTOMER_NAMESPACE, written)
+
+        resolver_match = getattr(request, 'resolver_match', None)
+        if (request.method not in self.SAFE_METHODS and response.status_code < 400 and resolver_match
+                and resolver_match.namespace in self.DETAIL_NAMESPACES and resolver_match.kwargs.get('pk')):
+            routers.pin(resolver_match.namespace, [resolver_match.kwargs['pk']])
+        return response
+
+
+
+class ShardMiddleware(object):
+    """
+    Runs the views of a customer in its shard, with loyal.routers.ShardRouter. It must come after ReplicaMiddleware,
+    which starts the request.
+    """
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if request.resolver_match.namespace == 'loyal:customer' and view_kwargs.get('pk'):
+            routers.use_customer_shard(view_kwargs['pk'])
+        return None
+
+
+
+@receiver(request_finished)
+def _finish_replica_request(sender, **kwargs):
+    # Streamed responses keep reading from the replica until they are closed
+    routers.finish_request()
@@ -1,6 +1,20 @@
-from django.db import models
+from contextlib import contextmanager
+from datetime import timedelta
+import logging
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.management.color import no_style
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, connection, connections, models, router, transaction
+from django.db.models import F
+from django.db.models.signals import post_syncdb
+from django.dispatch import receiver
 from django.utils import timezone
 
+from loyal import routers
+
+
+logger = logging.getLogger(__name__)
 # Create your models here.
 
 class Customer(models.Model):
@@ -9,18 +23,303 @@ class Customer(models.Model):
         first_name
         last_name
         email
+
+    It also stores the customer's loyalty balance, so we don't need to count stamps, vouchers and sales to show it.
+    These columns are maintained by Stamp, Voucher and Sale and can be rebuilt with the rebuild_balances command:
+        available_stamps   -> Stamps that have not been grouped in a voucher yet
+        total_stamps       -> All stamps owned
+        available_vouchers -> Vouchers that have not been redeemed yet
+        total_vouchers     -> All vouchers owned
+        num_purchases      -> Number of sales
+
+    Every change to the customer or to its sales, products, stamps and vouchers bumps its version, used for
+    conditional GETs:
+        version            -> Increased on every change
+        modified           -> When was the last change
     """
 
+    BALANCE_FIELDS = ('available_stamps', 'total_stamps', 'available_vouchers', 'total_vouchers', 'num_purchases')
+    VERSION_FIELDS = ('version', 'modified')
+
     first_name = models.CharField(max_length=20, help_text="First name")
     last_name = models.CharField(max_length=20, help_text="Last name")
     email = models.EmailField(help_text="E-mail address")
 
+    available_stamps = models.PositiveIntegerField(default=0, editable=False, help_text="Stamps not grouped in a voucher")
+    total_stamps = models.PositiveIntegerField(default=0, editable=False, help_text="Stamps owned")
+    available_vouchers = models.PositiveIntegerField(default=0, editable=False, help_text="Vouchers not redeemed")
+    total_vouchers = models.PositiveIntegerField(default=0, editable=False, help_text="Vouchers owned")
+    num_purchases = models.PositiveIntegerField(default=0, editable=False, help_text="Number of purchases")
+
+    version = models.PositiveIntegerField(default=0, editable=False, help_text="Increased on every change")
+    modified = models.DateTimeField(default=timezone.now, editable=False, help_text="Last change")
+
     def __unicode__(self):
         return " ".join([self.first_name, self.last_name, "<" + self.email + ">"])
 
 
+    def save(self, *args, **kwargs):
+        """
+        Balance and version columns are only written with update_balance(), so saving a customer that was loaded
+        earlier must not overwrite them with stale values.
+        With sharding, new customers are put in a shard at random, whose ShardIds give their id.
+        """
+
+        adding = self._state.adding or kwargs.get('force_insert')
+        if not adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [field.name for field in self._meta.local_fields
+                                       if not field.primary_key and field.name not in self.BALANCE_FIELDS
+                                       and field.name not in self.VERSION_FIELDS]
+
+        if self.pk is None and routers.is_sharded():
+            shard = routers.shard(routers.new_customer_shard())
+        else:
+            shard = routers.customer_shard(self.pk)
+
+        with shard as db, transaction.atomic(using=db):
+            if self.pk is None:
+                self.pk = ShardIds.allocate(Customer, db)[0]
+                if self.pk is not None:
+                    kwargs['force_insert'] = True
+            super(Customer, self).save(*args, **kwargs)
+            if not adding:
+                self.update_balance(self.pk)
+        routers.record_write(self.pk)
+
+
+    @classmethod
+    def lock(cls, *customer_ids):
+        """
+        Lock the rows of the given customers until the end of the current transaction, so changes to the same
+        customer from other processes wait for it while other customers don't.
+        Everything that writes to a customer's balance takes its lock first, in pk order, so two processes
+        can't deadlock waiting for each other.
+        Backends without SELECT ... FOR UPDATE (SQLite) lock the whole database on the first write, so
+        we take that lock right away with an UPDATE that doesn't change anything.
+        The customers are also pinned to the default database for a while, so their reads don't go to a replica
+        that hasn't seen the change yet.
+        With sharding they must be in the shard we are running in.
+        """
+
+        customer_ids = sorted(set(customer_ids) - set([None]))
+        if not customer_ids:
+            return
+
+        routers.record_write(*customer_ids)
+
+        db = router.db_for_write(cls)
+        customers = cls.objects.using(db).filter(pk__in=customer_ids)
+        if connections[db].features.has_select_for_update:
+            list(customers.select_for_update().order_by('pk').values_list('pk', flat=True))
+        else:
+            customers.update(version=F('version'))
+
+
+    @classmethod
+    def new_version(cls):
+        """
+        Changes that bump the version of a customer, for UPDATE queries.
+        """
+
+        return {'version': F('version') + 1, 'modified': timezone.now()}
+
+
+    @classmethod
+    def update_balance(cls, customer_id, **deltas):
+        """
+        Add the given deltas to the balance columns of a customer and bump its version with a single UPDATE.
+        """
+
+        changes = dict((field, F(field) + delta) for field, delta in deltas.items() if delta)
+        changes.update(cls.new_version())
+        cls.objects.filter(pk=customer_id).update(**changes)
+
+
+    @classmethod
+    def rebuild_balances(cls, first_id=None, last_id=None, using=DEFAULT_DB_ALIAS):
+        """
+        Recalculate the balance columns from the stamps, vouchers and sales tables with a single UPDATE,
+        bumping the versions.
+        We can limit the rebuild to a range of customer ids. With sharding it has to be run on every shard.
+        Returns the number of customers updated.
+        """
+
+        qn = connections[using].ops.quote_name
+        customer_table = qn(cls._meta.db_table)
+        customer_pk = customer_table + "." + qn(cls._meta.pk.column)
+
+        def count(model, owner, extra=""):
+            return "(SELECT COUNT(*) FROM {table} WHERE {table}.{owner} = {customer_pk}{extra})".format(
+                table=qn(model._meta.db_table), owner=qn(model._meta.get_field(owner).column),
+                customer_pk=customer_pk, extra=extra)
+
+        def is_null(model, field):
+            return " AND {0}.{1} IS NULL".format(qn(model._meta.db_table), qn(model._meta.get_field(field).column))
+
+        balances = (
+            ('available_stamps', count(Stamp, 'owned_by', is_null(Stamp, 'grouped_in'))),
+            ('total_stamps', count(Stamp, 'owned_by')),
+            ('available_vouchers', count(Voucher, 'owned_by', is_null(Voucher, 'redeemed_with'))),
+            ('total_vouchers', count(Voucher, 'owned_by')),
+            ('num_purchases', count(Sale, 'customer')),
+        )
+
+        sql = "UPDATE {0} SET {1}, {2} = {2} + 1, {3} = %s".format(
+            customer_table, ", ".join(qn(field) + " = " + value for field, value in balances),
+            qn('version'), qn('modified'))
+
+        where = []
+        params = [timezone.now()]
+        if first_id is not None:
+            where.append(customer_pk + " >= %s")
+            params.append(first_id)
+        if last_id is not None:
+            where.append(customer_pk + " <= %s")
+            params.append(last_id)
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+
+        cursor = connections[using].cursor()
+        cursor.execute(sql, params)
+        return cursor.rowcount
+
+
+
+class ShardIds(object):
+    """
+    Ids of the new customers, sales, stamps and vouchers. Each shard gives the ids that leave its index as the
+    remainder of dividing them by the number of shards, so they are unique across shards and shard_for() tells the
+    shard of any of them. Every shard allocates its own, without asking another database.
+    PostgreSQL sequences step over the ids of the other shards themselves, once step_sequences() has set them up
+    after syncdb, so rows are inserted as usual. SQLite has no sequences, so we take the next ones after the
+    largest id of the table, which is safe because it locks the whole database while a transaction writes.
+    """
+
+    @classmethod
+    def _step(cls, db):
+        shards = routers.shards()
+        return len(shards), shards.index(db)
+
+
+    @classmethod
+    def next_ids(cls, model, db, count):
+        """
+        The next count ids of the model in the shard db.
+        """
+
+        if not count:
+            return []
+
+        qn = connections[db].ops.quote_name
+        table, pk = model._meta.db_table, model._meta.pk.column
+        cursor = connections[db].cursor()
 
-class Sale(models.Model):
+        if connections[db].vendor == 'postgresql':
+            cursor.execute("SELECT nextval(pg_get_serial_sequence(%s, %s)) FROM generate_series(1, %s)",
+                           [table, pk, count])
+            return [row[0] for row in cursor.fetchall()]
+
+        step, index = cls._step(db)
+        cursor.execute("SELECT MAX({0}) FROM {1}".format(qn(pk), qn(table)))
+        first = ((cursor.fetchone()[0] or 0) // step + 1) * step + index
+        return range(first, first + count * step, step)
+
+
+    @classmethod
+    def allocate(cls, model, db, count=1):
+        """
+        Ids for count new rows of the model in the shard db, or Nones when the database gives them: without
+        sharding or with stepped sequences.
+        """
+
+        if not routers.is_sharded() or connections[db].vendor == 'postgresql':
+            return [None] * count
+        return cls.next_ids(model, db, count)
+
+
+    @classmethod
+    def step_sequences(cls, db):
+        """
+        Make the PostgreSQL sequences of the shard db give only its ids, starting after the largest one.
+        """
+
+        if connections[db].vendor != 'postgresql':
+            return
+
+        step, index = cls._step(db)
+        cursor = connections[db].cursor()
+        for model in (Customer, Sale, Stamp, Voucher):
+            table, pk = model._meta.db_table, model._meta.pk.column
+            cursor.execute("SELECT pg_get_serial_sequence(%s, %s), (SELECT MAX({0}) FROM {1})".format(
+                connections[db].ops.quote_name(pk), connections[db].ops.quote_name(table)), [table, pk])
+            sequence, last = cursor.fetchone()
+            cursor.execute("ALTER SEQUENCE {0} INCREMENT BY %s RESTART WITH %s".format(sequence),
+                           [step, ((last or 0) // step + 1) * step + index])
+
+
+
+class BalanceMixin(object):
+    """
+    Keeps the balance columns of the Customer that owns a row in sync when the row is saved or deleted.
+    Models using it must implement balance(), returning the owner's id and what the row adds to its balance.
+    Bulk operations (queryset update and delete, bulk_create) bypass it and must update the balance themselves.
+    Rows are saved and deleted in the shard of their owner, they can't be moved to a customer of another shard.
+    New rows get their id from the ShardIds of the shard.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(BalanceMixin, self).__init__(*args, **kwargs)
+        # Rows loaded from the DB are only flagged as such after __init__, so we check it when saving
+        self._saved_balance = self.balance()
+
+
+    def balance(self):
+        raise NotImplementedError
+
+
+    def _apply_balance(self, new_balance):
+        # Take out what the row added when it was loaded or last saved and add what it adds now
+        deltas = {}
+        for balance, sign in ((self._saved_balance, -1), (new_balance, 1)):
+            if balance is not None:
+                customer_id, counters = balance
+                customer_deltas = deltas.setdefault(customer_id, {})
+                for field, value in counters.items():
+                    customer_deltas[field] = customer_deltas.get(field, 0) + sign * value
+
+        for customer_id, counters in deltas.items():
+            Customer.update_balance(customer_id, **counters)
+
+        self._saved_balance = new_balance
+
+
+    def _lock_owners(self, *balances):
+        Customer.lock(*[balance[0] for balance in balances if balance is not None])
+
+
+    def save(self, *args, **kwargs):
+        if self._state.adding:
+            self._saved_balance = None
+
+        with routers.customer_shard(self.balance()[0]) as db, transaction.atomic(using=db):
+            self._lock_owners(self._saved_balance, self.balance())
+            if self._state.adding and self.pk is None:
+                self.pk = ShardIds.allocate(type(self), db)[0]
+                if self.pk is not None:
+                    kwargs['force_insert'] = True
+            super(BalanceMixin, self).save(*args, **kwargs)
+            self._apply_balance(self.balance())
+
+
+    def delete(self, *args, **kwargs):
+        with routers.customer_shard(self.balance()[0]) as db, transaction.atomic(using=db):
+            self._lock_owners(self._saved_balance)
+            super(BalanceMixin, self).delete(*args, **kwargs)
+            self._apply_balance(None)
+
+
+
+class Sale(BalanceMixin, models.Model):
     """
     Purchase model:
         customer -> Who made the purchase
@@ -30,10 +329,79 @@ class Sale(models.Model):
     customer = models.ForeignKey(Customer, help_text="Sold to")
     date = models.DateTimeField(default=timezone.now, verbose_name='Date of sale', help_text="Date of sale")
 
+    class Meta:
+        # Latest purchases of a customer
+        index_together = [('customer', 'date')]
+
     def __unicode__(self):
         return " ".join([str(self.pk), "-", self.customer.email])
 
 
+    def balance(self):
+        return (self.customer_id, {'num_purchases': 1})
+
+
+    @classmethod
+    def checkout(cls, customer_id, serial_nums, date=None):
+        """
+        Sell the products with the given serial numbers to a customer in a single sale.
+        Products are marked as sold with one UPDATE, the stamps for the widgets are created with one INSERT
+        and they are converted into vouchers once for the whole sale, so the number of queries doesn't
+        depend on the number of products. The customer's balance is updated once for the sale and the stamps.
+        With sharding, the products are moved from the catalog to the customer's shard.
+        Raises ValidationError if a product doesn't exist or has already been sold or redeemed.
+        """
+
+        serial_nums = set(serial_nums)
+        if not serial_nums:
+            raise ValidationError("No products to sell")
+
+        with routers.customer_shard(customer_id) as db, Product.catalog_transaction(db), transaction.atomic(using=db):
+            Customer.lock(customer_id)
+            products = Product.find(db, ('pk', 'kind', 'sale', 'serial_num', 'voucher'), serial_num__in=serial_nums)
+
+            missing = serial_nums - set(product[3] for product in products)
+            if missing:
+                raise ValidationError("Unknown products: " + ", ".join(sorted(missing)))
+
+            # Products given away for a voucher count as sold
+            sold = [product[3] for product in products if product[2] is not None or product[4] is not None]
+            if sold:
+                raise ValidationError("Products already sold: " + ", ".join(sorted(sold)))
+
+            sale = cls(customer_id=customer_id)
+            if date:
+                sale.date = date
+            # The customer is locked already and its balance is updated at the end
+            sale.pk = ShardIds.allocate(cls, db)[0]
+            models.Model.save(sale, force_insert=True)
+
+            # Someone else could have sold any of them since we checked
+            product_ids = [product[0] for product in products]
+            if db == DEFAULT_DB_ALIAS:
+                sold_now = Product.objects.filter(pk__in=product_ids, sale__isnull=True,
+                                                  voucher__isnull=True).update(sale=sale)
+            else:
+                sold_now = Product.move_from_catalog(product_ids, db, sale_id=sale.pk)
+            if sold_now != len(product_ids):
+                raise ValidationError("Products already sold")
+
+            # Widgets that don't have a stamp yet get one
+            widgets = [product[0] for product in products if product[1] == Product.WIDGET]
+            stamped = set(Stamp.objects.filter(obtained_with__in=widgets).values_list('obtained_with', flat=True))
+            unstamped = [product_id for product_id in widgets if product_id not in stamped]
+            stamps = [Stamp(id=stamp_id, owned_by_id=customer_id, obtained_with_id=product_id)
+                      for stamp_id, product_id in zip(ShardIds.allocate(Stamp, db, len(unstamped)), unstamped)]
+
+            Stamp.objects.bulk_create(stamps)
+            Customer.update_balance(customer_id, num_purchases=1, available_stamps=len(stamps),
+                                    total_stamps=len(stamps))
+            if stamps:
+                Stamp.schedule_grouping(customer_id)
+
+        return sale
+
+
 
 class Product(models.Model):
     """
@@ -56,29 +424,105 @@ class Product(models.Model):
     serial_num = models.CharField(unique=True, max_length=20, verbose_name='serial number', help_text="serial number")
     sale = models.ForeignKey(Sale, blank=True, null=True, help_text="Sold on this sale order")
 
+    def __init__(self, *args, **kwargs):
+        super(Product, self).__init__(*args, **kwargs)
+        # Sale when loaded or last saved, whose customer must also know when the product changes
+        self._saved_sale_id = self.sale_id
+
+
     def __unicode__(self):
         return " ".join([self.PRODUCT_CHOICES[self.kind][1], "[", str(self.pk), "]"])
 
 
+    @classmethod
+    def find(cls, db, fields, **filters):
+        """
+        The given fields of the products matching the filters in the shard db and, if it's another one, in the
+        catalog of products not sold yet in the default database.
+        """
+
+        products = list(cls.objects.using(db).filter(**filters).values_list(*fields))
+        if db != DEFAULT_DB_ALIAS:
+            products += list(cls.objects.using(DEFAULT_DB_ALIAS).filter(**filters).values_list(*fields))
+        return products
+
+
+    @classmethod
+    @contextmanager
+    def catalog_transaction(cls, db):
+        """
+        Transaction of the catalog around one of the shard db, for move_from_catalog(). Nothing when db is the
+        default database itself.
+        """
+
+        if db == DEFAULT_DB_ALIAS:
+            yield
+        else:
+            with transaction.atomic(using=DEFAULT_DB_ALIAS):
+                yield
+
+
+    @classmethod
+    def move_from_catalog(cls, product_ids, db, **changes):
+        """
+        Move products not sold yet from the catalog in the default database to the shard db, with the given
+        changes, when they are sold to one of its customers.
+        It must be called inside a transaction of the shard, inside catalog_transaction(), so the products are
+        copied to the shard first and only deleted from the catalog after the shard commits. If anything fails
+        before that, both roll back and the products stay in the catalog. They are locked in the catalog
+        meanwhile, so nobody else can take them.
+        Returns the number of products moved, nothing is moved unless all of them are still in the catalog.
+        """
+
+        catalog = cls.objects.using(DEFAULT_DB_ALIAS).filter(pk__in=product_ids, sale__isnull=True,
+                                                             voucher__isnull=True)
+        if catalog.update(serial_num=F('serial_num')) != len(product_ids):
+            return 0
+
+        products = list(catalog)
+        for product in products:
+            for field, value in changes.items():
+                setattr(product, field, value)
+        cls.objects.using(db).bulk_create(products)
+        cls.objects.using(DEFAULT_DB_ALIAS).filter(pk__in=product_ids)._raw_delete(DEFAULT_DB_ALIAS)
+
+        return len(products)
+
+
     def save(self, *args, **kwargs):
         """
         Whether we create a new product or modify an existing one, if it's sold, we have to make sure that there's a stamp for it.
+        Saving the stamp updates the customer's balance.
+        Products are shown in the purchases of the customers, so the versions of the customers who bought it
+        are bumped.
+        With sharding the product stays where it is, products are only moved to a shard by Sale.checkout() and
+        Voucher.redeem().
         """
 
-        # Call the "real" save() method.
-        super(Product, self).save(*args, **kwargs)
+        sale_ids = set([self._saved_sale_id, self.sale_id]) - set([None])
 
-        # If sold and is a Widget
-        if self.sale and self.kind == self.WIDGET:
-            # But has not stamp
-            try:
-                self.stamp
-            except:
-                s = Stamp(owned_by=self.sale.customer, obtained_with=self)
-                s.save()
+        with routers.shard(router.db_for_write(Product, instance=self)) as db, transaction.atomic(using=db):
+            if sale_ids:
+                Customer.lock(*Sale.objects.filter(pk__in=sale_ids).values_list('customer', flat=True))
+
+            # Call the "real" save() method.
+            super(Product, self).save(*args, **kwargs)
+
+            if sale_ids:
+                Customer.objects.filter(sale__in=sale_ids).update(**Customer.new_version())
+            self._saved_sale_id = self.sale_id
+
+            # If sold and is a Widget
+            if self.sale and self.kind == self.WIDGET:
+                # But has not stamp
+                try:
+                    self.stamp
+                except:
+                    s = Stamp(owned_by=self.sale.customer, obtained_with=self)
+                    s.save()
 
 
-class Voucher(models.Model):
+class Voucher(BalanceMixin, models.Model):
     """
     Voucher model:
         owned_by      -> The customer who owns this voucher
@@ -87,21 +531,89 @@ class Voucher(models.Model):
     """
 
     owned_by = models.ForeignKey(Customer, help_text="Customer who owns it")
-    date = models.DateTimeField(auto_now_add=True, verbose_name='creation date', help_text="Creation date")
+    date = models.DateTimeField(default=timezone.now, editable=False, verbose_name='creation date',
+                                help_text="Creation date")
     redeemed_with = models.OneToOneField(Product, blank=True, null=True, verbose_name='product acquired redeeming this voucher', help_text="Product acquired redeeming this voucher")
 
+    class Meta:
+        # Latest vouchers of a customer
+        index_together = [('owned_by', 'date')]
+
     def __unicode__(self):
         status = "Redeemed" if self.redeemed_with else "Available"
         return " ".join(["[",str(self.pk),"]", self.owned_by.email, "-", status])
 
 
+    def balance(self):
+        return (self.owned_by_id, {'total_vouchers': 1,
+                                   'available_vouchers': 0 if self.redeemed_with_id else 1})
+
+
+    @classmethod
+    def redeem(cls, customer_id, serial_num):
+        """
+        Redeem the oldest available voucher of a customer for the product with the given serial number.
+        It takes the same number of queries no matter how many vouchers the customer has: the voucher is found
+        with the loyal_voucher_available index, locked with SKIP LOCKED where the backend has it, and
+        updated together with the balance without loading any other row.
+        With sharding, the product is moved from the catalog to the customer's shard.
+        Raises ValidationError if the product doesn't exist, is already sold or redeemed, or if the customer has
+        no vouchers available.
+        Returns the redeemed voucher.
+        """
+
+        with routers.customer_shard(customer_id) as db, Product.catalog_transaction(db), transaction.atomic(using=db):
+            Customer.lock(customer_id)
+
+            product = Product.find(db, ('pk', 'sale', 'voucher'), serial_num=serial_num)
+            if not product:
+                raise ValidationError("Unknown product: " + serial_num)
+            product_id, sale_id, voucher_id = product[0]
+            if sale_id is not None or voucher_id is not None:
+                raise ValidationError("Product already sold: " + serial_num)
+
+            oldest = (cls.objects.filter(owned_by=customer_id, redeemed_with__isnull=True)
+                                 .order_by('date', 'pk').values_list('pk', 'date')[:1])
+            sql, params = oldest.query.sql_with_params()
+            shard_connection = connections[db]
+            if shard_connection.vendor == 'postgresql' and shard_connection.pg_version >= 90500:
+                # Vouchers being redeemed by someone not holding the customer's lock are left for them
+                sql += " FOR UPDATE SKIP LOCKED"
+
+            cursor = shard_connection.cursor()
+            cursor.execute(sql, params)
+            row = cursor.fetchone()
+            if row is None:
+                raise ValidationError("No vouchers available")
+
+            if db != DEFAULT_DB_ALIAS and not Product.move_from_catalog([product_id], db):
+                raise ValidationError("Product already sold: " + serial_num)
+
+            try:
+                with transaction.atomic():
+                    redeemed = cls.objects.filter(pk=row[0], redeemed_with__isnull=True).update(
+                        redeemed_with=product_id)
+            except IntegrityError:
+                # Someone redeemed another voucher for the same product since we checked
+                raise ValidationError("Product already sold: " + serial_num)
+            if not redeemed:
+                raise ValidationError("Voucher already redeemed")
+
+            Customer.update_balance(customer_id, available_vouchers=-1)
+
+        voucher = cls(pk=row[0], owned_by_id=customer_id, date=row[1], redeemed_with_id=product_id)
+        voucher._state.adding = False
+        return voucher
+
+
 
-class Stamp(models.Model):
+class Stamp(BalanceMixin, models.Model):
     """
     Stamp model:
         owned_by      -> The customer who owns this stamp
         obtained_with -> Which product produced this stamp
         grouped_in    -> In which voucher has been grouped this stamp
+        date          -> When it was created
 
     We allow the creation of stamps with no product attached to, in case it's a gift or similar case.
     """
@@ -114,36 +626,358 @@ class Stamp(models.Model):
                                          help_text="Product which purchase generated this stamp")
     grouped_in = models.ForeignKey(Voucher, blank=True, null=True,
                                    verbose_name='grouped in voucher', help_text="grouped in voucher")
+    date = models.DateTimeField(default=timezone.now, verbose_name='creation date', help_text="Creation date")
+
+    class Meta:
+        # Latest stamps of a customer
+        index_together = [('owned_by', 'date')]
 
     def __unicode__(self):
         return " ".join(["[", str(self.pk), "]", self.owned_by.email])
 
 
+    def balance(self):
+        return (self.owned_by_id, {'total_stamps': 1,
+                                   'available_stamps': 0 if self.grouped_in_id else 1})
+
+
     def save(self, *args, **kwargs):
         """
         For every 10 stamps created we have to convert them into 1 voucher.
-        So for every stamp we create we check if we have 10 and create the voucher and assign it to the customer.
+        Instead of counting the customer's stamps every time we use the running count of the ungrouped ones
+        in Customer.available_stamps, so a new stamp costs the same no matter how many stamps the customer has.
+        With LOYAL_DEFERRED_VOUCHERS the conversion is left to the run_loyalty_worker command.
         """
 
         is_new_stamp = not self.pk
 
-        # Call the "real" save() method.
-        super(Stamp, self).save(*args, **kwargs)
+        with routers.customer_shard(self.owned_by_id) as db, transaction.atomic(using=db):
+            # Call the "real" save() method, it also updates the customer's balance
+            super(Stamp, self).save(*args, **kwargs)
+
+            # Only new stamps that have not been grouped yet count towards a voucher
+            if is_new_stamp and not self.grouped_in_id:
+                self.schedule_grouping(self.owned_by_id)
+
+
+    @classmethod
+    def schedule_grouping(cls, customer_id):
+        """
+        Convert the available stamps of a customer into vouchers now, or with LOYAL_DEFERRED_VOUCHERS enqueue a
+        RegroupJob to do it later, so adding stamps doesn't wait for it.
+        Must be called inside a transaction.
+        """
+
+        if getattr(settings, 'LOYAL_DEFERRED_VOUCHERS', False):
+            RegroupJob.enqueue(customer_id)
+        else:
+            cls.group_into_vouchers(customer_id)
+
+
+    @classmethod
+    def group_into_vouchers(cls, customer_id):
+        """
+        Convert the available stamps of a customer into vouchers, STAMPS_PER_VOUCHER stamps at a time, oldest first.
+        It relies on Customer.available_stamps being up to date and must be called inside a transaction that has
+        locked the customer, so concurrent requests for the same customer can't group the same stamps twice or
+        leave a voucher with less stamps.
+        The vouchers are created with one INSERT and the stamps grouped in them with one UPDATE, so the number of
+        queries doesn't depend on the number of vouchers.
+        Returns the number of vouchers created.
+        """
+
+        per_voucher = cls.STAMPS_PER_VOUCHER
+        available = Customer.objects.values_list('available_stamps', flat=True).get(pk=customer_id)
+        if available < per_voucher:
+            return 0
+
+        # Get the oldest stamps that have not already been converted to vouchers
+        to_voucher = list(cls.objects.filter(owned_by=customer_id, grouped_in__isnull=True)
+                                     .order_by('pk').values_list('pk', flat=True)[:available - available % per_voucher])
+
+        # The counter is out of sync with the stamps, so we fix it and group the ones we have
+        if len(to_voucher) < available - available % per_voucher:
+            Customer.objects.filter(pk=customer_id).update(available_stamps=len(to_voucher))
+            to_voucher = to_voucher[:len(to_voucher) - len(to_voucher) % per_voucher]
+            if not to_voucher:
+                return 0
+
+        db = router.db_for_write(Voucher)
+        voucher_ids = ShardIds.next_ids(Voucher, db, len(to_voucher) // per_voucher)
+        Voucher.objects.bulk_create([Voucher(id=voucher_id, owned_by_id=customer_id) for voucher_id in voucher_ids])
+
+        # Each voucher takes the stamps up to its last one
+        qn = connections[db].ops.quote_name
+        pk, grouped_in = qn(cls._meta.pk.column), qn(cls._meta.get_field('grouped_in').column)
+        params = []
+        for number, voucher_id in enumerate(voucher_ids, 1):
+            params.extend([to_voucher[number * per_voucher - 1], voucher_id])
+        params.extend([customer_id, to_voucher[-1]])
+        connections[db].cursor().execute(
+            "UPDATE {stamp} SET {grouped_in} = CASE {whens} END "
+            "WHERE {owned_by} = %s AND {grouped_in} IS NULL AND {pk} <= %s".format(
+                stamp=qn(cls._meta.db_table), grouped_in=grouped_in, pk=pk,
+                owned_by=qn(cls._meta.get_field('owned_by').column),
+                whens=" ".join(["WHEN {0} <= %s THEN %s".format(pk)] * len(voucher_ids))),
+            params)
+
+        Customer.update_balance(customer_id, available_stamps=-len(to_voucher), available_vouchers=len(voucher_ids),
+                                total_vouchers=len(voucher_ids))
+        return len(voucher_ids)
+
+
+    @classmethod
+    def create_missing_stamps(cls):
+        """
+        Give a stamp, dated as the sale, for every widget sold that doesn't have one, with a single INSERT.
+        This is what Product.save() does for one product, for tables loaded in bulk.
+        Returns the number of stamps created.
+        """
+
+        qn = connection.ops.quote_name
+        sql = """
+            INSERT INTO {stamp} ({owned_by}, {obtained_with}, {grouped_in}, {stamp_date})
+            SELECT {sale}.{customer}, {product}.{product_pk}, NULL, {sale}.{sale_date}
+            FROM {product} INNER JOIN {sale} ON {sale}.{sale_pk} = {product}.{product_sale}
+            WHERE {product}.{kind} = %s
+              AND NOT EXISTS (SELECT 1 FROM {stamp} WHERE {stamp}.{obtained_with} = {product}.{product_pk})
+            ORDER BY {product}.{product_pk}
+        """.format(
+            stamp=qn(cls._meta.db_table), owned_by=qn(cls._meta.get_field('owned_by').column),
+            obtained_with=qn(cls._meta.get_field('obtained_with').column),
+            grouped_in=qn(cls._meta.get_field('grouped_in').column), stamp_date=qn(cls._meta.get_field('date').column),
+            sale=qn(Sale._meta.db_table), sale_pk=qn(Sale._meta.pk.column),
+            customer=qn(Sale._meta.get_field('customer').column), sale_date=qn(Sale._meta.get_field('date').column),
+            product=qn(Product._meta.db_table), product_pk=qn(Product._meta.pk.column),
+            product_sale=qn(Product._meta.get_field('sale').column), kind=qn(Product._meta.get_field('kind').column))
+
+        cursor = connection.cursor()
+        cursor.execute(sql, [Product.WIDGET])
+        return cursor.rowcount
+
+
+    @classmethod
+    def group_all_into_vouchers(cls):
+        """
+        Group the available stamps of every customer into vouchers, STAMPS_PER_VOUCHER stamps at a time,
+        oldest first, like group_into_vouchers() does for one customer but with a handful of queries.
+        Voucher ids are calculated with window functions over the ungrouped stamps into a temporary table,
+        from which we insert the vouchers and update the stamps. It's dropped at the end, or at the start
+        of the next call if a query failed.
+        It's meant for bulk loads, nobody else should be writing stamps or vouchers meanwhile.
+        Customer balances must be rebuilt afterwards.
+        Returns the number of vouchers created.
+        """
+
+        qn = connection.ops.quote_name
+        names = dict(
+            stamp=qn(cls._meta.db_table), stamp_pk=qn(cls._meta.pk.column),
+            owned_by=qn(cls._meta.get_field('owned_by').column),
+            grouped_in=qn(cls._meta.get_field('grouped_in').column), date=qn(cls._meta.get_field('date').column),
+            voucher=qn(Voucher._meta.db_table), voucher_pk=qn(Voucher._meta.pk.column),
+            voucher_owned_by=qn(Voucher._meta.get_field('owned_by').column),
+            redeemed_with=qn(Voucher._meta.get_field('redeemed_with').column),
+            voucher_date=qn(Voucher._meta.get_field('date').column),
+            grouping=qn('loyal_stamp_grouping'), per_voucher=cls.STAMPS_PER_VOUCHER)
+
+        first_voucher = (Voucher.objects.aggregate(last=models.Max('pk'))['last'] or 0) + 1
+
+        cursor = connection.cursor()
+        cursor.execute("DROP TABLE IF EXISTS {grouping}".format(**names))
+        cursor.execute("""
+            CREATE TEMPORARY TABLE {grouping} AS
+            WITH ungrouped AS (
+                SELECT {stamp_pk}, {owned_by}, {date},
+                       ROW_NUMBER() OVER (PARTITION BY {owned_by} ORDER BY {stamp_pk}) AS position
+                FROM {stamp} WHERE {grouped_in} IS NULL
+            ), owners AS (
+                SELECT {owned_by}, COUNT(*) / {per_voucher} AS num_vouchers
+                FROM {stamp} WHERE {grouped_in} IS NULL
+                GROUP BY {owned_by} HAVING COUNT(*) >= {per_voucher}
+            ), offsets AS (
+                SELECT {owned_by}, num_vouchers, SUM(num_vouchers) OVER (ORDER BY {owned_by}) - num_vouchers AS skip
+                FROM owners
+            )
+            SELECT ungrouped.{stamp_pk} AS stamp_id, ungrouped.{owned_by} AS owned_by_id, ungrouped.{date} AS date,
+                   CAST(%s + offsets.skip + (ungrouped.position - 1) / {per_voucher} AS INTEGER) AS voucher_id
+            FROM ungrouped INNER JOIN offsets ON offsets.{owned_by} = ungrouped.{owned_by}
+            WHERE ungrouped.position <= offsets.num_vouchers * {per_voucher}
+        """.format(**names), [first_voucher])
+
+        cursor.execute("CREATE INDEX {0} ON {1} (stamp_id)".format(qn('loyal_stamp_grouping_stamp'),
+                                                                  names['grouping']))
+
+        # Every voucher gets the date of its newest stamp
+        cursor.execute("""
+            INSERT INTO {voucher} ({voucher_pk}, {voucher_owned_by}, {redeemed_with}, {voucher_date})
+            SELECT voucher_id, owned_by_id, NULL, MAX(date) FROM {grouping}
+            GROUP BY voucher_id, owned_by_id ORDER BY voucher_id
+        """.format(**names))
+        created = cursor.rowcount
+
+        cursor.execute("""
+            UPDATE {stamp} SET {grouped_in} = (
+                SELECT voucher_id FROM {grouping} WHERE {grouping}.stamp_id = {stamp}.{stamp_pk})
+            WHERE {stamp_pk} IN (SELECT stamp_id FROM {grouping})
+        """.format(**names))
+        cursor.execute("DROP TABLE {grouping}".format(**names))
+
+        # We have set the voucher ids ourselves, so the DB sequence must catch up
+        for sql in connection.ops.sequence_reset_sql(no_style(), [Voucher]):
+            cursor.execute(sql)
+
+        return created
+
+
+
+class IdempotencyKey(models.Model):
+    """
+    Response given to a POST sent with an Idempotency-Key header, so retries of the same request get it again
+    instead of running it twice:
+        key         -> The Idempotency-Key sent by the client
+        path        -> Where the request was sent
+        body_hash   -> SHA-256 of the data of the request, retries must send the same
+        status_code -> Status of the response
+        response    -> JSON with the data and headers of the response
+        created     -> When the request was first received, keys expire LOYAL_IDEMPOTENCY_TTL seconds after it
+    """
+
+    key = models.CharField(max_length=255, unique=True, help_text="Idempotency-Key header")
+    path = models.CharField(max_length=255, help_text="Request path")
+    body_hash = models.CharField(max_length=64, blank=True, help_text="SHA-256 of the request data")
+    status_code = models.PositiveSmallIntegerField(null=True, help_text="Response status")
+    response = models.TextField(blank=True, help_text="Response data and headers")
+    created = models.DateTimeField(default=timezone.now, db_index=True, help_text="First received")
+
+    def __unicode__(self):
+        return " ".join([self.key, self.path])
+
+
+    @classmethod
+    def expired_before(cls):
+        return timezone.now() - timedelta(seconds=getattr(settings, 'LOYAL_IDEMPOTENCY_TTL', 24 * 60 * 60))
+
+
+    @classmethod
+    def claim(cls, key, path, body_hash=''):
+        """
+        Store a new key, or get the stored one if it hasn't expired. Must be called inside a transaction.
+        While the transaction that stored a key is running, the same key can't be stored again, so concurrent
+        requests with it wait here until the first one has finished and then get its response.
+        Returns the key and whether it was stored now.
+        """
+
+        cls.objects.filter(key=key, created__lt=cls.expired_before()).delete()
+
+        try:
+            with transaction.atomic(using=router.db_for_write(cls)):
+                return cls.objects.create(key=key, path=path, body_hash=body_hash), True
+        except IntegrityError:
+            return cls.objects.get(key=key), False
+
+
+    @classmethod
+    def purge_expired(cls, batch_size):
+        """
+        Delete up to batch_size expired keys, oldest first, so the table can be purged in short transactions.
+        Returns the number of keys deleted.
+        """
+
+        expired = list(cls.objects.filter(created__lt=cls.expired_before())
+                                  .order_by('created').values_list('pk', flat=True)[:batch_size])
+        if expired:
+            cls.objects.filter(pk__in=expired).delete()
+        return len(expired)
+
+
+
+class RegroupJob(models.Model):
+    """
+    Pending conversion of a customer's stamps into vouchers, when they are deferred with LOYAL_DEFERRED_VOUCHERS.
+    There's at most one job per customer, however many stamps are added before the worker gets to it:
+        customer  -> Whose stamps have to be grouped
+        enqueued  -> When was the job first enqueued
+        attempts  -> Times it has failed
+        run_after -> When it can be run, later after every failure
+    """
+
+    # Seconds a failed job waits the first time, doubled after every failure up to RETRY_MAX_DELAY
+    RETRY_DELAY = 10
+    RETRY_MAX_DELAY = 60 * 60
+
+    customer = models.OneToOneField(Customer, help_text="Customer whose stamps have to be grouped")
+    enqueued = models.DateTimeField(default=timezone.now, db_index=True, help_text="First enqueued")
+    attempts = models.PositiveIntegerField(default=0, help_text="Times it has failed")
+    run_after = models.DateTimeField(default=timezone.now, db_index=True, help_text="Not run before")
+
+    def __unicode__(self):
+        return " ".join([str(self.customer_id), "-", str(self.enqueued)])
+
+
+    @classmethod
+    def enqueue(cls, customer_id):
+        """
+        Add a job for the customer, unless there's one already. Must be called inside a transaction.
+        """
+
+        if cls.objects.filter(customer=customer_id).exists():
+            return
+
+        try:
+            with transaction.atomic():
+                cls.objects.create(customer_id=customer_id)
+        except IntegrityError:
+            # Someone else enqueued it since we checked
+            pass
+
+
+    @classmethod
+    def retry_delay(cls, attempts):
+        return timedelta(seconds=min(cls.RETRY_DELAY * 2 ** (attempts - 1), cls.RETRY_MAX_DELAY))
+
+
+    @classmethod
+    def run_batch(cls, batch_size):
+        """
+        Group the stamps of the customers of up to batch_size jobs that are due, oldest first, one transaction per
+        customer.
+        Each customer is locked before its job is taken, like when stamps are added, so a stamp added meanwhile
+        either waits and is grouped now or enqueues a new job.
+        A job that fails is logged and left in the queue to be retried after retry_delay(), and the rest go on.
+        With sharding, every shard runs up to batch_size jobs.
+        Returns the number of jobs run, including the failed ones.
+        """
+
+        run = 0
+        for shard in routers.shards():
+            jobs = list(cls.objects.using(shard).filter(run_after__lte=timezone.now()).order_by('run_after')
+                                   .values_list('customer', 'attempts')[:batch_size])
+
+            for customer_id, attempts in jobs:
+                try:
+                    with routers.customer_shard(customer_id) as db, transaction.atomic(using=db):
+                        Customer.lock(customer_id)
+                        cls.objects.filter(customer=customer_id).delete()
+                        Stamp.group_into_vouchers(customer_id)
+                except Exception:
+                    logger.exception("Regroup job of customer %s failed, attempt %s", customer_id, attempts + 1)
+                    with routers.customer_shard(customer_id):
+                        cls.objects.filter(customer=customer_id).update(
+                            attempts=attempts + 1, run_after=timezone.now() + cls.retry_delay(attempts + 1))
+            run += len(jobs)
+
+        return run
+
+
 
-        # Convert to vouchers every 10 stamps
-        if is_new_stamp:
-            # Get all stamps that have not already been converted to vouchers
-            stamps = Stamp.objects.filter(grouped_in__isnull=True, owned_by=self.owned_by)
+@receiver(post_syncdb)
+def step_shard_sequences(sender, db=DEFAULT_DB_ALIAS, **kwargs):
+    if sender.__name__ == __name__ and routers.is_sharded():
+        ShardIds.step_sequences(db)
 
-            for i in xrange(self.STAMPS_PER_VOUCHER-1, stamps.count(), self.STAMPS_PER_VOUCHER):
-                # Create new voucher
-                voucher = Voucher(owned_by=self.owned_by, redeemed_with=None)
-                voucher.save()
 
-                # Get the 10 vouchers
-                to_voucher = stamps[i+1-self.STAMPS_PER_VOUCHER:i+1]
+# Cached customer payloads are invalidated with the signals of these models
+import loyal.cache
 
-                # Now they have been grouped in the new voucher
-                for stamp in to_voucher:
-                    stamp.grouped_in = voucher
-                    stamp.save()
+# Connection counters and health checks are hooked to the request signals
+import loyal.connections
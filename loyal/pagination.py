@@ -0,0 +1,246 @@
+import base64
+import binascii
+import heapq
+from itertools import islice
+import json
+
+from django.core.exceptions import ValidationError
+from django.db import models
+from django.db.models import Q
+from django.http import Http404, StreamingHttpResponse
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.templatetags.rest_framework import replace_query_param
+
+from loyal import routers
+from loyal.renderers import NDJSONRenderer
+
+
+class KeysetPaginationMixin(object):
+    """
+    Paginates a list view following a unique ordering, by primary key unless keyset_ordering says otherwise.
+    Instead of a page number, every page links to the next one with an opaque cursor holding the ordering values
+    of the last object it returned, so getting any page is a "WHERE (ordering) > cursor ORDER BY ordering LIMIT
+    page_size" query that an index on the ordering fields can answer, and we never count the rows.
+        cursor: Position to start from, as given in the next link
+        page_size: Number of results per page
+    With format=ndjson the whole list is streamed instead, one object per line, reading it in chunks with the
+    same queries used for pages.
+    """
+
+    paginate_by = 20
+    paginate_by_param = 'page_size'
+    max_paginate_by = 100
+    cursor_param = 'cursor'
+    export_chunk_size = 1000
+    renderer_classes = tuple(api_settings.DEFAULT_RENDERER_CLASSES) + (NDJSONRenderer,)
+
+    # Must end with the primary key so the ordering is unique
+    keyset_ordering = ('pk',)
+
+
+    def _ordering_fields(self, model):
+        for name in self.keyset_ordering:
+            field_name = name.lstrip('-')
+            field = model._meta.pk if field_name == 'pk' else model._meta.get_field(field_name)
+            yield field_name, name.startswith('-'), field
+
+
+    def cursor_values(self, obj):
+        return [getattr(obj, name.lstrip('-')) for name in self.keyset_ordering]
+
+
+    def encode_cursor(self, obj):
+        values = [value.isoformat() if hasattr(value, 'isoformat') else value for value in self.cursor_values(obj)]
+        return base64.urlsafe_b64encode(json.dumps(values))
+
+
+    def cursor_fields(self, model):
+        return [field for _, _, field in self._ordering_fields(model)]
+
+
+    def decode_cursor(self, model, cursor):
+        try:
+            values = json.loads(base64.urlsafe_b64decode(str(cursor)))
+            fields = self.cursor_fields(model)
+            if not isinstance(values, list) or len(values) != len(fields):
+                raise ValueError
+            return [field.to_python(value) for field, value in zip(fields, values)]
+        except (TypeError, ValueError, binascii.Error, ValidationError):
+            raise Http404("Invalid cursor")
+
+
+    def after_values(self, queryset, values, inclusive=False):
+        """
+        Filter the objects that go after the cursor values in the ordering, and the one with those values when
+        inclusive.
+        For (a, b) that is "a >= x AND (a > x OR (a = x AND b > y))", where the first condition lets the DB
+        use an index starting with a.
+        """
+
+        fields = list(self._ordering_fields(queryset.model))
+
+        after = Q()
+        equal = Q()
+        for position, ((field_name, descending, _), value) in enumerate(zip(fields, values)):
+            lookup = '__lt' if descending else '__gt'
+            if inclusive and position == len(fields) - 1:
+                lookup += 'e'
+            after |= equal & Q(**{field_name + lookup: value})
+            equal &= Q(**{field_name: value})
+
+        if len(fields) > 1:
+            first_name, first_descending, _ = fields[0]
+            queryset = queryset.filter(**{first_name + ('__lte' if first_descending else '__gte'): values[0]})
+
+        return queryset.filter(after)
+
+
+    def fetch(self, queryset):
+        """
+        Read the objects of a page from its sliced queryset.
+        """
+
+        return list(queryset)
+
+
+    def read_page(self, queryset, values, limit):
+        """
+        Return the first limit objects after the given cursor values, or from the start without them.
+        """
+
+        if values is not None:
+            queryset = self.after_values(queryset, values)
+        return self.fetch(queryset.order_by(*self.keyset_ordering)[:limit])
+
+
+    def paginate_keyset(self, queryset):
+        """
+        Return the objects of the requested page and the link to the next page, if there's one.
+        """
+
+        page_size = self.get_paginate_by()
+        cursor = self.request.QUERY_PARAMS.get(self.cursor_param)
+        values = self.decode_cursor(queryset.model, cursor) if cursor else None
+
+        # We get one extra row to know if there's a next page
+        objects = self.read_page(queryset, values, page_size + 1)
+        if len(objects) <= page_size:
+            return objects, None
+
+        objects = objects[:page_size]
+        next_link = replace_query_param(self.request.build_absolute_uri(), self.cursor_param,
+                                        self.encode_cursor(objects[-1]))
+        return objects, next_link
+
+
+    def iter_chunks(self, queryset):
+        """
+        Yield every object of the queryset in chunks of export_chunk_size, each one a query after the last.
+        """
+
+        values = None
+        while True:
+            chunk = self.read_page(queryset, values, self.export_chunk_size)
+            if chunk:
+                yield chunk
+            if len(chunk) < self.export_chunk_size:
+                return
+
+            values = self.cursor_values(chunk[-1])
+
+
+    def stream(self, queryset):
+        """
+        Stream the serialized objects, so memory doesn't grow with the size of the list and the first rows are
+        sent as soon as the first chunk is read.
+        """
+
+        def rows():
+            for chunk in self.iter_chunks(queryset):
+                for row in self.get_serializer(chunk, many=True).data:
+                    yield row
+
+        renderer = self.request.accepted_renderer
+        return StreamingHttpResponse(renderer.render_rows(rows()), content_type=renderer.media_type)
+
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        if isinstance(request.accepted_renderer, NDJSONRenderer):
+            return self.stream(queryset)
+
+        objects, next_link = self.paginate_keyset(queryset)
+        serializer = self.get_serializer(objects, many=True)
+        return Response({'next': next_link, 'results': serializer.data})
+
+
+
+class ShardedKeysetPaginationMixin(KeysetPaginationMixin):
+    """
+    Keyset pagination of a sharded model over all the shards, for ascending orderings only.
+    Every page reads the next objects of each shard and merges them, so the cursor also has the shard of the
+    last object, which breaks the ties between shards.
+    """
+
+    def object_db(self, obj):
+        return obj._state.db
+
+
+    def cursor_values(self, obj):
+        shard = routers.shards().index(self.object_db(obj)) if routers.is_sharded() else 0
+        return super(ShardedKeysetPaginationMixin, self).cursor_values(obj) + [shard]
+
+
+    def cursor_fields(self, model):
+        return super(ShardedKeysetPaginationMixin, self).cursor_fields(model) + [models.IntegerField()]
+
+
+    def read_page(self, queryset, values, limit):
+        if not routers.is_sharded():
+            return super(ShardedKeysetPaginationMixin, self).read_page(queryset, values and values[:-1], limit)
+
+        def shard_objects(index, alias):
+            shard_queryset = queryset.using(alias)
+            if values is not None:
+                # The shards after the one of the cursor can have an object with the same values
+                shard_queryset = self.after_values(shard_queryset, values[:-1], inclusive=index > values[-1])
+            for obj in self.fetch(shard_queryset.order_by(*self.keyset_ordering)[:limit]):
+                yield self.cursor_values(obj), obj
+
+        streams = [shard_objects(index, alias) for index, alias in enumerate(routers.shards())]
+        return [obj for _, obj in islice(heapq.merge(*streams), limit)]
+
+
+
+class ValuesListMixin(object):
+    """
+    Serves the GET requests of a paginated list view with values_serializer_class, reading only its columns
+    with values_list() instead of model instances. Must go before the pagination mixin.
+    Other methods, and the docs, still use the serializer_class.
+    """
+
+    values_serializer_class = None
+
+
+    def use_values(self):
+        request = getattr(self, 'request', None)
+        return request is not None and request.method in ('GET', 'HEAD')
+
+
+    def get_serializer_class(self):
+        if self.use_values():
+            return self.values_serializer_class
+        return super(ValuesListMixin, self).get_serializer_class()
+
+
+    def fetch(self, queryset):
+        if self.use_values():
+            return self.values_serializer_class.fetch(queryset)
+        return super(ValuesListMixin, self).fetch(queryset)
+
+
+    def object_db(self, obj):
+        if self.use_values():
+            return obj.db
+        return super(ValuesListMixin, self).object_db(obj)
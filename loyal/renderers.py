@@ -0,0 +1,26 @@
+import json
+
+from rest_framework import renderers
+from rest_framework.utils import encoders
+
+
+class NDJSONRenderer(renderers.JSONRenderer):
+    """
+    Newline delimited JSON, one object per line.
+    Lists are normally streamed row by row with render_rows, render is only used for other responses like errors.
+    """
+
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+
+
+    def render_rows(self, rows):
+        for row in rows:
+            yield json.dumps(row, cls=self.encoder_class, ensure_ascii=self.ensure_ascii) + '\n'
+
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return bytes()
+
+        return ''.join(self.render_rows(data if isinstance(data, list) else [data]))
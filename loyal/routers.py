@@ -0,0 +1,234 @@
+"""
+Read replicas.
+
+Requests that don't change anything read from one of the LOYAL_REPLICAS, picked at random for each request, as
+set by loyal.middleware.ReplicaMiddleware. Everything else uses the default database: writes, reads of requests
+that write and reads outside of requests, like management commands and the worker, which read what they are about
+to change.
+
+Replicas lag behind the default database, so after a request writes to a customer, the requests for that customer
+read from the default database for LOYAL_REPLICA_STICKY_SECONDS, and so do the detail views of the products, stamps
+and vouchers changed through them. Rows created for a customer, like the stamps of a sale, are only pinned through
+the customer, their detail views can read from a replica that doesn't have them yet. Pins are kept in the
+LOYAL_REPLICA_PIN_CACHE cache, which must be shared by all the processes (file based or memcached) for the pins
+to work across gunicorn workers, check_pin_cache() makes sure of it.
+
+Customers can also be sharded across the LOYAL_SHARDS databases by id. A customer and its sales, stamps, vouchers,
+regroup jobs and sold products live on the same shard, so everything about a customer is read and written in one
+database, while the products not sold yet stay in the default database, which is also the first shard. The
+idempotency keys of a customer's requests are stored in its shard, so they commit with what the requests change.
+New customers are put in a shard at random. Each shard gives the ids of its customers, sales, stamps and vouchers
+interleaved with the other shards (see loyal.models.ShardIds), so they are unique across shards and the remainder of
+dividing one by the number of shards is the index of its shard.
+Model methods and the views of a customer run in its shard with customer_shard(). Reads of sharded models outside
+of one go to the default database, so global lists and detail views go through every shard themselves. When sharding
+is enabled the replicas are only used for the models that aren't sharded.
+"""
+
+from contextlib import contextmanager
+import random
+import threading
+
+from django.conf import settings
+from django.core.cache import get_cache
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DEFAULT_DB_ALIAS
+
+
+_state = threading.local()
+
+
+# Attribute with the id of the customer that owns a row of each sharded model
+SHARD_OWNERS = {
+    'customer': 'pk',
+    'sale': 'customer_id',
+    'stamp': 'owned_by_id',
+    'voucher': 'owned_by_id',
+    'regroupjob': 'customer_id',
+}
+
+# Sold products are on the shard of their customer, the rest of them in the default database. Idempotency keys are
+# on the shard of the request.
+SHARDED_MODELS = tuple(SHARD_OWNERS) + ('product', 'idempotencykey')
+
+
+def start_request(read_db=None):
+    _state.read_db = read_db
+    _state.written = set()
+    _state.shard = None
+
+
+def finish_request():
+    _state.read_db = None
+    _state.written = None
+    _state.shard = None
+
+
+def read_from(alias):
+    _state.read_db = alias
+
+
+def record_write(*customer_ids):
+    """
+    Remember the customers written by the current request, so they can be pinned when it finishes.
+    """
+
+    written = getattr(_state, 'written', None)
+    if written is not None:
+        written.update(customer_id for customer_id in customer_ids if customer_id is not None)
+
+
+def written_customers():
+    return getattr(_state, 'written', None) or set()
+
+
+def _pin_key(namespace, pk):
+    return 'loyal:primary:{0}:{1}'.format(namespace, pk)
+
+
+def check_pin_cache():
+    """
+    Raise ImproperlyConfigured if there are replicas and the pins wouldn't be seen by other processes.
+    """
+
+    if not getattr(settings, 'LOYAL_REPLICAS', None):
+        return
+
+    alias = getattr(settings, 'LOYAL_REPLICA_PIN_CACHE', 'default')
+    if isinstance(get_cache(alias), (LocMemCache, DummyCache)):
+        raise ImproperlyConfigured("LOYAL_REPLICA_PIN_CACHE must be a cache shared by all the processes, "
+                                   "'{0}' is local to each one".format(alias))
+
+
+def pin(namespace, pks):
+    """
+    Send the reads of the views of the namespace for the given pks to the default database for a while.
+    """
+
+    cache = get_cache(getattr(settings, 'LOYAL_REPLICA_PIN_CACHE', 'default'))
+    seconds = getattr(settings, 'LOYAL_REPLICA_STICKY_SECONDS', 10)
+    cache.set_many(dict((_pin_key(namespace, pk), 1) for pk in pks), seconds)
+
+
+def is_pinned(namespace, pk):
+    cache = get_cache(getattr(settings, 'LOYAL_REPLICA_PIN_CACHE', 'default'))
+    return cache.get(_pin_key(namespace, pk)) is not None
+
+
+
+def shards():
+    return getattr(settings, 'LOYAL_SHARDS', None) or [DEFAULT_DB_ALIAS]
+
+
+def is_sharded():
+    return len(shards()) > 1
+
+
+def shard_for(customer_id):
+    all_shards = shards()
+    return all_shards[int(customer_id) % len(all_shards)]
+
+
+def new_customer_shard():
+    return random.choice(shards())
+
+
+def current_shard():
+    return getattr(_state, 'shard', None)
+
+
+def use_shard(alias):
+    """
+    Run the rest of the request in the given shard.
+    """
+
+    _state.shard = alias if is_sharded() else None
+
+
+def use_customer_shard(customer_id):
+    """
+    Run the rest of the request in the shard of the given customer.
+    """
+
+    use_shard(shard_for(customer_id) if is_sharded() else None)
+
+
+@contextmanager
+def shard(alias):
+    """
+    Run the block in the given shard, yielding its alias.
+    """
+
+    previous = current_shard()
+    _state.shard = alias if is_sharded() else None
+    try:
+        yield alias
+    finally:
+        _state.shard = previous
+
+
+def customer_shard(customer_id):
+    """
+    Run the block in the shard of the given customer, yielding its alias. Without sharding that's the default
+    database.
+    """
+
+    if customer_id is None or not is_sharded():
+        return shard(DEFAULT_DB_ALIAS)
+    return shard(shard_for(customer_id))
+
+
+
+class ShardRouter(object):
+    """
+    Sends the queries of sharded models to the shard of the customer they belong to: the one of the row itself or of
+    the related row they come from when we have it, or else the one of the customer_shard() we are running in.
+    Says nothing about unsharded models or when there's only one shard, so ReplicaRouter decides.
+    """
+
+    def _shard(self, model, hints):
+        if not is_sharded() or model._meta.model_name not in SHARDED_MODELS:
+            return None
+
+        instance = hints.get('instance')
+        if instance is not None:
+            if instance._state.db is not None:
+                return instance._state.db
+            owner = SHARD_OWNERS.get(instance._meta.model_name)
+            if owner is not None and getattr(instance, owner) is not None:
+                return shard_for(getattr(instance, owner))
+
+        return current_shard()
+
+
+    def db_for_read(self, model, **hints):
+        return self._shard(model, hints)
+
+
+    def db_for_write(self, model, **hints):
+        return self._shard(model, hints)
+
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return None
+
+
+
+class ReplicaRouter(object):
+    """
+    Sends reads to the replica chosen for the current request, if any, and everything else to the default database.
+    """
+
+    def db_for_read(self, model, **hints):
+        return getattr(_state, 'read_db', None) or DEFAULT_DB_ALIAS
+
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas have the same rows as the default database
+        return True
@@ -3,3 +3,4 @@ from .stamp_serializer import *
 from .voucher_serializer import *
 from .sale_serializer import *
 from .product_serializer import *
+from .values_serializer import *
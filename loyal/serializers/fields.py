@@ -0,0 +1,69 @@
+from django.core.urlresolvers import NoReverseMatch, get_script_prefix, get_urlconf, reverse
+from rest_framework import serializers
+
+
+# Placeholder pk the URL templates are reversed with
+PLACEHOLDER = '8061977130520021'
+
+# Reversed URL of each view around the placeholder, split in the parts before and after it
+_url_templates = {}
+
+
+def url_template(view_name):
+    """
+    The parts of the URL of the view before and after its pk, reversed once per process, or None if it can't be
+    reversed with just a pk.
+    """
+
+    key = (view_name, get_urlconf(), get_script_prefix())
+    if key not in _url_templates:
+        try:
+            parts = reverse(view_name, kwargs={'pk': PLACEHOLDER}).split(PLACEHOLDER)
+        except NoReverseMatch:
+            parts = None
+        _url_templates[key] = tuple(parts) if parts and len(parts) == 2 else None
+    return _url_templates[key]
+
+
+def absolute_url_template(view_name, request):
+    """
+    Same as url_template(), but for absolute URLs with the host of the request.
+    """
+
+    template = url_template(view_name)
+    if template is None:
+        return None
+    return tuple(request.build_absolute_uri(PLACEHOLDER.join(template)).split(PLACEHOLDER))
+
+
+
+class FastHyperlinkedIdentityField(serializers.HyperlinkedIdentityField):
+    """
+    Gives the same URLs as HyperlinkedIdentityField without reversing one for every object.
+    The view is reversed once per process with a placeholder pk, and made absolute with the host of the request once
+    per serializer, so for each object we only put its pk in between.
+    Lookups by something else than an integer pk, formats and serializers without a request are reversed as usual.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(FastHyperlinkedIdentityField, self).__init__(*args, **kwargs)
+        self._absolute_template = None
+
+
+    def absolute_template(self, request):
+        if self._absolute_template is None or self._absolute_template[0] is not request:
+            self._absolute_template = (request, absolute_url_template(self.view_name, request))
+        return self._absolute_template[1]
+
+
+    def field_to_native(self, obj, field_name):
+        request = self.context.get('request')
+        pk = getattr(obj, self.lookup_field, None)
+        if (request is None or self.context.get('format') or self.lookup_field != 'pk'
+                or not isinstance(pk, (int, long))):
+            return super(FastHyperlinkedIdentityField, self).field_to_native(obj, field_name)
+
+        template = self.absolute_template(request)
+        if template is None:
+            return super(FastHyperlinkedIdentityField, self).field_to_native(obj, field_name)
+        return template[0] + str(pk) + template[1]
@@ -1,9 +1,10 @@
 from rest_framework import serializers
+from .fields import FastHyperlinkedIdentityField
 from loyal.models import Product, Customer
 
 class ProductSerializer(serializers.ModelSerializer):
     kind_name = serializers.SerializerMethodField('get_kind_name')
-    to_modify = serializers.HyperlinkedIdentityField(view_name='loyal:product:product-detail')
+    to_modify = FastHyperlinkedIdentityField(view_name='loyal:product:product-detail')
 
     class Meta:
         model = Product
@@ -1,15 +1,17 @@
 from rest_framework import serializers
+from .fields import FastHyperlinkedIdentityField
 from loyal.models import Stamp, Customer
 from django.http import Http404
 from rest_framework.reverse import reverse
 
 
 class StampSerializer(serializers.ModelSerializer):
-    link = serializers.HyperlinkedIdentityField(view_name='loyal:stamp:stamp-detail')
+    date = serializers.DateTimeField(read_only=True)
+    link = FastHyperlinkedIdentityField(view_name='loyal:stamp:stamp-detail')
 
     class Meta:
         model = Stamp
-        fields = ('obtained_with', 'grouped_in', 'link')
+        fields = ('date', 'obtained_with', 'grouped_in', 'link')
 
     def restore_object(self, attrs, instance=None):
         pk = self.context['view'].kwargs['pk']
@@ -23,7 +25,7 @@ class StampSerializer(serializers.ModelSerializer):
 
 
 class StampListSerializer(serializers.ModelSerializer):
-    to_modify = serializers.HyperlinkedIdentityField(view_name='loyal:stamp:stamp-detail')
+    to_modify = FastHyperlinkedIdentityField(view_name='loyal:stamp:stamp-detail')
 
     class Meta:
         model = Stamp
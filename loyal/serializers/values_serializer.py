@@ -0,0 +1,138 @@
+from collections import namedtuple
+
+from django.utils.datastructures import SortedDict
+from rest_framework import serializers
+from rest_framework.reverse import reverse
+from .fields import absolute_url_template
+from loyal.models import Product
+
+
+class ValuesSerializer(object):
+    """
+    Read-only serializer of rows read with values_list(), giving the same data as the ModelSerializer of the
+    list views without creating model instances or going through serializer fields for every value.
+    Rows are namedtuples of the columns, plus the db they were read from. Subclasses build the data of one row
+    in row_to_native(), with the same keys in the same order as the ModelSerializer.
+    """
+
+    columns = ()
+    # View linked by the to_modify field of each row
+    view_name = None
+
+    _row_classes = {}
+    _date_field = serializers.DateTimeField()
+
+
+    def __init__(self, instance=None, data=None, files=None, many=False, partial=False, context=None, **kwargs):
+        self.object = instance
+        self.many = many
+        self.context = context or {}
+        self._data = None
+        self._template = None
+
+
+    @classmethod
+    def row_class(cls, db):
+        key = (cls, db)
+        if key not in cls._row_classes:
+            base = namedtuple(cls.__name__ + 'Row', cls.columns)
+            cls._row_classes[key] = type(base.__name__, (base,), {'__slots__': (), 'db': db})
+        return cls._row_classes[key]
+
+
+    @classmethod
+    def fetch(cls, queryset):
+        """
+        Read the columns of the queryset, which must be sliced or small enough to be read at once.
+        """
+
+        make = cls.row_class(queryset.db)._make
+        return [make(values) for values in queryset.values_list(*cls.columns)]
+
+
+    def format_date(self, value):
+        return self._date_field.to_native(value)
+
+
+    def link(self, pk):
+        request = self.context.get('request')
+        if request is not None and not self.context.get('format'):
+            if self._template is None:
+                self._template = absolute_url_template(self.view_name, request) or ()
+            if self._template:
+                return self._template[0] + str(pk) + self._template[1]
+
+        return reverse(self.view_name, kwargs={'pk': pk}, request=request, format=self.context.get('format'))
+
+
+    def row_to_native(self, row):
+        raise NotImplementedError
+
+
+    @property
+    def data(self):
+        if self._data is None:
+            if self.many:
+                self._data = [self.row_to_native(row) for row in self.object]
+            else:
+                self._data = self.row_to_native(self.object)
+        return self._data
+
+
+
+class ProductValuesSerializer(ValuesSerializer):
+    """
+    Same data as ProductSerializer.
+    """
+
+    columns = ('pk', 'kind', 'date', 'serial_num', 'sale')
+    view_name = 'loyal:product:product-detail'
+
+    def row_to_native(self, row):
+        return SortedDict((
+            ('id', row.pk),
+            ('to_modify', self.link(row.pk)),
+            ('kind', row.kind),
+            ('kind_name', Product.PRODUCT_CHOICES[row.kind][1]),
+            ('date', self.format_date(row.date)),
+            ('serial_num', row.serial_num),
+            ('sale', row.sale),
+        ))
+
+
+
+class StampValuesSerializer(ValuesSerializer):
+    """
+    Same data as StampListSerializer.
+    """
+
+    columns = ('pk', 'owned_by', 'obtained_with', 'grouped_in')
+    view_name = 'loyal:stamp:stamp-detail'
+
+    def row_to_native(self, row):
+        return SortedDict((
+            ('id', row.pk),
+            ('to_modify', self.link(row.pk)),
+            ('owned_by', row.owned_by),
+            ('obtained_with', row.obtained_with),
+            ('grouped_in', row.grouped_in),
+        ))
+
+
+
+class VoucherValuesSerializer(ValuesSerializer):
+    """
+    Same data as VoucherListSerializer.
+    """
+
+    columns = ('pk', 'owned_by', 'redeemed_with', 'date')
+    view_name = 'loyal:voucher:voucher-detail'
+
+    def row_to_native(self, row):
+        return SortedDict((
+            ('id', row.pk),
+            ('to_modify', self.link(row.pk)),
+            ('owned_by', row.owned_by),
+            ('redeemed_with', row.redeemed_with),
+            ('date', self.format_date(row.date)),
+        ))
@@ -1,10 +1,11 @@
 from rest_framework import serializers
+from .fields import FastHyperlinkedIdentityField
 from loyal.models import Voucher, Customer
 from django.http import Http404
 from rest_framework.reverse import reverse
 
 class VoucherSerializer(serializers.ModelSerializer):
-    link = serializers.HyperlinkedIdentityField(view_name='loyal:voucher:voucher-detail')
+    link = FastHyperlinkedIdentityField(view_name='loyal:voucher:voucher-detail')
 
     class Meta:
         model = Voucher
@@ -22,7 +23,7 @@ class VoucherSerializer(serializers.ModelSerializer):
 
 
 class VoucherListSerializer(serializers.ModelSerializer):
-    to_modify = serializers.HyperlinkedIdentityField(view_name='loyal:voucher:voucher-detail')
+    to_modify = FastHyperlinkedIdentityField(view_name='loyal:voucher:voucher-detail')
 
     class Meta:
         model = Voucher
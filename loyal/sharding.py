@@ -0,0 +1,83 @@
+"""
+Views of sharded models that go through every shard, see loyal.routers.
+"""
+
+from itertools import chain
+from operator import attrgetter
+
+from django.http import Http404
+from rest_framework import status
+from rest_framework.response import Response
+
+from loyal import routers
+
+
+def from_all_shards(queryset):
+    """
+    The objects of the queryset in every shard, sorted by pk, or the queryset itself without sharding.
+    """
+
+    if not routers.is_sharded():
+        return queryset
+    return sorted(chain(*[queryset.using(alias) for alias in routers.shards()]), key=attrgetter('pk'))
+
+
+
+class ShardedObjectMixin(object):
+    """
+    Detail view of a sharded model, looking for the object in each shard until it's found.
+    Ids are unique across shards: customers, sales, stamps and vouchers get them interleaved from their shard, and
+    products keep the one they had in the catalog.
+    The rest of the request runs in the shard of the object, so the rows it's related to are read from there.
+    Rows of another shard can't be related to it by an update, the fields of other_shard_errors refuse them with
+    their error instead of not finding them.
+    """
+
+    other_shard_errors = {}
+
+    def get_object(self, queryset=None):
+        if queryset is not None or not routers.is_sharded():
+            return super(ShardedObjectMixin, self).get_object(queryset)
+
+        for alias in routers.shards():
+            try:
+                obj = super(ShardedObjectMixin, self).get_object(self.get_queryset().using(alias))
+            except Http404:
+                continue
+            routers.use_shard(alias)
+            return obj
+        raise Http404
+
+
+    def errors_for_other_shards(self, data):
+        """
+        Errors of the fields of data with rows of another shard than the object.
+        """
+
+        if not routers.is_sharded() or not self.other_shard_errors:
+            return {}
+        try:
+            self.get_object()
+        except Http404:
+            return {}
+
+        errors = {}
+        model = self.get_queryset().model
+        for field, message in self.other_shard_errors.items():
+            try:
+                pk = int(data.get(field))
+            except (TypeError, ValueError):
+                continue
+            related = model._meta.get_field(field).rel.to
+            if related.objects.using(routers.current_shard()).filter(pk=pk).exists():
+                continue
+            if any(related.objects.using(alias).filter(pk=pk).exists() for alias in routers.shards()):
+                errors[field] = [message]
+        return errors
+
+
+    def update(self, request, *args, **kwargs):
+        errors = self.errors_for_other_shards(request.DATA)
+        if errors:
+            return Response(errors, status=status.HTTP_400_BAD_REQUEST)
+        return super(ShardedObjectMixin, self).update(request, *args, **kwargs)
@@ -0,0 +1,2 @@
+-- Oldest stamps of a customer not grouped in a voucher yet, Stamp.group_into_vouchers() and the balances
+CREATE INDEX loyal_stamp_available ON loyal_stamp (owned_by_id, id) WHERE grouped_in_id IS NULL;
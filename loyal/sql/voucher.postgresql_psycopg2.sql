@@ -0,0 +1,2 @@
+-- Vouchers of a customer not redeemed yet, oldest first, for redeeming them and the balances
+CREATE INDEX loyal_voucher_available ON loyal_voucher (owned_by_id, date, id) WHERE redeemed_with_id IS NULL;
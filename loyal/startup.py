@@ -0,0 +1,61 @@
+"""
+Startup of the web processes.
+
+Django leaves a lot of work for the first request: loading the middleware, importing the views, compiling the URL
+patterns and filling the reverse() caches. warm_up() does it when the WSGI application is loaded, so when gunicorn
+preloads the app (yoyo_test/gunicorn_conf.py) it's done once in the master and every forked worker starts with it.
+Database connections can't be shared by forked processes, so each worker opens its own with connect_databases()
+right after the fork instead.
+"""
+
+from django.conf import settings
+from django.core.urlresolvers import RegexURLResolver, get_resolver
+from django.db import connections
+from django.db.models import get_models
+from rest_framework.settings import api_settings
+
+
+def _load_patterns(resolver):
+    # Compiling the regex of a resolver fills its reverse caches, getting the callback imports the view
+    resolver.reverse_dict
+    for pattern in resolver.url_patterns:
+        pattern.regex
+        if isinstance(pattern, RegexURLResolver):
+            _load_patterns(pattern)
+        else:
+            pattern.callback
+
+
+def warm_up(handler=None):
+    """
+    Load the models, URL patterns, views and REST framework classes, the API docs, and the middleware of the
+    handler if given. It doesn't touch the databases.
+    """
+
+    get_models()
+    _load_patterns(get_resolver(None))
+
+    for setting in ('DEFAULT_RENDERER_CLASSES', 'DEFAULT_PARSER_CLASSES', 'DEFAULT_AUTHENTICATION_CLASSES',
+                    'DEFAULT_PERMISSION_CLASSES', 'DEFAULT_CONTENT_NEGOTIATION_CLASS'):
+        getattr(api_settings, setting)
+
+    if 'rest_framework_swagger' in settings.INSTALLED_APPS:
+        from loyal.docs import api_docs
+        api_docs.get()
+
+    if handler is not None and handler._request_middleware is None:
+        handler.load_middleware()
+
+
+def connect_databases():
+    """
+    Open the connections of the databases with persistent connections (CONN_MAX_AGE), so the first request of a
+    worker doesn't wait for them. Returns the aliases connected.
+    """
+
+    connected = []
+    for conn in connections.all():
+        if conn.settings_dict.get('CONN_MAX_AGE'):
+            conn.ensure_connection()
+            connected.append(conn.alias)
+    return connected
@@ -1,6 +1,11 @@
+import calendar
+from datetime import datetime, timedelta
+import time
+
 from rest_framework import status
 from django.core.urlresolvers import reverse
 from django.utils import timezone
+from django.utils.http import http_date
 
 from loyal.models import Customer, Product, Sale, Stamp, Voucher
 from loyal.serializers import CustomerSerializerList
@@ -350,3 +355,91 @@ class APICustomer(YoyoAPITestCase):
         # Confirm it's OK
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(expected_customer, response.data)
+
+
+    def test_get_detail_single_query(self):
+        """
+        Verify that the customers detail endpoint reads the counters from the customer itself.
+        This tests the GET endpoint /loyal/customer/${id}
+        """
+
+        # Create customer with some stamps
+        c = Customer(**self.new_customer)
+        c.save()
+
+        for _ in xrange(3):
+            Stamp(owned_by=c).save()
+
+        # Get details with one query
+        url = self.get_url(self.CUST_DET_ENDP, args=[c.pk])
+        with self.assertNumQueries(1):
+            response = self.client.get(url)
+
+        # Confirm it's OK
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(3, response.data['available_stamps'])
+
+
+    def test_get_detail_not_modified(self):
+        """
+        Verify that the customers detail endpoint answers If-None-Match with 304 until the customer changes.
+        This tests the GET endpoint /loyal/customer/${id}
+        """
+
+        # Create customer
+        c = Customer(**self.new_customer)
+        c.save()
+
+        url = self.get_url(self.CUST_DET_ENDP, args=[c.pk])
+        response = self.client.get(url)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        etag = response['ETag']
+
+        # Unchanged, we only read the version
+        with self.assertNumQueries(1):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(etag, response['ETag'])
+        self.assertEqual('', response.content)
+
+        # A new stamp changes it
+        Stamp(owned_by=c).save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(etag, response['ETag'])
+        self.assertEqual(1, response.data['available_stamps'])
+
+
+    def test_get_detail_modified_since(self):
+        """
+        Verify that If-Modified-Since gets a 304 when the customer hasn't changed since that second, and that
+        there's no Last-Modified while the last change is in the current second, when another change would have
+        the same one.
+        This tests the GET endpoint /loyal/customer/${id}
+        """
+
+        # Create customer
+        c = Customer(**self.new_customer)
+        c.save()
+
+        changed = datetime(2015, 3, 1, 12, 0, 0, 500000, tzinfo=timezone.utc)
+        Customer.objects.filter(pk=c.pk).update(modified=changed)
+
+        url = self.get_url(self.CUST_DET_ENDP, args=[c.pk])
+        last_modified = self.client.get(url)['Last-Modified']
+        self.assertEqual(http_date(calendar.timegm(changed.utctimetuple())), last_modified)
+
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        # Changed in the current second, or as here on a clock a bit ahead, so the test can't cross into the next one
+        Stamp(owned_by=c).save()
+        Customer.objects.filter(pk=c.pk).update(modified=timezone.now() + timedelta(seconds=5))
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=http_date(time.time() + 60))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotIn('Last-Modified', response)
+        self.assertIn('ETag', response)
+        self.assertEqual(1, response.data['available_stamps'])
@@ -0,0 +1,129 @@
+from datetime import datetime
+
+from rest_framework import status
+from django.utils import timezone
+from loyal.models import Customer, Product, Sale, Stamp, Voucher
+from .yoyo_api_testcase import YoyoAPITestCase
+
+
+class APIHistory(YoyoAPITestCase):
+    """
+    This class tests following endpoints
+        /loyal/customer/history
+    """
+
+    def _date(self, day, hour=0):
+        return timezone.make_aware(datetime(2014, 1, day, hour), timezone.utc)
+
+
+    def _create_history(self):
+        """
+        Create a customer with a purchase on the 1st, a free stamp on the 2nd, a free voucher on the 3rd and
+        another purchase of a widget, that gives a stamp, on the 4th.
+        """
+
+        c = Customer(**self.new_customer)
+        c.save()
+
+        Sale(customer=c, date=self._date(1)).save()
+        Stamp(owned_by=c, date=self._date(2)).save()
+        v = Voucher(owned_by=c)
+        v.save()
+        Voucher.objects.filter(pk=v.pk).update(date=self._date(3))
+
+        s = Sale(customer=c, date=self._date(4))
+        s.save()
+        new_product = dict(self.new_product, sale=s)
+        p = Product(**new_product)
+        p.save()
+        Stamp.objects.filter(obtained_with=p).update(date=self._date(4))
+
+        return c
+
+
+    def test_history_empty(self):
+        """
+        Test that initially the history of a customer is empty.
+        This tests the GET endpoint /loyal/customer/${id}/history
+        """
+
+        c = Customer(**self.new_customer)
+        c.save()
+
+        url = self.get_url(self.HISTORY_ENDP, args=[c.pk])
+        response = self.client.get(url)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {'next': None, 'results': []})
+
+
+    def test_history_merged(self):
+        """
+        Test that purchases, stamps and vouchers are merged latest first, with a constant number of queries.
+        This tests the GET endpoint /loyal/customer/${id}/history
+        """
+
+        c = self._create_history()
+
+        url = self.get_url(self.HISTORY_ENDP, args=[c.pk])
+        with self.assertNumQueries(5):
+            response = self.client.get(url)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(None, response.data['next'])
+
+        events = [(event['type'], event['date'].day) for event in response.data['results']]
+        self.assertEqual([('purchase', 4), ('stamp', 4), ('voucher', 3), ('stamp', 2), ('purchase', 1)], events)
+        self.assertEqual([str(Product.objects.get())], response.data['results'][0]['products'])
+
+
+    def test_history_paginated(self):
+        """
+        Test that following the next links we get the whole history once.
+        This tests the GET endpoint /loyal/customer/${id}/history
+        """
+
+        c = self._create_history()
+
+        url = self.get_url(self.HISTORY_ENDP, args=[c.pk])
+        response = self.client.get(url, {'page_size': 2})
+
+        events = []
+        pages = 0
+        while True:
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            events += [(event['type'], event['date'].day) for event in response.data['results']]
+            pages += 1
+            if not response.data['next']:
+                break
+            response = self.client.get(response.data['next'])
+
+        self.assertEqual(3, pages)
+        self.assertEqual([('purchase', 4), ('stamp', 4), ('voucher', 3), ('stamp', 2), ('purchase', 1)], events)
+
+
+    def test_history_since(self):
+        """
+        Test that the history can be filtered by date.
+        This tests the GET endpoint /loyal/customer/${id}/history
+        """
+
+        c = self._create_history()
+
+        url = self.get_url(self.HISTORY_ENDP, args=[c.pk])
+        response = self.client.get(url, {'since': '2014-01-02T00:00:00Z', 'until': '2014-01-04T00:00:00Z'})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(['voucher', 'stamp'], [event['type'] for event in response.data['results']])
+
+
+    def test_history_non_existant_customer(self):
+        """
+        Test that the history of an unknown customer is not found.
+        This tests the GET endpoint /loyal/customer/${id}/history
+        """
+
+        url = self.get_url(self.HISTORY_ENDP, args=[1])
+        response = self.client.get(url)
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
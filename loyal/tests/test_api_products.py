@@ -29,9 +29,7 @@ class APIProduct(APITestCase):
     URL_TEST_PREFIX = "http://testserver"
 
     EMPTY_LIST = {
-        'count': 0,
         'next': None,
-        'previous': None,
         'results': []
     }
 
@@ -87,7 +85,6 @@ class APIProduct(APITestCase):
         products.append(p)
 
         expected_response['results'] = ProductSerializer(products, many=True).data
-        expected_response['count'] = 2
 
         for product in expected_response['results']:
             product['to_modify'] = self.URL_TEST_PREFIX +  product['to_modify']
@@ -104,6 +101,48 @@ class APIProduct(APITestCase):
         self.assertEqual(response.data, expected_response)
 
 
+    def test_product_list_cursor(self):
+        """
+        Test that we can walk through all the products following the next links.
+        This tests the GET from endpoint /loyal/products
+        """
+
+        # Create products
+        for i in xrange(25):
+            new_product = dict(self.new_product)
+            new_product['serial_num'] = str(i)
+            Product(**new_product).save()
+
+        # Get first page
+        url = self.get_url(self.PROD_LIST_ENDP)
+        response = self.client.get(url, {'page_size': 10})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(range(1, 11), [product['id'] for product in response.data['results']])
+
+        # Follow the next links without counting the products
+        ids = [product['id'] for product in response.data['results']]
+        while response.data['next']:
+            with self.assertNumQueries(1):
+                response = self.client.get(response.data['next'])
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            ids.extend(product['id'] for product in response.data['results'])
+
+        self.assertEqual(range(1, 26), ids)
+
+
+    def test_product_list_wrong_cursor(self):
+        """
+        Test that an invalid cursor is rejected
+        This tests the GET from endpoint /loyal/products
+        """
+
+        url = self.get_url(self.PROD_LIST_ENDP)
+        response = self.client.get(url, {'cursor': 'not a cursor'})
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
     def test_create_product(self):
         """
         Test that creates a single product
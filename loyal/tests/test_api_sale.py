@@ -2,6 +2,8 @@ from rest_framework import status
 from loyal.models import Customer, Product, Sale, Stamp, Voucher
 from .yoyo_api_testcase import YoyoAPITestCase
 
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 from datetime import datetime
 
@@ -32,7 +34,7 @@ class APISale(YoyoAPITestCase):
 
         # Confirm it's OK
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(response.data, [])
+        self.assertEqual(response.data, {'next': None, 'results': []})
 
 
     def test_sales_list_populated(self):
@@ -63,21 +65,77 @@ class APISale(YoyoAPITestCase):
         url = self.get_url(self.SALE_LIST_ENDP, args=[c.pk])
         response = self.client.get(url)
 
-        # Confirm it's OK
+        # Confirm it's OK, latest first
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(2, len(response.data))
+        self.assertEqual(None, response.data['next'])
+        sales = response.data['results']
+        self.assertEqual(2, len(sales))
+
+        sale_data = {"date": sales[0].get("date", None),
+                     'products':[str(p)],
+                     'products_links': [self.get_non_customer_url(self.PRODUCT_ENDP, args=[1])],
+        }
+        self.assertEqual(sales[0], sale_data)
 
-        sale_data = {"date": response.data[0].get("date", None),
+        sale_data = {"date": sales[1].get("date", None),
                      'products':[],
                      'products_links':[]
         }
-        self.assertEqual(response.data[0], sale_data)
+        self.assertEqual(sales[1], sale_data)
 
-        sale_data = {"date": response.data[1].get("date", None),
-                     'products':[str(p)],
-                     'products_links': [self.get_non_customer_url(self.PRODUCT_ENDP, args=[1])],
-        }
-        self.assertEqual(response.data[1], sale_data)
+
+    def test_sales_list_since(self):
+        """
+        Test that the sales of a customer can be filtered by date with a constant number of queries.
+        This tests the GET from endpoint /loyal/customer/${id}/sales
+        """
+
+        # Create customer with a sale of 2 products on each of the first 3 days of the year
+        c = Customer(**self.new_customer)
+        c.save()
+
+        for day in xrange(1, 4):
+            s = Sale(customer=c, date=timezone.make_aware(datetime(2014, 1, day), timezone.utc))
+            s.save()
+            serial_nums = self._create_products(2, Product.GIZMO)
+            Product.objects.filter(serial_num__in=serial_nums).update(sale=s)
+
+        # Get the sales of the last 2 days
+        url = self.get_url(self.SALE_LIST_ENDP, args=[c.pk])
+        with self.assertNumQueries(3):
+            response = self.client.get(url, {'since': '2014-01-02T00:00:00Z'})
+
+        # Confirm it's OK
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        dates = [sale['date'].day for sale in response.data['results']]
+        self.assertEqual([3, 2], dates)
+        self.assertEqual(2, len(response.data['results'][0]['products']))
+
+
+    def test_sales_list_not_modified(self):
+        """
+        Test that the purchases of a customer are not sent again until a product is sold to it.
+        This tests the GET from endpoint /loyal/customer/${id}/sales
+        """
+
+        c = Customer(**self.new_customer)
+        c.save()
+        s = Sale(customer=c)
+        s.save()
+
+        url = self.get_url(self.SALE_LIST_ENDP, args=[c.pk])
+        etag = self.client.get(url)['ETag']
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        # Adding a gizmo to the sale doesn't give a stamp but changes the list
+        new_product = dict(self.new_product, kind=Product.GIZMO, sale=s)
+        Product(**new_product).save()
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(1, len(response.data['results'][0]['products']))
 
 
     def test_create_sale_with_no_date(self):
@@ -135,3 +193,188 @@ class APISale(YoyoAPITestCase):
 
         # Confirm it's not OK
         self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+    def _create_products(self, num_products, kind=Product.WIDGET):
+        serial_nums = []
+        first_serial_num = Product.objects.count()
+        for i in xrange(first_serial_num, first_serial_num + num_products):
+            serial_num = str(i)
+            Product(kind=kind, date=timezone.now(), serial_num=serial_num).save()
+            serial_nums.append(serial_num)
+
+        return serial_nums
+
+
+    def test_checkout(self):
+        """
+        Test that sells 20 widgets and 2 gizmos in a single sale
+        This tests the POST from endpoint /loyal/customer/${id}/purchases/checkout
+        """
+
+        # Create customer and products in DB
+        c = Customer(**self.new_customer)
+        c.save()
+
+        serial_nums = self._create_products(20) + self._create_products(2, Product.GIZMO)
+
+        # Sell them through API
+        url = self.get_url(self.CHECKOUT_ENDP, args=[c.pk])
+        response = self.client.post(url, {'serial_nums': serial_nums})
+
+        # Confirm it's OK
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(22, len(response.data['products']))
+
+        # All products are in the sale, widgets got stamps and they were converted to vouchers
+        self.assertEqual(1, Sale.objects.count())
+        self.assertEqual(22, Product.objects.filter(sale__customer=c).count())
+        self.assertEqual(20, Stamp.objects.filter(owned_by=c, obtained_with__kind=Product.WIDGET).count())
+        self.assertEqual(2, Voucher.objects.filter(owned_by=c).count())
+
+        c = Customer.objects.get(pk=c.pk)
+        self.assertEqual((0, 20, 2, 2, 1), (c.available_stamps, c.total_stamps, c.available_vouchers,
+                                            c.total_vouchers, c.num_purchases))
+
+
+    def test_checkout_constant_queries(self):
+        """
+        Test that the number of queries of a sale doesn't depend on the number of products
+        This tests the POST from endpoint /loyal/customer/${id}/purchases/checkout
+        """
+
+        # Create customer and products in DB
+        c = Customer(**self.new_customer)
+        c.save()
+
+        small_basket = self._create_products(2)
+        big_basket = self._create_products(8, Product.GIZMO) + self._create_products(8)[2:]
+
+        # Sell them through API
+        url = self.get_url(self.CHECKOUT_ENDP, args=[c.pk])
+        with CaptureQueriesContext(connection) as small_queries:
+            response = self.client.post(url, {'serial_nums': small_basket})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        with CaptureQueriesContext(connection) as big_queries:
+            response = self.client.post(url, {'serial_nums': big_basket})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        self.assertEqual(len(small_queries), len(big_queries))
+        self.assertEqual(8, Stamp.objects.count())
+
+
+    def test_checkout_vouchers_constant_queries(self):
+        """
+        Test that a sale giving several vouchers takes the same queries as one giving a single voucher
+        This tests the POST from endpoint /loyal/customer/${id}/purchases/checkout
+        """
+
+        url = self.get_url(self.CHECKOUT_ENDP, args=[Customer.objects.create(**self.new_customer).pk])
+        basket = self._create_products(Stamp.STAMPS_PER_VOUCHER)
+        with self.assertNumQueries(18):
+            response = self.client.post(url, {'serial_nums': basket})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        # 20 widgets give 2 vouchers
+        c = Customer(**self.new_customer)
+        c.save()
+        basket = self._create_products(2 * Stamp.STAMPS_PER_VOUCHER)
+        with self.assertNumQueries(18):
+            response = self.client.post(self.get_url(self.CHECKOUT_ENDP, args=[c.pk]), {'serial_nums': basket})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        c = Customer.objects.get(pk=c.pk)
+        self.assertEqual((0, 20, 2, 2, 1), (c.available_stamps, c.total_stamps, c.available_vouchers,
+                                            c.total_vouchers, c.num_purchases))
+        for voucher in Voucher.objects.filter(owned_by=c):
+            self.assertEqual(Stamp.STAMPS_PER_VOUCHER, voucher.stamp_set.count())
+
+
+    def test_checkout_sold_product(self):
+        """
+        Test that tries to sell a product that has already been sold
+        This tests the POST from endpoint /loyal/customer/${id}/purchases/checkout
+        """
+
+        # Create customer and products in DB
+        c = Customer(**self.new_customer)
+        c.save()
+
+        serial_nums = self._create_products(2)
+
+        # Sell the first product
+        url = self.get_url(self.CHECKOUT_ENDP, args=[c.pk])
+        response = self.client.post(url, {'serial_nums': serial_nums[:1]})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        # Try to sell both
+        response = self.client.post(url, {'serial_nums': serial_nums})
+
+        # Confirm it's not OK and nothing changed
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(1, Sale.objects.count())
+        self.assertEqual(1, Stamp.objects.count())
+
+
+    def test_checkout_redeemed_product(self):
+        """
+        Test that tries to sell a product that has already been given away for a voucher
+        This tests the POST from endpoints /loyal/customer/${id}/vouchers/redeem and
+        /loyal/customer/${id}/purchases/checkout
+        """
+
+        # Create customer with a voucher and a product in DB
+        c = Customer(**self.new_customer)
+        c.save()
+        Voucher(owned_by=c).save()
+        serial_nums = self._create_products(1)
+
+        # Redeem the voucher for it
+        response = self.client.post(self.get_url(self.REDEEM_ENDP, args=[c.pk]), {'serial_num': serial_nums[0]})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        # Try to sell it
+        url = self.get_url(self.CHECKOUT_ENDP, args=[c.pk])
+        response = self.client.post(url, {'serial_nums': serial_nums})
+
+        # Confirm it's not OK and nothing changed
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(0, Sale.objects.count())
+        self.assertEqual(0, Stamp.objects.count())
+        self.assertIsNone(Product.objects.get(serial_num=serial_nums[0]).sale_id)
+
+
+    def test_checkout_unknown_product(self):
+        """
+        Test that tries to sell a product that doesn't exist
+        This tests the POST from endpoint /loyal/customer/${id}/purchases/checkout
+        """
+
+        # Create customer in DB
+        c = Customer(**self.new_customer)
+        c.save()
+
+        # Try to sell it
+        url = self.get_url(self.CHECKOUT_ENDP, args=[c.pk])
+        response = self.client.post(url, {'serial_nums': ['unknown']})
+
+        # Confirm it's not OK
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(0, Sale.objects.count())
+
+
+    def test_checkout_non_existan_owner(self):
+        """
+        Test that tries to sell to an unkown customer
+        This tests the POST from endpoint /loyal/customer/${id}/purchases/checkout
+        """
+
+        serial_nums = self._create_products(1)
+
+        # Try to sell it
+        url = self.get_url(self.CHECKOUT_ENDP, args=[1])
+        response = self.client.post(url, {'serial_nums': serial_nums})
+
+        # Confirm it's not OK
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
@@ -1,5 +1,11 @@
+from datetime import datetime
+import json
+
 from rest_framework import status
+from django.core.urlresolvers import reverse
+from django.utils import timezone
 from loyal.models import Customer, Product, Stamp
+from loyal.views import StampListAllView
 from .yoyo_api_testcase import YoyoAPITestCase
 
 import names as gen_names
@@ -29,7 +35,7 @@ class APIStamp(YoyoAPITestCase):
 
         # Confirm it's OK
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(response.data, [])
+        self.assertEqual(response.data, {'next': None, 'results': []})
 
 
     def test_stamp_list_populated(self):
@@ -59,22 +65,77 @@ class APIStamp(YoyoAPITestCase):
         url = self.get_url(self.STAMP_LIST_ENDP, args=[c.pk])
         response = self.client.get(url)
 
-        # Confirm it's OK
+        # Confirm it's OK, latest first
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(2, len(response.data))
+        self.assertEqual(None, response.data['next'])
+        stamps = response.data['results']
+        self.assertEqual(2, len(stamps))
 
         stamp_data = {
-            'obtained_with': p.pk,
+            'date': stamps[0].get('date', None),
+            'obtained_with': None,
             'grouped_in': None,
-            'link': self.get_non_customer_url(self.STAMP_ENDP, args=[1]),
+            'link': self.get_non_customer_url(self.STAMP_ENDP, args=[2]),
         }
-        self.assertEqual(response.data[0], stamp_data)
+        self.assertEqual(stamps[0], stamp_data)
 
         stamp_data.update({
-            'obtained_with': None,
-            'link': self.get_non_customer_url(self.STAMP_ENDP, args=[2]),
+            'date': stamps[1].get('date', None),
+            'obtained_with': p.pk,
+            'link': self.get_non_customer_url(self.STAMP_ENDP, args=[1]),
         })
-        self.assertEqual(response.data[1], stamp_data)
+        self.assertEqual(stamps[1], stamp_data)
+
+
+    def test_stamp_list_dates(self):
+        """
+        Test that the stamps of a customer can be filtered by date and are paginated.
+        This tests the GET from endpoint /loyal/customer/${id}/stamps.
+        """
+
+        # Create customer with a stamp on each of the first 3 days of the year
+        c = Customer(**self.new_customer)
+        c.save()
+
+        for day in xrange(1, 4):
+            Stamp(owned_by=c, date=timezone.make_aware(datetime(2014, 1, day), timezone.utc)).save()
+
+        # Get the stamps of the last 2 days, one per page
+        url = self.get_url(self.STAMP_LIST_ENDP, args=[c.pk])
+        response = self.client.get(url, {'since': '2014-01-02T00:00:00Z', 'page_size': 1})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(1, len(response.data['results']))
+        self.assertTrue(response.data['results'][0]['link'].endswith('/3'))
+
+        response = self.client.get(response.data['next'])
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(1, len(response.data['results']))
+        self.assertTrue(response.data['results'][0]['link'].endswith('/2'))
+        self.assertEqual(None, response.data['next'])
+
+        # Get the stamps before the second day
+        response = self.client.get(url, {'until': '2014-01-02T00:00:00Z'})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(1, len(response.data['results']))
+        self.assertTrue(response.data['results'][0]['link'].endswith('/1'))
+
+
+    def test_stamp_list_wrong_date(self):
+        """
+        Test that an invalid date filter is rejected.
+        This tests the GET from endpoint /loyal/customer/${id}/stamps.
+        """
+
+        c = Customer(**self.new_customer)
+        c.save()
+
+        url = self.get_url(self.STAMP_LIST_ENDP, args=[c.pk])
+        response = self.client.get(url, {'since': 'yesterday'})
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
 
 
     def test_create_free_stamp(self):
@@ -93,6 +154,7 @@ class APIStamp(YoyoAPITestCase):
 
         # Confirm it's OK
         free_stamp = {
+            "date": response.data.get("date", None),
             "obtained_with": None,
             "grouped_in": None,
             'link': self.get_non_customer_url(self.STAMP_ENDP, args=[1]),
@@ -124,6 +186,7 @@ class APIStamp(YoyoAPITestCase):
         response = self.client.post(url, stamp_data)
 
         stamp_data['link'] = self.get_non_customer_url(self.STAMP_ENDP, args=[1])
+        stamp_data['date'] = response.data.get('date', None)
 
         # Confirm it's OK
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
@@ -196,3 +259,62 @@ class APIStamp(YoyoAPITestCase):
 
         # Confirm it's not OK
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+    def test_all_stamps_paginated(self):
+        """
+        Test that the list of all the stamps is paginated by id.
+        This tests the GET from endpoint /loyal/stamps.
+        """
+
+        # Create customer with 3 stamps
+        c = Customer(**self.new_customer)
+        c.save()
+
+        for _ in xrange(3):
+            Stamp(owned_by=c).save()
+
+        # Get the first page
+        url = reverse('loyal:stamp:stamp-list')
+        response = self.client.get(url, {'page_size': 2})
+
+        # Confirm it's OK
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([1, 2], [stamp['id'] for stamp in response.data['results']])
+
+        # Get the last page
+        response = self.client.get(response.data['next'])
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([3], [stamp['id'] for stamp in response.data['results']])
+        self.assertEqual(None, response.data['next'])
+
+
+    def test_all_stamps_ndjson(self):
+        """
+        Test that all the stamps can be streamed as newline delimited JSON, reading them in chunks.
+        This tests the GET from endpoint /loyal/stamps.
+        """
+
+        # Create customer with 5 stamps
+        c = Customer(**self.new_customer)
+        c.save()
+
+        for _ in xrange(5):
+            Stamp(owned_by=c).save()
+
+        # Stream them in chunks of 2 stamps
+        url = reverse('loyal:stamp:stamp-list')
+        old_chunk_size = StampListAllView.export_chunk_size
+        StampListAllView.export_chunk_size = 2
+        try:
+            response = self.client.get(url, {'format': 'ndjson'})
+            with self.assertNumQueries(3):
+                lines = list(response.streaming_content)
+        finally:
+            StampListAllView.export_chunk_size = old_chunk_size
+
+        # Confirm it's OK
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual('application/x-ndjson', response['Content-Type'])
+        self.assertEqual([1, 2, 3, 4, 5], [json.loads(line)['id'] for line in lines])
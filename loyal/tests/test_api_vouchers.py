@@ -2,6 +2,11 @@ from rest_framework import status
 from loyal.models import Customer, Product, Sale, Stamp, Voucher
 from .yoyo_api_testcase import YoyoAPITestCase
 
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from datetime import datetime
+
 import names as gen_names
 
 
@@ -29,7 +34,7 @@ class APIVoucher(YoyoAPITestCase):
 
         # Confirm it's OK
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(response.data, [])
+        self.assertEqual(response.data, {'next': None, 'results': []})
 
 
     def test_voucher_list_populated(self):
@@ -59,19 +64,21 @@ class APIVoucher(YoyoAPITestCase):
         url = self.get_url(self.VOUCH_LIST_ENDP, args=[c.pk])
         response = self.client.get(url)
 
-        # Confirm it's OK
+        # Confirm it's OK, latest first
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(2, len(response.data))
-
-        voucher_data = {"redeemed_with": p.pk,
-                        "date": response.data[0].get("date", None),
-                        'link': self.get_non_customer_url(self.VOUCHER_ENDP, args=[1])}
-        self.assertEqual(response.data[0], voucher_data)
+        self.assertEqual(None, response.data['next'])
+        vouchers = response.data['results']
+        self.assertEqual(2, len(vouchers))
 
         voucher_data = {"redeemed_with": None,
-                        "date": response.data[1].get("date", None),
+                        "date": vouchers[0].get("date", None),
                         'link': self.get_non_customer_url(self.VOUCHER_ENDP, args=[2])}
-        self.assertEqual(response.data[1], voucher_data)
+        self.assertEqual(vouchers[0], voucher_data)
+
+        voucher_data = {"redeemed_with": p.pk,
+                        "date": vouchers[1].get("date", None),
+                        'link': self.get_non_customer_url(self.VOUCHER_ENDP, args=[1])}
+        self.assertEqual(vouchers[1], voucher_data)
 
 
     def test_create_free_voucher(self):
@@ -218,3 +225,115 @@ class APIVoucher(YoyoAPITestCase):
 
         # Confirm it's not OK
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+    def _create_vouchers(self, customer, days):
+        for day in days:
+            v = Voucher(owned_by=customer)
+            v.save()
+            Voucher.objects.filter(pk=v.pk).update(date=timezone.make_aware(datetime(2014, 1, day), timezone.utc))
+
+
+    def test_redeem_voucher(self):
+        """
+        Test that redeeming gives the product for the oldest available voucher.
+        This tests the POST from endpoint /loyal/customer/${id}/vouchers/redeem
+        """
+
+        # Create customer, vouchers and product in DB
+        c = Customer(**self.new_customer)
+        c.save()
+        self._create_vouchers(c, [3, 1, 2])
+        p = Product(**self.new_product)
+        p.save()
+
+        # Redeem through API
+        url = self.get_url(self.REDEEM_ENDP, args=[c.pk])
+        response = self.client.post(url, {'serial_num': p.serial_num})
+
+        # Confirm it's OK
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(p.pk, response.data['redeemed_with'])
+        self.assertEqual(1, response.data['date'].day)
+
+        v = Voucher.objects.get(redeemed_with=p)
+        self.assertEqual(v.pk, response.data['id'])
+        c = Customer.objects.get(pk=c.pk)
+        self.assertEqual((2, 3), (c.available_vouchers, c.total_vouchers))
+
+
+    def test_redeem_constant_queries(self):
+        """
+        Test that the number of queries of a redemption doesn't depend on the number of vouchers.
+        This tests the POST from endpoint /loyal/customer/${id}/vouchers/redeem
+        """
+
+        # Create customers with 1 and 20 vouchers, and products in DB
+        few = Customer(**self.new_customer)
+        few.save()
+        self._create_vouchers(few, [1])
+        many = Customer(**self.new_customer)
+        many.save()
+        self._create_vouchers(many, range(1, 21))
+        for serial_num in ("1", "2"):
+            Product(**dict(self.new_product, serial_num=serial_num)).save()
+
+        # Redeem through API
+        with CaptureQueriesContext(connection) as few_queries:
+            response = self.client.post(self.get_url(self.REDEEM_ENDP, args=[few.pk]), {'serial_num': "1"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        with CaptureQueriesContext(connection) as many_queries:
+            response = self.client.post(self.get_url(self.REDEEM_ENDP, args=[many.pk]), {'serial_num': "2"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        self.assertEqual(len(few_queries), len(many_queries))
+
+
+    def test_redeem_no_vouchers(self):
+        """
+        Test that tries to redeem when all the vouchers of the customer have been redeemed.
+        This tests the POST from endpoint /loyal/customer/${id}/vouchers/redeem
+        """
+
+        # Create customer, a voucher and products in DB
+        c = Customer(**self.new_customer)
+        c.save()
+        self._create_vouchers(c, [1])
+        for serial_num in ("1", "2"):
+            Product(**dict(self.new_product, serial_num=serial_num)).save()
+
+        # Redeem twice through API
+        url = self.get_url(self.REDEEM_ENDP, args=[c.pk])
+        response = self.client.post(url, {'serial_num': "1"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.post(url, {'serial_num': "2"})
+
+        # Confirm it's not OK and nothing changed
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(1, Voucher.objects.filter(redeemed_with__isnull=False).count())
+        self.assertEqual(0, Customer.objects.get(pk=c.pk).available_vouchers)
+
+
+    def test_redeem_product_redeemed(self):
+        """
+        Test that tries to redeem a voucher for a product that has already been redeemed.
+        This tests the POST from endpoint /loyal/customer/${id}/vouchers/redeem
+        """
+
+        # Create customer, vouchers and product in DB
+        c = Customer(**self.new_customer)
+        c.save()
+        self._create_vouchers(c, [1, 2])
+        p = Product(**self.new_product)
+        p.save()
+
+        # Redeem twice for the same product through API
+        url = self.get_url(self.REDEEM_ENDP, args=[c.pk])
+        response = self.client.post(url, {'serial_num': p.serial_num})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.post(url, {'serial_num': p.serial_num})
+
+        # Confirm it's not OK
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(1, Customer.objects.get(pk=c.pk).available_vouchers)
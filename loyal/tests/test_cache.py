@@ -0,0 +1,125 @@
+import shutil
+import tempfile
+
+from django.test import TestCase
+from django.test.utils import override_settings
+from rest_framework import status
+
+from loyal.cache import LRUCache, PayloadCache, SharedCache, customer_cache
+from loyal.models import Customer, Product, Sale, Stamp
+from .yoyo_api_testcase import YoyoAPITestCase
+
+
+class TestLRUCache(TestCase):
+
+    def test_eviction(self):
+        """
+        Test that the least recently used entry is evicted when the cache is full.
+        """
+
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(1, cache.get('a'))
+
+        cache.set('c', 3)
+        self.assertEqual(None, cache.get('b'))
+        self.assertEqual(1, cache.get('a'))
+        self.assertEqual(3, cache.get('c'))
+        self.assertEqual(1, cache.evictions)
+        self.assertEqual(2, len(cache))
+
+
+    def test_payload_version(self):
+        """
+        Test that payloads are only used for the version of the customer they were built from.
+        """
+
+        cache = PayloadCache(LRUCache(10), 'test')
+        c = Customer(pk=1, version=3)
+        cache.set(c, 'http://testserver/', {'first_name': 'John'})
+
+        self.assertEqual({'first_name': 'John'}, cache.get(c, 'http://testserver/'))
+        self.assertEqual(None, cache.get(c, 'https://example.com/'))
+        c.version = 4
+        self.assertEqual(None, cache.get(c, 'http://testserver/'))
+        self.assertEqual({'enabled': True, 'hits': 1, 'misses': 2, 'hit_ratio': 0.333, 'invalidations': 0,
+                          'evictions': 0, 'entries': 1}, cache.stats())
+
+
+    def test_shared_evictions(self):
+        """
+        Test that the entries culled by the file based and local memory caches are counted as evictions.
+        """
+
+        directory = tempfile.mkdtemp()
+        caches = {
+            'files': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': directory,
+                      'OPTIONS': {'MAX_ENTRIES': 4, 'CULL_FREQUENCY': 2}},
+            'memory': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'test-evictions',
+                       'OPTIONS': {'MAX_ENTRIES': 4, 'CULL_FREQUENCY': 2}},
+            'dummy': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'},
+        }
+        try:
+            with override_settings(CACHES=caches):
+                for alias in ('files', 'memory'):
+                    cache = SharedCache(alias)
+                    for number in xrange(6):
+                        cache.set(number, number)
+                    cache.delete(5)
+                    self.assertEqual(2, cache.evictions)
+                    self.assertEqual(3, len([number for number in xrange(6) if cache.get(number) is not None]))
+
+                self.assertEqual(None, SharedCache('dummy').evictions)
+        finally:
+            shutil.rmtree(directory)
+
+
+
+class APICustomerCache(YoyoAPITestCase):
+    """
+    This class tests the cache of the endpoint
+        /loyal/customer/${id}
+    """
+
+    def setUp(self):
+        customer_cache.reset()
+
+
+    def test_detail_cached(self):
+        """
+        Test that the customer detail is built once and rebuilt after its stamps change.
+        """
+
+        c = Customer(**self.new_customer)
+        c.save()
+
+        url = self.get_url(self.CUST_DET_ENDP, args=[c.pk])
+        first = self.client.get(url).data
+        self.assertEqual(first, self.client.get(url).data)
+        self.assertEqual((1, 1), (customer_cache.hits, customer_cache.misses))
+
+        Stamp(owned_by=c).save()
+        response = self.client.get(url)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(1, response.data['available_stamps'])
+        self.assertEqual((1, 2), (customer_cache.hits, customer_cache.misses))
+
+
+    def test_product_invalidates(self):
+        """
+        Test that selling a product to a customer removes its cached detail.
+        """
+
+        c = Customer(**self.new_customer)
+        c.save()
+        s = Sale(customer=c)
+        s.save()
+
+        self.client.get(self.get_url(self.CUST_DET_ENDP, args=[c.pk]))
+        invalidations = customer_cache.invalidations
+
+        new_product = dict(self.new_product, kind=Product.GIZMO, sale=s)
+        Product(**new_product).save()
+        self.assertEqual(invalidations + 1, customer_cache.invalidations)
@@ -0,0 +1,159 @@
+import os
+import shutil
+from StringIO import StringIO
+import tempfile
+
+from django.core.management import call_command
+from django.db.models import DateTimeField
+from django.test import TransactionTestCase
+from django.utils import timezone
+from loyal.models import Customer, Product, Sale, Stamp, Voucher
+
+
+class LoyaltyCSV(TransactionTestCase):
+    """
+    This class tests the import_loyalty and export_loyalty commands
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+    def _write(self, name, content):
+        with open(os.path.join(self.directory, name + '.csv'), 'w') as csv_file:
+            csv_file.write(content)
+
+
+    def _rows(self):
+        # Versions of the customers are bumped when loading
+        rows = []
+        for model in (Customer, Sale, Product, Voucher, Stamp):
+            fields = [field.attname for field in model._meta.local_fields
+                      if model is not Customer or field.name not in Customer.VERSION_FIELDS]
+            rows.append(list(model.objects.order_by('pk').values_list(*fields)))
+        return rows
+
+
+    def test_import_purchases(self):
+        """
+        Test that importing purchases gives stamps for the widgets, grouped in vouchers, and updates balances.
+        """
+
+        self._write('customers', "id,first_name,last_name,email\n"
+                                 "1,John,Doe,john.doe@gmail.com\n"
+                                 "2,Jane,Doe,jane.doe@gmail.com\n")
+        self._write('sales', "id,customer_id,date\n"
+                             "1,1,2014-01-01T10:00:00+00:00\n"
+                             "2,2,2014-01-02T10:00:00+00:00\n")
+
+        # John buys 12 widgets and a gizmo, Jane buys 3 widgets and there's an unsold widget
+        products = ["id,kind,serial_num,date,sale_id"]
+        for i in xrange(1, 13):
+            products.append("{0},0,{0},2013-12-01T10:00:00+00:00,1".format(i))
+        products.append("13,1,13,2013-12-01T10:00:00+00:00,1")
+        for i in xrange(14, 17):
+            products.append("{0},0,{0},2013-12-01T10:00:00+00:00,2".format(i))
+        products.append("17,0,17,2013-12-01T10:00:00+00:00,")
+        self._write('products', "\n".join(products) + "\n")
+
+        call_command('import_loyalty', self.directory, stdout=StringIO())
+
+        john = Customer.objects.get(pk=1)
+        self.assertEqual((2, 12, 1, 1, 1), (john.available_stamps, john.total_stamps, john.available_vouchers,
+                                            john.total_vouchers, john.num_purchases))
+
+        jane = Customer.objects.get(pk=2)
+        self.assertEqual((3, 3, 0), (jane.available_stamps, jane.total_stamps, jane.total_vouchers))
+
+        # The oldest stamps are grouped and new objects don't collide with the imported ones
+        voucher = Voucher.objects.get()
+        self.assertEqual(range(1, 11), sorted(voucher.stamp_set.values_list('obtained_with', flat=True)))
+        self.assertEqual(Sale.objects.get(pk=1).date, Stamp.objects.get(obtained_with=1).date)
+        Customer(first_name="Jim", last_name="Doe", email="jim.doe@gmail.com").save()
+
+
+    def test_export_import(self):
+        """
+        Test that exported data is imported back as it was.
+        """
+
+        c = Customer(first_name="John", last_name="Doe", email="john.doe@gmail.com")
+        c.save()
+        s = Sale(customer=c)
+        s.save()
+        for i in xrange(11):
+            Product(kind=Product.WIDGET, serial_num=str(i), sale=s, date=timezone.now()).save()
+        Voucher(owned_by=c).save()
+
+        call_command('export_loyalty', self.directory, stdout=StringIO())
+
+        expected = self._rows()
+        for model in (Stamp, Voucher, Product, Sale, Customer):
+            model.objects.all().delete()
+
+        call_command('import_loyalty', self.directory, stdout=StringIO())
+
+        self.assertEqual(expected, self._rows())
+
+
+
+class PopulateDB(TransactionTestCase):
+    """
+    This class tests the populate_db command
+    """
+
+    def _rows(self):
+        # Dates depend on when it runs
+        rows = []
+        for model in (Customer, Sale, Product, Voucher, Stamp):
+            fields = [field.attname for field in model._meta.local_fields if not isinstance(field, DateTimeField)
+                      and (model is not Customer or field.name not in Customer.VERSION_FIELDS)]
+            rows.append(list(model.objects.order_by('pk').values_list(*fields)))
+        return rows
+
+
+    def _populate(self):
+        call_command('populate_db', customers=30, seed=1234, batch_size=7, transaction_size=50, stdout=StringIO())
+
+
+    def test_populate(self):
+        """
+        Test that the same seed gives the same rows and that the balances match them.
+        """
+
+        self._populate()
+
+        self.assertEqual(30, Customer.objects.count())
+        self.assertEqual(300, Product.objects.count())
+        self.assertTrue(Sale.objects.exists())
+
+        # Every sold widget has a stamp, and there's a free stamp and half a free voucher per customer
+        sold_widgets = Product.objects.filter(kind=Product.WIDGET, sale__isnull=False).count()
+        self.assertEqual(sold_widgets, Stamp.objects.filter(obtained_with__isnull=False).count())
+        self.assertEqual(30, Stamp.objects.filter(obtained_with__isnull=True).count())
+        grouped = Voucher.objects.filter(stamp__isnull=False).distinct().count()
+        self.assertEqual(grouped + 15, Voucher.objects.count())
+        self.assertFalse(Voucher.objects.filter(redeemed_with__sale__isnull=False).exists())
+
+        for customer in Customer.objects.all():
+            stamps = Stamp.objects.filter(owned_by=customer)
+            vouchers = Voucher.objects.filter(owned_by=customer)
+            self.assertEqual((stamps.filter(grouped_in__isnull=True).count(), stamps.count(),
+                              vouchers.filter(redeemed_with__isnull=True).count(), vouchers.count(),
+                              Sale.objects.filter(customer=customer).count()),
+                             (customer.available_stamps, customer.total_stamps, customer.available_vouchers,
+                              customer.total_vouchers, customer.num_purchases))
+            for voucher in vouchers:
+                self.assertIn(voucher.stamp_set.count(), (0, Stamp.STAMPS_PER_VOUCHER))
+
+        # The second time it starts again from the same ids
+        expected = self._rows()
+        for model in (Stamp, Voucher, Product, Sale, Customer):
+            model.objects.all().delete()
+
+        self._populate()
+        self.assertEqual(expected, self._rows())
@@ -0,0 +1,58 @@
+from multiprocessing import Process
+
+from django.db import connection
+from django.db.models import Count
+from django.test import TransactionTestCase
+
+from loyal.models import Customer, Stamp, Voucher
+
+
+def _add_stamps(customer_ids, num_stamps):
+    # The connection inherited from the parent can't be shared, the process opens its own
+    connection.close()
+    for i in xrange(num_stamps):
+        Stamp(owned_by_id=customer_ids[i % len(customer_ids)]).save()
+    connection.close()
+
+
+class ConcurrentVouchers(TransactionTestCase):
+    """
+    Stamps are added to the same customers from several processes at the same time, like gunicorn workers do.
+    """
+
+    PROCESSES = 4
+    STAMPS_PER_PROCESS = 60
+
+    def setUp(self):
+        # The test database only exists once the tests are running
+        if connection.vendor == 'sqlite' and connection.settings_dict['NAME'] in ('', ':memory:'):
+            self.skipTest("Processes can't share an in-memory database")
+
+
+    def test_every_voucher_has_ten_stamps(self):
+        customers = []
+        for i in xrange(3):
+            c = Customer(first_name="John", last_name="Doe", email="john{0}@example.com".format(i))
+            c.save()
+            customers.append(c.pk)
+
+        processes = [Process(target=_add_stamps, args=(customers, self.STAMPS_PER_PROCESS))
+                     for _ in xrange(self.PROCESSES)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        self.assertEqual([0] * self.PROCESSES, [process.exitcode for process in processes])
+
+        # Every voucher holds exactly ten stamps and no stamp is left that could make another one
+        stamps = Stamp.objects.count()
+        self.assertEqual(self.PROCESSES * self.STAMPS_PER_PROCESS, stamps)
+        grouped = Voucher.objects.annotate(num_stamps=Count('stamp')).values_list('num_stamps', flat=True)
+        self.assertEqual(set([Stamp.STAMPS_PER_VOUCHER]), set(grouped))
+        self.assertEqual(stamps // Stamp.STAMPS_PER_VOUCHER, len(grouped))
+
+        for c in Customer.objects.all():
+            available = Stamp.objects.filter(owned_by=c, grouped_in__isnull=True).count()
+            self.assertEqual(available, c.available_stamps)
+            self.assertTrue(available < Stamp.STAMPS_PER_VOUCHER)
+            self.assertEqual(Voucher.objects.filter(owned_by=c).count(), c.total_vouchers)
@@ -0,0 +1,64 @@
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.test.utils import override_settings
+from rest_framework import status
+
+from loyal.connections import connection_stats
+from loyal.models import Customer
+from .yoyo_api_testcase import YoyoAPITestCase
+
+
+class ConnectionHealthChecks(YoyoAPITestCase):
+    """
+    This class tests the checks of the connections reused by new requests
+    """
+
+    def setUp(self):
+        c = Customer(**self.new_customer)
+        c.save()
+        self.url = self.get_url(self.CUST_DET_ENDP, args=[c.pk])
+        connection_stats.reset()
+
+
+    def test_reused_connection_checked(self):
+        """
+        Test that a connection kept open from a previous request is checked before it's reused.
+        """
+
+        self.client.get(self.url)
+        self.client.get(self.url)
+
+        stats = connection_stats.stats()
+        self.assertEqual(2, stats['reused'])
+        self.assertEqual(2, stats['health_checks'])
+        self.assertEqual(0, stats['unusable'])
+
+
+    @override_settings(LOYAL_CONN_HEALTH_CHECKS=False)
+    def test_health_checks_disabled(self):
+        """
+        Test that reused connections are not checked when health checks are disabled.
+        """
+
+        self.client.get(self.url)
+        self.assertEqual((1, 0), (connection_stats.reused, connection_stats.health_checks))
+
+
+    def test_unusable_connection_closed(self):
+        """
+        Test that a connection that fails the check is closed, and the request gets a new one.
+        """
+
+        # Stubbed on the wrapper itself, django.db.connection is only a proxy to it
+        wrapper = connections[DEFAULT_DB_ALIAS]
+        closed = []
+        wrapper.is_usable = lambda: False
+        wrapper.close = lambda: closed.append(True)
+        try:
+            response = self.client.get(self.url)
+        finally:
+            del wrapper.is_usable
+            del wrapper.close
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(1, connection_stats.unusable)
+        self.assertEqual([True], closed)
@@ -0,0 +1,86 @@
+import json
+import os
+import shutil
+from StringIO import StringIO
+import tempfile
+from unittest import skipUnless
+
+from django.conf import settings
+from django.core.management import call_command
+from django.test import TestCase
+from django.test.utils import override_settings
+from rest_framework import status
+from rest_framework_swagger.docgenerator import DocumentationGenerator
+
+from loyal.docs import api_docs, code_version
+
+
+@skipUnless('rest_framework_swagger' in settings.INSTALLED_APPS, "API-only processes have no docs")
+class ApiDocs(TestCase):
+    """
+    This class tests that the API docs are generated once and served from memory
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'api-docs.json')
+        self.settings_override = override_settings(LOYAL_API_DOCS_FILE=self.filename)
+        self.settings_override.enable()
+        api_docs.reset()
+
+
+    def tearDown(self):
+        api_docs.reset()
+        self.settings_override.disable()
+        shutil.rmtree(self.directory)
+
+
+    def test_docs_generated_once(self):
+        """
+        Test that the docs are generated by the first request and stored, and later ones don't introspect the views.
+        This tests the GET endpoints /docs/api-docs/ and /docs/api-docs/loyal
+        """
+
+        response = self.client.get('/docs/api-docs/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn({'path': '/loyal'}, json.loads(response.content)['apis'])
+
+        with open(self.filename) as docs_file:
+            self.assertEqual(code_version(), json.load(docs_file)['version'])
+
+        old_generate = DocumentationGenerator.generate
+        DocumentationGenerator.generate = None
+        try:
+            response = self.client.get('/docs/api-docs/loyal')
+        finally:
+            DocumentationGenerator.generate = old_generate
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        docs = json.loads(response.content)
+        self.assertEqual('http://testserver', docs['basePath'])
+        self.assertIn('/loyal/customer/{pk}/vouchers/redeem/', [api['path'] for api in docs['apis']])
+
+
+    def test_stale_docs_rebuilt(self):
+        """
+        Test that docs stored for another version of the code are not used.
+        """
+
+        with open(self.filename, 'w') as docs_file:
+            json.dump({'version': 'old', 'resources': [], 'apis': {}}, docs_file)
+
+        self.assertIn('loyal', api_docs.get()['resources'])
+        self.assertEqual(code_version(), api_docs.load(self.filename)['version'])
+
+
+    @override_settings(LOYAL_CODE_VERSION='abc123')
+    def test_build_api_docs(self):
+        """
+        Test that the build_api_docs command stores the docs for the version given.
+        """
+
+        output = StringIO()
+        call_command('build_api_docs', stdout=output)
+
+        self.assertIn("version abc123", output.getvalue())
+        self.assertEqual('abc123', api_docs.load(self.filename)['version'])
@@ -0,0 +1,77 @@
+from django.core.urlresolvers import set_script_prefix
+from rest_framework import serializers
+from rest_framework.test import APIRequestFactory
+
+from loyal.models import Customer, Stamp
+from loyal.serializers import CustomerSerializerDetail, StampListSerializer
+from .yoyo_api_testcase import YoyoAPITestCase
+
+
+class SlowStampListSerializer(StampListSerializer):
+    to_modify = serializers.HyperlinkedIdentityField(view_name='loyal:stamp:stamp-detail')
+
+
+
+class SlowCustomerSerializerDetail(CustomerSerializerDetail):
+    stamps = serializers.HyperlinkedIdentityField(view_name='loyal:customer:stamp-list')
+    vouchers = serializers.HyperlinkedIdentityField(view_name='loyal:customer:voucher-list')
+    purchases = serializers.HyperlinkedIdentityField(view_name='loyal:customer:sale-list')
+
+
+
+class FastHyperlinks(YoyoAPITestCase):
+    """
+    This class tests that FastHyperlinkedIdentityField gives the same URLs as HyperlinkedIdentityField
+    """
+
+    def setUp(self):
+        self.customer = Customer(**self.new_customer)
+        self.customer.save()
+        for _ in xrange(3):
+            Stamp(owned_by=self.customer).save()
+        self.factory = APIRequestFactory()
+
+
+    def tearDown(self):
+        set_script_prefix('/')
+
+
+    def _assert_same(self, request):
+        stamps = list(Stamp.objects.all())
+        context = {'request': request}
+        self.assertEqual(SlowStampListSerializer(stamps, many=True, context=context).data,
+                         StampListSerializer(stamps, many=True, context=context).data)
+        self.assertEqual(SlowCustomerSerializerDetail(self.customer, context=context).data,
+                         CustomerSerializerDetail(self.customer, context=context).data)
+
+
+    def test_same_urls(self):
+        """
+        Test that the URLs are the same for plain and secure requests to other hosts and ports.
+        """
+
+        self._assert_same(self.factory.get('/loyal/stamps/'))
+        request = self.factory.get('/loyal/stamps/', HTTP_X_FORWARDED_PROTO='https', HTTP_HOST='example.com:8443')
+        self._assert_same(request)
+        url = StampListSerializer(Stamp.objects.all()[0], context={'request': request}).data['to_modify']
+        self.assertTrue(url.startswith('https://example.com:8443/loyal/stamps/'))
+
+
+    def test_script_prefix(self):
+        """
+        Test that the URLs keep the prefix of an application not mounted at the root.
+        """
+
+        set_script_prefix('/api/')
+        self._assert_same(self.factory.get('/api/loyal/stamps/'))
+        url = StampListSerializer(Stamp.objects.all()[0], context={'request': self.factory.get('/')}).data['to_modify']
+        self.assertTrue(url.startswith('http://testserver/api/loyal/stamps/'))
+
+
+    def test_without_request(self):
+        """
+        Test that serializers without a request still give relative URLs.
+        """
+
+        stamps = list(Stamp.objects.all())
+        self.assertEqual(SlowStampListSerializer(stamps, many=True).data, StampListSerializer(stamps, many=True).data)
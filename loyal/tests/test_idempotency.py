@@ -0,0 +1,154 @@
+from datetime import timedelta
+import json
+from StringIO import StringIO
+
+from django.core.management import call_command
+from django.utils import timezone
+from rest_framework import status
+
+from loyal.models import Customer, IdempotencyKey, Product, Sale, Stamp
+from .yoyo_api_testcase import YoyoAPITestCase
+
+
+class APIIdempotency(YoyoAPITestCase):
+    """
+    This class tests the Idempotency-Key header of the POST endpoints
+    """
+
+    def test_retry_replayed(self):
+        """
+        Test that retrying a stamp with the same key gives the same response without creating another stamp.
+        This tests the POST from endpoint /loyal/customer/${id}/stamps
+        """
+
+        # Create customer in DB
+        c = Customer(**self.new_customer)
+        c.save()
+
+        # Create stamp through API twice
+        url = self.get_url(self.STAMP_LIST_ENDP, args=[c.pk])
+        first = self.client.post(url, {}, HTTP_IDEMPOTENCY_KEY='till-1-0001')
+        retry = self.client.post(url, {}, HTTP_IDEMPOTENCY_KEY='till-1-0001')
+
+        # Confirm it's OK and there's only one stamp
+        self.assertEqual(first.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(retry.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(first.content, retry.content)
+        self.assertEqual('true', retry['Idempotent-Replayed'])
+        self.assertFalse(first.has_header('Idempotent-Replayed'))
+        self.assertEqual(1, Stamp.objects.count())
+        self.assertEqual(1, Customer.objects.get(pk=c.pk).total_stamps)
+
+
+    def test_different_keys(self):
+        """
+        Test that requests with different keys or without one are all run.
+        This tests the POST from endpoint /loyal/customer/${id}/stamps
+        """
+
+        # Create customer in DB
+        c = Customer(**self.new_customer)
+        c.save()
+
+        # Create stamps through API
+        url = self.get_url(self.STAMP_LIST_ENDP, args=[c.pk])
+        self.client.post(url, {}, HTTP_IDEMPOTENCY_KEY='till-1-0001')
+        self.client.post(url, {}, HTTP_IDEMPOTENCY_KEY='till-1-0002')
+        self.client.post(url, {})
+        self.client.post(url, {})
+
+        # Confirm there's one stamp per request
+        self.assertEqual(4, Stamp.objects.count())
+
+
+    def test_key_other_request(self):
+        """
+        Test that a key can't be used for a request to another endpoint.
+        This tests the POST from endpoints /loyal/customer/${id}/stamps and /loyal/customer/${id}/vouchers
+        """
+
+        # Create customer in DB
+        c = Customer(**self.new_customer)
+        c.save()
+
+        # Create a stamp and a voucher with the same key through API
+        self.client.post(self.get_url(self.STAMP_LIST_ENDP, args=[c.pk]), {}, HTTP_IDEMPOTENCY_KEY='till-1-0001')
+        response = self.client.post(self.get_url(self.VOUCH_LIST_ENDP, args=[c.pk]), {},
+                                    HTTP_IDEMPOTENCY_KEY='till-1-0001')
+
+        # Confirm it's not OK
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(0, Customer.objects.get(pk=c.pk).total_vouchers)
+
+
+    def test_key_other_data(self):
+        """
+        Test that a key can't be used again with other data, but the same data in another encoding is a retry.
+        This tests the POST from endpoint /loyal/customer/${id}/purchases/checkout
+        """
+
+        # Create customer and products in DB
+        c = Customer(**self.new_customer)
+        c.save()
+        for serial_num in ('1', '2'):
+            Product(kind=Product.WIDGET, serial_num=serial_num).save()
+
+        url = self.get_url(self.CHECKOUT_ENDP, args=[c.pk])
+        response = self.client.post(url, {'serial_nums': ['1']}, HTTP_IDEMPOTENCY_KEY='till-1-0001')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        response = self.client.post(url, {'serial_nums': ['2']}, HTTP_IDEMPOTENCY_KEY='till-1-0001')
+        self.assertEqual(422, response.status_code)
+        self.assertIsNone(Product.objects.get(serial_num='2').sale_id)
+
+        response = self.client.post(url, json.dumps({'serial_nums': ['1']}), content_type='application/json',
+                                    HTTP_IDEMPOTENCY_KEY='till-1-0001')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual('true', response['Idempotent-Replayed'])
+        self.assertEqual(1, Sale.objects.count())
+
+
+    def test_failed_request_not_stored(self):
+        """
+        Test that a request that fails can be retried with the same key.
+        This tests the POST from endpoint /loyal/customer/${id}/stamps
+        """
+
+        url = self.get_url(self.STAMP_LIST_ENDP, args=[1])
+        response = self.client.post(url, {}, HTTP_IDEMPOTENCY_KEY='till-1-0001')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(0, IdempotencyKey.objects.count())
+
+        c = Customer(**self.new_customer)
+        c.save()
+        response = self.client.post(self.get_url(self.STAMP_LIST_ENDP, args=[c.pk]), {},
+                                    HTTP_IDEMPOTENCY_KEY='till-1-0001')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+
+    def test_expired_key(self):
+        """
+        Test that an expired key runs the request again and that the purge deletes the expired keys in batches.
+        This tests the POST from endpoint /loyal/customer/${id}/stamps and the purge_idempotency_keys command
+        """
+
+        # Create customer in DB
+        c = Customer(**self.new_customer)
+        c.save()
+
+        url = self.get_url(self.STAMP_LIST_ENDP, args=[c.pk])
+        for key in ('till-1-0001', 'till-1-0002', 'till-1-0003'):
+            self.client.post(url, {}, HTTP_IDEMPOTENCY_KEY=key)
+
+        old = timezone.now() - timedelta(days=2)
+        IdempotencyKey.objects.exclude(key='till-1-0003').update(created=old)
+
+        # The expired key is stored again
+        self.client.post(url, {}, HTTP_IDEMPOTENCY_KEY='till-1-0001')
+        self.assertEqual(4, Stamp.objects.count())
+
+        out = StringIO()
+        call_command('purge_idempotency_keys', batch_size=1, stdout=out)
+        self.assertEqual("Purged 1 idempotency keys", out.getvalue().strip())
+        self.assertEqual(['till-1-0001', 'till-1-0003'],
+                         sorted(IdempotencyKey.objects.values_list('key', flat=True)))
@@ -0,0 +1,139 @@
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.test import TestCase
+from django.test.utils import override_settings
+from rest_framework import status
+from rest_framework.renderers import JSONRenderer
+from rest_framework.serializers import BaseSerializer
+from rest_framework.test import APITestCase
+
+from loyal.metrics import Histogram, request_metrics, QUERY_BUCKETS
+from loyal.models import Customer, Stamp
+
+
+class TestHistogram(TestCase):
+
+    def test_percentiles(self):
+        """
+        Test that percentiles are given with the precision of the buckets.
+        """
+
+        histogram = Histogram(QUERY_BUCKETS)
+        for value in [1] * 50 + [4] * 45 + [7] * 4 + [2000]:
+            histogram.add(value)
+
+        self.assertEqual(100, histogram.count)
+        self.assertEqual(1, histogram.percentile(50))
+        self.assertEqual(4, histogram.percentile(95))
+        self.assertEqual(10, histogram.percentile(99))
+        self.assertEqual(2000, histogram.percentile(100))
+
+
+    def test_merge(self):
+        histogram = Histogram(QUERY_BUCKETS)
+        other = Histogram(QUERY_BUCKETS)
+        histogram.add(1)
+        other.add(3)
+
+        histogram.merge(other)
+        self.assertEqual(2, histogram.count)
+        self.assertEqual(3, histogram.max)
+        self.assertEqual(3, histogram.percentile(100))
+
+
+
+# Once, even if LOYAL_METRICS has added it already
+METRICS_MIDDLEWARE = 'loyal.middleware.QueryMetricsMiddleware'
+
+
+@override_settings(LOYAL_METRICS=True, MIDDLEWARE_CLASSES=(METRICS_MIDDLEWARE,) + tuple(
+    middleware for middleware in settings.MIDDLEWARE_CLASSES if middleware != METRICS_MIDDLEWARE))
+class APIMetrics(APITestCase):
+    """
+    This class tests following endpoints
+        /metrics
+    """
+
+    def setUp(self):
+        request_metrics.reset()
+
+
+    def test_metrics_by_url_name(self):
+        """
+        Test that requests are recorded by URL name with their number of queries.
+        This tests the GET endpoint /metrics
+        """
+
+        # Create customer with some stamps
+        c = Customer(first_name="John", last_name="Doe", email="john.doe@gmail.com")
+        c.save()
+        Stamp(owned_by=c).save()
+
+        # Get the customer and its stamps twice
+        for _ in xrange(2):
+            self.client.get('/loyal/customer/{0}/'.format(c.pk))
+            self.client.get('/loyal/customer/{0}/stamps/'.format(c.pk))
+
+        # Get metrics as staff
+        user = User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.client.force_authenticate(user)
+        response = self.client.get('/metrics/')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        endpoints = response.data['endpoints']
+
+        detail = endpoints['loyal:customer:customer-detail']
+        self.assertEqual(2, detail['queries']['count'])
+        self.assertEqual(1, detail['queries']['max'])
+        self.assertEqual(2, endpoints['loyal:customer:stamp-list']['total_ms']['count'])
+        for metric in ('sql_ms', 'view_python_ms', 'serializer_ms', 'renderer_ms', 'response_ms', 'total_ms'):
+            self.assertEqual(2, detail[metric]['count'])
+            self.assertTrue(detail[metric]['max'] >= 0)
+
+
+    def test_serializer_and_renderer_times(self):
+        """
+        Test that building the data of the serializers and rendering it are timed apart from the view.
+        This tests the GET endpoint /metrics
+        """
+
+        c = Customer(first_name="John", last_name="Doe", email="john.doe@gmail.com")
+        c.save()
+        Stamp(owned_by=c).save()
+
+        # Slowed down before the first request, when the middleware times the data of the serializers
+        data = BaseSerializer.__dict__['data']
+        render = JSONRenderer.__dict__['render']
+
+        def slow_data(self):
+            time.sleep(0.02)
+            return data.fget(self)
+
+        def slow_render(self, *args, **kwargs):
+            time.sleep(0.03)
+            return render(self, *args, **kwargs)
+
+        BaseSerializer.data = property(slow_data)
+        JSONRenderer.render = slow_render
+        try:
+            self.client.get('/loyal/customer/{0}/stamps/'.format(c.pk), HTTP_ACCEPT='application/json')
+        finally:
+            BaseSerializer.data = data
+            JSONRenderer.render = render
+
+        stamps = request_metrics.summary()['loyal:customer:stamp-list']
+        self.assertTrue(stamps['serializer_ms']['max'] >= 20)
+        self.assertTrue(stamps['renderer_ms']['max'] >= 30)
+        self.assertTrue(stamps['view_python_ms']['max'] < 20)
+
+
+    def test_metrics_staff_only(self):
+        """
+        Test that metrics are not available to anonymous users.
+        This tests the GET endpoint /metrics
+        """
+
+        response = self.client.get('/metrics/')
+        self.assertIn(response.status_code, (status.HTTP_401_UNAUTHORIZED, status.HTTP_403_FORBIDDEN))
@@ -1,7 +1,14 @@
+import logging
+from StringIO import StringIO
+import time
+
+from django.core.management import call_command
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext, override_settings
 from django.utils import timezone
 
-from loyal.models import Customer, Sale, Product, Stamp, Voucher
+from loyal.models import Customer, Sale, Product, RegroupJob, Stamp, Voucher
 
 
 class TestModel(TestCase):
@@ -206,3 +213,289 @@ class TestModel(TestCase):
 
         # Confirm that there are 9 free stamps
         self.assertEqual(9, Stamp.objects.filter(grouped_in__isnull=True).count())
+
+
+
+    def test_available_stamps_counter(self):
+        """
+        Test that the customer keeps an up to date count of the stamps that have not been grouped in a voucher.
+        """
+
+        # Create a customer
+        c, _, _ = self._creation(customer=True)
+
+        # Create 25 stamps, 20 of them will be grouped in 2 vouchers
+        for _ in xrange((2 * Stamp.STAMPS_PER_VOUCHER) + 5):
+            stamp = Stamp(owned_by=c)
+            stamp.save()
+
+        # Confirm the counter matches the stamps in the DB
+        c = Customer.objects.get(pk=c.pk)
+        self.assertEqual(5, c.available_stamps)
+        self.assertEqual(5, Stamp.objects.filter(grouped_in__isnull=True).count())
+        self.assertEqual(2, Voucher.objects.count())
+
+        # Grouped stamps don't count
+        voucher = Voucher.objects.all()[0]
+        stamp = Stamp(owned_by=c, grouped_in=voucher)
+        stamp.save()
+
+        c = Customer.objects.get(pk=c.pk)
+        self.assertEqual(5, c.available_stamps)
+
+
+
+    def test_stamp_creation_constant_queries(self):
+        """
+        Test that adding a stamp costs the same number of queries regardless of the customer's stamp history.
+        """
+
+        # Create a customer
+        c, _, _ = self._creation(customer=True)
+
+        def queries_for_new_stamp():
+            with CaptureQueriesContext(connection) as queries:
+                Stamp(owned_by=c).save()
+            return len(queries)
+
+        # Second stamp of the customer
+        Stamp(owned_by=c).save()
+        first_queries = queries_for_new_stamp()
+
+        # Add 5 vouchers worth of history and check the 2nd stamp after that
+        for _ in xrange((5 * Stamp.STAMPS_PER_VOUCHER) - 1):
+            Stamp(owned_by=c).save()
+        self.assertEqual(first_queries, queries_for_new_stamp())
+
+        # The stamp completing a voucher locks the customer once
+        for _ in xrange(Stamp.STAMPS_PER_VOUCHER - 3):
+            Stamp(owned_by=c).save()
+        with CaptureQueriesContext(connection) as queries:
+            Stamp(owned_by=c).save()
+        self.assertEqual(6, Customer.objects.get(pk=c.pk).total_vouchers)
+        locks = [query['sql'] for query in queries.captured_queries if 'FOR UPDATE' in query['sql']
+                 or 'SET "version" = "loyal_customer"."version" WHERE' in query['sql']]
+        self.assertEqual(1, len(locks))
+
+
+
+    def test_customer_balance(self):
+        """
+        Test that stamps, vouchers and sales keep the customer's balance up to date.
+        """
+
+        # Create a customer, a product and a sale
+        c, p, s = self._creation(customer=True, product=True, sale=True)
+        Sale(customer=c).save()
+
+        # The sold widget got a stamp, add 10 more
+        for _ in xrange(Stamp.STAMPS_PER_VOUCHER):
+            Stamp(owned_by=c).save()
+
+        # Redeem the voucher that was generated and add a free one
+        voucher = Voucher.objects.get(owned_by=c)
+        voucher.redeemed_with = p
+        voucher.save()
+        Voucher(owned_by=c).save()
+
+        c = Customer.objects.get(pk=c.pk)
+        self.assertEqual(1, c.available_stamps)
+        self.assertEqual(11, c.total_stamps)
+        self.assertEqual(1, c.available_vouchers)
+        self.assertEqual(2, c.total_vouchers)
+        self.assertEqual(2, c.num_purchases)
+
+        # Moving a stamp to another customer moves it in the balance too
+        other, _, _ = self._creation(customer=True)
+        stamp = Stamp.objects.get(grouped_in__isnull=True)
+        stamp.owned_by = other
+        stamp.save()
+
+        self.assertEqual(0, Customer.objects.get(pk=c.pk).available_stamps)
+        self.assertEqual(1, Customer.objects.get(pk=other.pk).available_stamps)
+
+        # Saving a customer that was loaded before doesn't overwrite the balance
+        c.first_name = "Jane"
+        c.save()
+        self.assertEqual(10, Customer.objects.get(pk=c.pk).total_stamps)
+
+
+
+    def test_customer_version(self):
+        """
+        Test that every change in the history of a customer bumps its version.
+        """
+
+        c, _, s = self._creation(customer=True, sale=True)
+
+        def version():
+            return Customer.objects.values_list('version', flat=True).get(pk=c.pk)
+
+        versions = [version()]
+
+        # Selling a gizmo only changes the product
+        p = Product(**self.new_product)
+        p.kind = Product.GIZMO
+        p.save()
+        p.sale = s
+        p.save()
+        versions.append(version())
+
+        # Stamps, vouchers and the customer itself
+        stamp = Stamp(owned_by=c)
+        stamp.save()
+        versions.append(version())
+
+        Voucher(owned_by=c).save()
+        versions.append(version())
+
+        stamp.delete()
+        versions.append(version())
+
+        c.first_name = "Jane"
+        c.save()
+        versions.append(version())
+
+        self.assertEqual(versions, sorted(set(versions)))
+
+
+    def test_rebuild_balances(self):
+        """
+        Test that the balances can be rebuilt from the stamps, vouchers and sales.
+        """
+
+        # Create a customer with some history
+        c, _, _ = self._creation(customer=True, sale=True)
+        for _ in xrange(Stamp.STAMPS_PER_VOUCHER + 3):
+            Stamp(owned_by=c).save()
+        Voucher(owned_by=c).save()
+
+        # Break the balance and rebuild it
+        Customer.objects.update(available_stamps=0, total_stamps=0, available_vouchers=0,
+                                total_vouchers=0, num_purchases=0)
+        self.assertEqual(1, Customer.rebuild_balances())
+
+        c = Customer.objects.get(pk=c.pk)
+        self.assertEqual(3, c.available_stamps)
+        self.assertEqual(13, c.total_stamps)
+        self.assertEqual(2, c.available_vouchers)
+        self.assertEqual(2, c.total_vouchers)
+        self.assertEqual(1, c.num_purchases)
+
+
+    @override_settings(LOYAL_DEFERRED_VOUCHERS=True)
+    def test_deferred_vouchers(self):
+        """
+        Test that with deferred vouchers adding stamps only enqueues one job per customer, and the worker
+        converts them into vouchers later.
+        """
+
+        c, _, _ = self._creation(customer=True)
+        other = Customer(**self.new_customer)
+        other.save()
+
+        for _ in xrange(2 * Stamp.STAMPS_PER_VOUCHER + 1):
+            Stamp(owned_by=c).save()
+        Stamp(owned_by=other).save()
+
+        self.assertEqual(0, Voucher.objects.count())
+        self.assertEqual(2, RegroupJob.objects.count())
+        self.assertEqual(21, Customer.objects.get(pk=c.pk).available_stamps)
+
+        # Run the jobs one at a time
+        self.assertEqual(1, RegroupJob.run_batch(1))
+        self.assertEqual(1, RegroupJob.run_batch(5))
+        self.assertEqual(0, RegroupJob.run_batch(5))
+
+        c = Customer.objects.get(pk=c.pk)
+        self.assertEqual((1, 2), (c.available_stamps, c.total_vouchers))
+        self.assertEqual(2, Voucher.objects.filter(owned_by=c).count())
+        self.assertEqual(1, Customer.objects.get(pk=other.pk).available_stamps)
+
+        # The worker drains the queue
+        for _ in xrange(Stamp.STAMPS_PER_VOUCHER - 1):
+            Stamp(owned_by=other).save()
+        out = StringIO()
+        call_command('run_loyalty_worker', once=True, stdout=out)
+        self.assertEqual("Ran 1 regroup jobs", out.getvalue().strip())
+        self.assertEqual(1, Voucher.objects.filter(owned_by=other).count())
+
+
+    def _worker_waits(self, polls):
+        # Seconds the worker waits between its first polls of the queue
+        waits = []
+
+        def sleep(seconds):
+            waits.append(seconds)
+            if len(waits) == polls:
+                raise KeyboardInterrupt
+
+        original = time.sleep
+        time.sleep = sleep
+        try:
+            call_command('run_loyalty_worker', interval=1, max_interval=5, stdout=StringIO())
+        finally:
+            time.sleep = original
+        return waits
+
+
+    def test_worker_backoff(self):
+        """
+        Test that the worker waits longer while the queue stays empty, and the longest without deferred vouchers.
+        """
+
+        with override_settings(LOYAL_DEFERRED_VOUCHERS=True):
+            self.assertEqual([1, 2, 4, 5, 5], self._worker_waits(5))
+        self.assertEqual([5, 5], self._worker_waits(2))
+
+
+    @override_settings(LOYAL_DEFERRED_VOUCHERS=True)
+    def test_failed_regroup_job(self):
+        """
+        Test that a job that fails is retried later while the jobs of other customers still run.
+        """
+
+        failing, _, _ = self._creation(customer=True)
+        other = Customer(**self.new_customer)
+        other.save()
+        for customer in (failing, other):
+            for _ in xrange(Stamp.STAMPS_PER_VOUCHER):
+                Stamp(owned_by=customer).save()
+
+        group_into_vouchers = Stamp.__dict__['group_into_vouchers']
+
+        def fail_for_one(cls, customer_id):
+            if customer_id == failing.pk:
+                raise ValueError("Regrouping failed")
+            return group_into_vouchers.__func__(cls, customer_id)
+
+        # Keep the errors logged instead of printing them
+        logged = []
+        handler = logging.Handler()
+        handler.emit = logged.append
+        logger = logging.getLogger('loyal.models')
+        logger.addHandler(handler)
+        logger.propagate = False
+
+        Stamp.group_into_vouchers = classmethod(fail_for_one)
+        try:
+            self.assertEqual(2, RegroupJob.run_batch(5))
+        finally:
+            Stamp.group_into_vouchers = group_into_vouchers
+            logger.removeHandler(handler)
+            logger.propagate = True
+
+        self.assertEqual(1, len(logged))
+
+        self.assertEqual(1, Voucher.objects.filter(owned_by=other).count())
+        self.assertEqual(0, Voucher.objects.filter(owned_by=failing).count())
+        job = RegroupJob.objects.get()
+        self.assertEqual((failing.pk, 1), (job.customer_id, job.attempts))
+        self.assertTrue(job.run_after > timezone.now())
+
+        # It waits for its retry
+        self.assertEqual(0, RegroupJob.run_batch(5))
+        RegroupJob.objects.update(run_after=timezone.now())
+        self.assertEqual(1, RegroupJob.run_batch(5))
+        self.assertEqual(1, Voucher.objects.filter(owned_by=failing).count())
+        self.assertFalse(RegroupJob.objects.exists())
@@ -0,0 +1,137 @@
+import os
+import shutil
+import tempfile
+
+from django.core.cache import cache, get_cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import connections
+from django.test.utils import override_settings
+from rest_framework import status
+
+from loyal.cache import customer_cache
+from loyal.middleware import ReplicaMiddleware
+from loyal.models import Customer, Stamp
+from .yoyo_api_testcase import YoyoAPITestCase
+
+
+PIN_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'loyal-test-replica-pins')
+
+
+@override_settings(LOYAL_REPLICAS=['replica'], LOYAL_REPLICA_STICKY_SECONDS=60, LOYAL_REPLICA_PIN_CACHE='pins',
+                   CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+                           'pins': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+                                    'LOCATION': PIN_CACHE_DIR}})
+class ReadReplicas(YoyoAPITestCase):
+    """
+    This class tests that GET requests read from the replicas, except for customers written recently.
+    The replica is a second SQLite file that we update by hand, so we can tell where each read went.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super(ReadReplicas, cls).setUpClass()
+        cls.directory = tempfile.mkdtemp()
+        connections.databases['replica'] = {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.path.join(cls.directory, 'replica.sqlite3'),
+        }
+        call_command('syncdb', database='replica', interactive=False, verbosity=0)
+
+
+    @classmethod
+    def tearDownClass(cls):
+        connections['replica'].close()
+        del connections['replica']
+        del connections.databases['replica']
+        shutil.rmtree(cls.directory)
+        shutil.rmtree(PIN_CACHE_DIR, ignore_errors=True)
+        super(ReadReplicas, cls).tearDownClass()
+
+
+    def setUp(self):
+        cache.clear()
+        get_cache('pins').clear()
+        if customer_cache.backend is not None:
+            customer_cache.backend.clear()
+
+        # The replica has the customer, but not its latest stamp yet
+        self.customer = Customer(**self.new_customer)
+        self.customer.save()
+        Customer.objects.using('replica').bulk_create([Customer(pk=self.customer.pk, **self.new_customer)])
+        Stamp(owned_by=self.customer).save()
+        cache.clear()
+
+
+    def tearDown(self):
+        Customer.objects.using('replica').all().delete()
+
+
+    def _available_stamps(self):
+        response = self.client.get(self.get_url(self.CUST_DET_ENDP, args=[self.customer.pk]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data['available_stamps']
+
+
+    def test_reads_from_replica(self):
+        """
+        Test that reading a customer not written recently goes to the replica.
+        This tests the GET endpoint /loyal/customer/${id}
+        """
+
+        self.assertEqual(0, self._available_stamps())
+
+
+    def test_read_your_writes(self):
+        """
+        Test that after adding a stamp to a customer, its reads go to the default database until the pin expires.
+        This tests the POST endpoint /loyal/customer/${id}/stamps and the GET endpoint /loyal/customer/${id}
+        """
+
+        response = self.client.post(self.get_url(self.STAMP_LIST_ENDP, args=[self.customer.pk]), {})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(2, self._available_stamps())
+
+        # Other customers still read from the replica
+        other = Customer(**self.new_customer)
+        other.save()
+        response = self.client.get(self.get_url(self.CUST_DET_ENDP, args=[other.pk]))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+        cache.clear()
+        get_cache('pins').clear()
+        self.assertEqual(0, self._available_stamps())
+
+
+    def test_read_your_detail_writes(self):
+        """
+        Test that after changing a stamp through its detail view, its reads go to the default database, while the
+        stamps that weren't changed there are still read from the replica, which doesn't have them yet.
+        This tests the PUT and GET endpoints /loyal/stamps/${id}
+        """
+
+        changed = Stamp.objects.get(owned_by=self.customer)
+        unchanged = Stamp(owned_by=self.customer)
+        unchanged.save()
+        get_cache('pins').clear()
+
+        url = self.get_non_customer_url(self.STAMP_ENDP, args=[changed.pk])
+        response = self.client.put(url, {'owned_by': self.customer.pk})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        response = self.client.get(self.get_non_customer_url(self.STAMP_ENDP, args=[unchanged.pk]))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+    def test_pins_must_be_shared(self):
+        """
+        Test that processes don't start with replicas if the pins are only kept in each process.
+        """
+
+        ReplicaMiddleware()
+        with self.settings(LOYAL_REPLICA_PIN_CACHE='default'):
+            self.assertRaises(ImproperlyConfigured, ReplicaMiddleware)
+        with self.settings(LOYAL_REPLICAS=[], LOYAL_REPLICA_PIN_CACHE='default'):
+            ReplicaMiddleware()
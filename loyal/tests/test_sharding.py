@@ -0,0 +1,295 @@
+from datetime import timedelta
+import os
+import shutil
+from StringIO import StringIO
+import tempfile
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.core.urlresolvers import reverse
+from django.db import connections
+from django.db.models.signals import post_save
+from django.test.utils import override_settings
+from django.utils import timezone
+from rest_framework import status
+
+from loyal import routers
+from loyal.models import Customer, IdempotencyKey, Product, Sale, Stamp, Voucher
+from .yoyo_api_testcase import YoyoAPITestCase
+
+
+@override_settings(LOYAL_SHARDS=['default', 'shard1'])
+class Sharding(YoyoAPITestCase):
+    """
+    This class tests that customers and their rows are spread by id over the shards and that the global lists
+    go through all of them. The second shard is another SQLite file.
+    """
+
+    multi_db = True
+
+    @classmethod
+    def setUpClass(cls):
+        super(Sharding, cls).setUpClass()
+        cls.directory = tempfile.mkdtemp()
+        connections.databases['shard1'] = {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.path.join(cls.directory, 'shard1.sqlite3'),
+        }
+        call_command('syncdb', database='shard1', interactive=False, verbosity=0)
+
+
+    @classmethod
+    def tearDownClass(cls):
+        connections['shard1'].close()
+        del connections['shard1']
+        del connections.databases['shard1']
+        shutil.rmtree(cls.directory)
+        super(Sharding, cls).tearDownClass()
+
+
+    def _customer_in(self, alias):
+        # New customers are put in a shard at random
+        while True:
+            customer = Customer(**self.new_customer)
+            customer.save()
+            if routers.shard_for(customer.pk) == alias:
+                return customer
+
+
+    def _product(self, serial_num, kind=Product.WIDGET):
+        product = Product(**dict(self.new_product, serial_num=serial_num, kind=kind))
+        product.save()
+        return product
+
+
+    def test_customer_rows_in_its_shard(self):
+        """
+        Test that a customer, its stamps and its vouchers are only written to its shard.
+        This tests the POST endpoint /loyal/customer/${id}/stamps and the GET endpoint /loyal/customer/${id}
+        """
+
+        customer = self._customer_in('shard1')
+        self.assertFalse(Customer.objects.using('default').filter(pk=customer.pk).exists())
+
+        url = self.get_url(self.STAMP_LIST_ENDP, args=[customer.pk])
+        for _ in xrange(Stamp.STAMPS_PER_VOUCHER):
+            response = self.client.post(url, {})
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        self.assertEqual(10, Stamp.objects.using('shard1').filter(owned_by=customer.pk).count())
+        self.assertEqual(1, Voucher.objects.using('shard1').filter(owned_by=customer.pk).count())
+        self.assertFalse(Stamp.objects.using('default').exists())
+
+        response = self.client.get(self.get_url(self.CUST_DET_ENDP, args=[customer.pk]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual((0, 1), (response.data['available_stamps'], response.data['available_vouchers']))
+
+        other = self._customer_in('default')
+        response = self.client.get(self.get_url(self.CUST_LIST_ENDP))
+        expected = sorted(pk for alias in routers.shards()
+                          for pk in Customer.objects.using(alias).values_list('pk', flat=True))
+        self.assertEqual(expected, [data['id'] for data in response.data])
+        self.assertTrue(set([customer.pk, other.pk]) <= set(expected))
+
+
+    def test_checkout_and_redeem_move_products(self):
+        """
+        Test that products sold or redeemed by a customer of another shard are moved there from the catalog.
+        This tests the POST endpoints /loyal/customer/${id}/purchases/checkout and /loyal/customer/${id}/vouchers/redeem
+        """
+
+        customer = self._customer_in('shard1')
+        serial_nums = [str(number) for number in xrange(Stamp.STAMPS_PER_VOUCHER)]
+        for serial_num in serial_nums:
+            self._product(serial_num)
+        gizmo = self._product('gizmo', Product.GIZMO)
+
+        response = self.client.post(self.get_url(self.CHECKOUT_ENDP, args=[customer.pk]), {'serial_nums': serial_nums})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(['gizmo'], list(Product.objects.using('default').values_list('serial_num', flat=True)))
+        self.assertEqual(10, Product.objects.using('shard1').filter(sale__customer=customer.pk).count())
+
+        # Selling them again finds them in the shard
+        response = self.client.post(self.get_url(self.CHECKOUT_ENDP, args=[customer.pk]), {'serial_nums': ['1']})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = self.client.post(self.get_url(self.REDEEM_ENDP, args=[customer.pk]), {'serial_num': 'gizmo'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(gizmo.pk, response.data['redeemed_with'])
+        self.assertFalse(Product.objects.using('default').exists())
+        self.assertTrue(Voucher.objects.using('shard1').filter(redeemed_with=gizmo.pk).exists())
+
+        # The product is found in its shard
+        response = self.client.get(self.get_non_customer_url(self.PRODUCT_ENDP, args=[gizmo.pk]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual('gizmo', response.data['serial_num'])
+
+
+    def test_failed_checkout_keeps_products(self):
+        """
+        Test that products moved from the catalog stay in it when the sale fails after moving them.
+        """
+
+        customer = self._customer_in('shard1')
+        self._product('1')
+
+        class GroupingFailed(Exception):
+            pass
+
+        def fail_grouping(cls, customer_id):
+            raise GroupingFailed
+
+        schedule_grouping = Stamp.__dict__['schedule_grouping']
+        Stamp.schedule_grouping = classmethod(fail_grouping)
+        try:
+            self.assertRaises(GroupingFailed, Sale.checkout, customer.pk, ['1'])
+        finally:
+            Stamp.schedule_grouping = schedule_grouping
+        self.assertEqual(['1'], list(Product.objects.using('default').values_list('serial_num', flat=True)))
+        self.assertFalse(Product.objects.using('shard1').exists())
+        self.assertFalse(Sale.objects.using('shard1').exists())
+
+        Sale.checkout(customer.pk, ['1'])
+        self.assertFalse(Product.objects.using('default').exists())
+        self.assertEqual(1, Product.objects.using('shard1').filter(sale__customer=customer.pk).count())
+
+
+    def test_update_refuses_rows_of_other_shards(self):
+        """
+        Test that a PUT relating a row to one of another shard is refused saying so, products of the catalog are
+        sold and redeemed to customers of other shards with their checkout and voucher redeem.
+        This tests the PUT endpoints /loyal/products/${id} and /loyal/vouchers/${id}
+        """
+
+        customer = self._customer_in('shard1')
+        product = self._product('1')
+        response = self.client.post(self.get_url(self.SALE_LIST_ENDP, args=[customer.pk]), {})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        sale_id = Sale.objects.using('shard1').get(customer=customer.pk).pk
+
+        url = self.get_non_customer_url(self.PRODUCT_ENDP, args=[product.pk])
+        response = self.client.put(url, {'kind': Product.WIDGET, 'serial_num': '1', 'sale': sale_id})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('checkout', response.data['sale'][0])
+        self.assertIsNone(Product.objects.using('default').get(pk=product.pk).sale_id)
+
+        voucher = Voucher(owned_by=customer)
+        voucher.save()
+        url = self.get_non_customer_url(self.VOUCHER_ENDP, args=[voucher.pk])
+        response = self.client.put(url, {'owned_by': customer.pk, 'redeemed_with': product.pk})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('redeem', response.data['redeemed_with'][0])
+        self.assertIsNone(Voucher.objects.using('shard1').get(pk=voucher.pk).redeemed_with_id)
+
+        # Rows of its own shard are still fine
+        response = self.client.put(url, {'owned_by': customer.pk})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+    def test_global_list_merges_shards(self):
+        """
+        Test that paging through all the stamps returns the stamps of every shard once, by id.
+        This tests the GET endpoint /loyal/stamps
+        """
+
+        for alias, count in (('default', 3), ('shard1', 4)):
+            customer = self._customer_in(alias)
+            for _ in xrange(count):
+                Stamp(owned_by=customer).save()
+
+        expected = sorted((pk, index) for index, alias in enumerate(routers.shards())
+                          for pk in Stamp.objects.using(alias).values_list('pk', flat=True))
+
+        seen = []
+        url = reverse('loyal:stamp:stamp-list') + '?page_size=2'
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            seen.extend((stamp['id'], stamp['owned_by']) for stamp in response.data['results'])
+            url = response.data['next']
+
+        self.assertEqual([pk for pk, _ in expected], [pk for pk, _ in seen])
+        self.assertEqual(len(set(seen)), len(seen))
+
+
+    def test_ids_unique_across_shards(self):
+        """
+        Test that stamps and vouchers of different shards don't share ids, so a detail view changes the one of
+        its URL, even the first stamp of the second shard, which its own table would number like the first one of
+        the default database.
+        This tests the GET and PUT endpoints /loyal/stamps/${id} and /loyal/vouchers/${id}
+        """
+
+        default_customer = self._customer_in('default')
+        shard_customer = self._customer_in('shard1')
+        default_stamp = Stamp(owned_by=default_customer)
+        default_stamp.save()
+        shard_stamp = Stamp(owned_by=shard_customer)
+        shard_stamp.save()
+        default_voucher = Voucher(owned_by=default_customer)
+        default_voucher.save()
+        shard_voucher = Voucher(owned_by=shard_customer)
+        shard_voucher.save()
+
+        self.assertNotEqual(default_stamp.pk, shard_stamp.pk)
+        self.assertNotEqual(default_voucher.pk, shard_voucher.pk)
+        for obj in (default_customer, default_stamp, default_voucher, shard_customer, shard_stamp, shard_voucher):
+            self.assertEqual(obj._state.db, routers.shard_for(obj.pk))
+
+        url = self.get_non_customer_url(self.STAMP_ENDP, args=[shard_stamp.pk])
+        response = self.client.put(url, {'owned_by': shard_customer.pk, 'grouped_in': shard_voucher.pk})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(shard_customer.pk, response.data['owned_by'])
+        self.assertEqual(shard_voucher.pk, Stamp.objects.using('shard1').get(pk=shard_stamp.pk).grouped_in_id)
+        self.assertIsNone(Stamp.objects.using('default').get(pk=default_stamp.pk).grouped_in_id)
+
+        response = self.client.get(self.get_non_customer_url(self.VOUCHER_ENDP, args=[shard_voucher.pk]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(shard_customer.pk, response.data['owned_by'])
+
+
+    def test_idempotency_keys_in_shard(self):
+        """
+        Test that idempotency keys are stored in the shard of the customer, in the same transaction as the stamp,
+        so a request that fails after adding the stamp doesn't keep it.
+        This tests the POST endpoint /loyal/customer/${id}/stamps and the purge_idempotency_keys command
+        """
+
+        customer = self._customer_in('shard1')
+        url = self.get_url(self.STAMP_LIST_ENDP, args=[customer.pk])
+
+        class StoreFailed(Exception):
+            pass
+
+        def fail_storing(sender, instance, update_fields=None, **kwargs):
+            if update_fields and 'response' in update_fields:
+                raise StoreFailed
+
+        post_save.connect(fail_storing, sender=IdempotencyKey)
+        try:
+            self.assertRaises(StoreFailed, self.client.post, url, {}, HTTP_IDEMPOTENCY_KEY='till-1-0001')
+        finally:
+            post_save.disconnect(fail_storing, sender=IdempotencyKey)
+        self.assertFalse(Stamp.objects.using('shard1').exists())
+        self.assertFalse(IdempotencyKey.objects.using('shard1').exists())
+
+        for _ in xrange(2):
+            response = self.client.post(url, {}, HTTP_IDEMPOTENCY_KEY='till-1-0001')
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(1, Stamp.objects.using('shard1').count())
+        self.assertEqual(['till-1-0001'], list(IdempotencyKey.objects.using('shard1').values_list('key', flat=True)))
+        self.assertFalse(IdempotencyKey.objects.using('default').exists())
+
+        IdempotencyKey.objects.using('shard1').update(created=timezone.now() - timedelta(days=2))
+        call_command('purge_idempotency_keys', stdout=StringIO())
+        self.assertFalse(IdempotencyKey.objects.using('shard1').exists())
+
+
+    def test_bulk_commands_refused(self):
+        """
+        Test that the commands loading or dumping rows in bulk refuse to run, they only know the default database.
+        """
+
+        for name, args in (('populate_db', []), ('import_loyalty', [self.directory]),
+                           ('export_loyalty', [self.directory])):
+            self.assertRaises(CommandError, call_command, name, *args, stdout=StringIO())
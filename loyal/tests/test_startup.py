@@ -0,0 +1,42 @@
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.urlresolvers import get_resolver
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from loyal import startup
+
+
+class Startup(TestCase):
+    """
+    This class tests the warm up of the web processes
+    """
+
+    @override_settings(LOYAL_API_DOCS_FILE=None)
+    def test_warm_up(self):
+        """
+        Test that the middleware and URL patterns are loaded before the first request.
+        """
+
+        handler = WSGIHandler()
+        startup.warm_up(handler)
+
+        self.assertIsNotNone(handler._request_middleware)
+        self.assertTrue(get_resolver(None)._populated)
+
+
+    def test_connect_databases(self):
+        """
+        Test that the databases with persistent connections are connected.
+        """
+
+        old_max_age = connection.settings_dict.get('CONN_MAX_AGE', 0)
+        try:
+            connection.settings_dict['CONN_MAX_AGE'] = 0
+            self.assertNotIn('default', startup.connect_databases())
+
+            connection.settings_dict['CONN_MAX_AGE'] = 600
+            self.assertIn('default', startup.connect_databases())
+            self.assertIsNotNone(connection.connection)
+        finally:
+            connection.settings_dict['CONN_MAX_AGE'] = old_max_age
@@ -0,0 +1,97 @@
+from collections import OrderedDict
+import json
+
+from django.core.urlresolvers import reverse
+from rest_framework import status
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIRequestFactory
+
+from loyal.models import Customer, Product, Sale, Stamp, Voucher
+from loyal.serializers import (ProductSerializer, ProductValuesSerializer, StampListSerializer, StampValuesSerializer,
+                               VoucherListSerializer, VoucherValuesSerializer)
+from .yoyo_api_testcase import YoyoAPITestCase
+
+
+class ValuesSerializers(YoyoAPITestCase):
+    """
+    This class tests that the list views serialized from values_list() rows give the same JSON as the
+    ModelSerializers, field by field and in the same order.
+    """
+
+    def setUp(self):
+        customer = Customer(**self.new_customer)
+        customer.save()
+        sale = Sale(customer=customer)
+        sale.save()
+
+        products = []
+        for number in xrange(6):
+            product = Product(**dict(self.new_product, serial_num=str(number), kind=number % 2,
+                                     sale=sale if number < 3 else None))
+            product.save()
+            products.append(product)
+
+        voucher = Voucher(owned_by=customer, redeemed_with=products[3])
+        voucher.save()
+        Voucher(owned_by=customer).save()
+        for product in products[4:]:
+            Stamp(owned_by=customer, obtained_with=product, grouped_in=voucher).save()
+        Stamp(owned_by=customer).save()
+
+
+    def _assert_same_json(self, view_name, model, serializer_class):
+        response = self.client.get(reverse(view_name) + '?page_size=100')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        objects = list(model.objects.order_by('pk'))
+        request = APIRequestFactory().get(reverse(view_name))
+        expected = JSONRenderer().render(serializer_class(objects, many=True, context={'request': request}).data)
+        results = json.loads(response.content, object_pairs_hook=OrderedDict)['results']
+        self.assertEqual(json.loads(expected, object_pairs_hook=OrderedDict), results)
+        self.assertEqual([obj.pk for obj in objects], [row['id'] for row in results])
+
+
+    def test_same_json(self):
+        """
+        Test that the lists give the same JSON as their ModelSerializers.
+        This tests the GET endpoints /loyal/products, /loyal/stamps and /loyal/vouchers
+        """
+
+        self._assert_same_json('loyal:product:product-list', Product, ProductSerializer)
+        self._assert_same_json('loyal:stamp:stamp-list', Stamp, StampListSerializer)
+        self._assert_same_json('loyal:voucher:voucher-list', Voucher, VoucherListSerializer)
+
+
+    def test_rows(self):
+        """
+        Test that only the columns of the serializer are read, and which database they come from.
+        """
+
+        for model, serializer_class in ((Product, ProductValuesSerializer), (Stamp, StampValuesSerializer),
+                                        (Voucher, VoucherValuesSerializer)):
+            rows = serializer_class.fetch(model.objects.all())
+            self.assertEqual(model.objects.count(), len(rows))
+            self.assertEqual(serializer_class.columns, rows[0]._fields)
+            self.assertEqual('default', rows[0].db)
+
+
+    def test_paging_and_create(self):
+        """
+        Test that the next pages follow the rows, and that products are still created with ProductSerializer.
+        This tests the GET and POST endpoints /loyal/products
+        """
+
+        url = reverse('loyal:product:product-list') + '?page_size=4'
+        seen = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            seen.extend(product['serial_num'] for product in response.data['results'])
+            url = response.data['next']
+        self.assertEqual([str(number) for number in xrange(6)], seen)
+
+        response = self.client.post(reverse('loyal:product:product-list'),
+                                    {'kind': Product.GIZMO, 'serial_num': 'new'})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual('new', response.data['serial_num'])
+        self.assertIn('kind_name', response.data)
@@ -19,6 +19,9 @@ class YoyoAPITestCase(APITestCase):
     VOUCHER_ENDP    = 5
     PRODUCT_ENDP    = 6
     STAMP_ENDP      = 7
+    CHECKOUT_ENDP   = 8
+    HISTORY_ENDP    = 9
+    REDEEM_ENDP     = 10
 
     namespace_path = ['loyal', 'customer']
 
@@ -32,6 +35,9 @@ class YoyoAPITestCase(APITestCase):
         VOUCHER_ENDP    :'voucher:voucher-detail',
         PRODUCT_ENDP    :'product:product-detail',
         STAMP_ENDP      :'stamp:stamp-detail',
+        CHECKOUT_ENDP   :'checkout',
+        HISTORY_ENDP    :'history',
+        REDEEM_ENDP     :'voucher-redeem',
     }
 
 
@@ -1,11 +1,14 @@
 from django.conf.urls import patterns, url, include
 
-from loyal.views import CustomerListView, CustomerDetailView, StampList, VoucherListView, SaleListView
+from loyal.views import CustomerListView, CustomerDetailView, StampList, VoucherListView, VoucherRedeemView, SaleListView, CheckoutView, HistoryView
 
 urlpatterns = patterns('',
                        url(r'^$', CustomerListView.as_view(), name='customer-list'),
                        url(r'^(?P<pk>[0-9]+)/?$', CustomerDetailView.as_view(), name='customer-detail'),
                        url(r'^(?P<pk>[0-9]+)/stamps/?$', StampList.as_view(), name='stamp-list'),
                        url(r'^(?P<pk>[0-9]+)/vouchers/?$', VoucherListView.as_view(), name='voucher-list'),
+                       url(r'^(?P<pk>[0-9]+)/vouchers/redeem/?$', VoucherRedeemView.as_view(), name='voucher-redeem'),
                        url(r'^(?P<pk>[0-9]+)/purchases/?$', SaleListView.as_view(), name='sale-list'),
+                       url(r'^(?P<pk>[0-9]+)/purchases/checkout/?$', CheckoutView.as_view(), name='checkout'),
+                       url(r'^(?P<pk>[0-9]+)/history/?$', HistoryView.as_view(), name='history'),
 )
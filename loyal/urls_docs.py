@@ -0,0 +1,11 @@
+from django.conf.urls import patterns, url
+
+from loyal.docs import CachedSwaggerApiView, CachedSwaggerResourcesView
+from rest_framework_swagger.views import SwaggerUIView
+
+# Same names as rest_framework_swagger.urls, which the UI uses
+urlpatterns = patterns('',
+                       url(r'^$', SwaggerUIView.as_view(), name='django.swagger.base.view'),
+                       url(r'^api-docs/$', CachedSwaggerResourcesView.as_view(), name='django.swagger.resources.view'),
+                       url(r'^api-docs/(?P<path>.*)/?$', CachedSwaggerApiView.as_view(), name='django.swagger.api.view'),
+)
@@ -3,3 +3,4 @@ from .view_stamp import *
 from .view_voucher import *
 from .view_sale import *
 from .view_product import *
+from .view_history import *
@@ -1,7 +1,11 @@
 from django.shortcuts import render
+from loyal.cache import customer_cache
+from loyal.conditional import CustomerConditionalMixin
 from loyal.models import Customer
 from loyal.serializers import CustomerSerializerList, CustomerSerializerDetail
+from loyal.sharding import from_all_shards
 from rest_framework import generics
+from rest_framework.response import Response
 
 # Create your views here.
 class CustomerListView(generics.ListCreateAPIView):
@@ -12,10 +16,29 @@ class CustomerListView(generics.ListCreateAPIView):
     queryset = Customer.objects.all()
     serializer_class = CustomerSerializerList
 
-class CustomerDetailView(generics.RetrieveAPIView):
+    def get_queryset(self):
+        return from_all_shards(super(CustomerListView, self).get_queryset())
+
+class CustomerDetailView(CustomerConditionalMixin, generics.RetrieveAPIView):
     """
     This endpoint shows detailed information of one customer.
+    Responses have an ETag, so unchanged customers can be polled with If-None-Match.
     """
 
     queryset = Customer.objects.all()
     serializer_class = CustomerSerializerDetail
+
+    def get_object(self, queryset=None):
+        return self.get_customer()
+
+    def retrieve(self, request, *args, **kwargs):
+        # The payload only depends on the customer, so we build it once per version
+        customer = self.get_object()
+        base_url = request.build_absolute_uri('/')
+
+        data = customer_cache.get(customer, base_url)
+        if data is None:
+            data = self.get_serializer(customer).data
+            customer_cache.set(customer, base_url, data)
+
+        return Response(data)
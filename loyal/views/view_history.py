@@ -0,0 +1,144 @@
+import base64
+import binascii
+import calendar
+import heapq
+from itertools import islice
+import json
+
+from django.core.exceptions import ValidationError
+from django.http import Http404
+from django.utils.datastructures import SortedDict
+from rest_framework import generics
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.templatetags.rest_framework import replace_query_param
+
+from loyal.conditional import CustomerConditionalMixin
+from loyal.filters import DateRangeFilter
+from loyal.models import Sale, Stamp, Voucher
+from loyal.pagination import KeysetPaginationMixin
+from loyal.serializers import SaleSerializer, StampSerializer, VoucherSerializer
+
+
+class HistoryView(CustomerConditionalMixin, KeysetPaginationMixin, generics.ListAPIView):
+    """
+    This endpoint gives the transaction history of a customer, latest first: purchases, stamps and vouchers.
+        type: Whether the event is a purchase, a stamp or a voucher
+    The history can be filtered by date and is paginated.
+        since: Only events from this date on
+        until: Only events before this date
+        cursor: Where to start, as given in the next link
+        page_size: Number of events per page
+    Responses have an ETag, so an unchanged history can be polled with If-None-Match.
+    """
+
+    # Type, model, serializer and queryset method of each stream, events with the same date go in this order
+    STREAMS = (
+        ('purchase', Sale, SaleSerializer, 'sale_set'),
+        ('stamp', Stamp, StampSerializer, 'stamp_set'),
+        ('voucher', Voucher, VoucherSerializer, 'voucher_set'),
+    )
+
+    paginate_by = 50
+    renderer_classes = api_settings.DEFAULT_RENDERER_CLASSES
+    filter_backends = (DateRangeFilter,)
+    keyset_ordering = ('-date', '-pk')
+
+
+    def get_serializer_class(self):
+        # Only asked for by the API docs, every type of event has its own serializer
+        return SaleSerializer
+
+
+    def encode_cursor(self, event):
+        kind, obj = event
+        return base64.urlsafe_b64encode(json.dumps([obj.date.isoformat(), kind, obj.pk]))
+
+
+    def decode_cursor(self, cursor):
+        try:
+            date, kind, pk = json.loads(base64.urlsafe_b64decode(str(cursor)))
+            rank = [stream[0] for stream in self.STREAMS].index(kind)
+            return Sale._meta.get_field('date').to_python(date), rank, int(pk)
+        except (TypeError, ValueError, binascii.Error, ValidationError):
+            raise Http404("Invalid cursor")
+
+
+    def get_streams(self, customer, page_size, cursor=None):
+        """
+        Querysets with the next page_size + 1 events of every stream, the most a page can take from one stream.
+        """
+
+        streams = []
+        for rank, (kind, model, _, related_name) in enumerate(self.STREAMS):
+            queryset = self.filter_queryset(getattr(customer, related_name).all())
+            if model is Sale:
+                queryset = queryset.prefetch_related('product_set')
+
+            if cursor is not None:
+                date, cursor_rank, pk = cursor
+                if rank == cursor_rank:
+                    queryset = self.after_values(queryset, [date, pk])
+                elif rank > cursor_rank:
+                    queryset = queryset.filter(date__lte=date)
+                else:
+                    queryset = queryset.filter(date__lt=date)
+
+            streams.append(queryset.order_by(*self.keyset_ordering)[:page_size + 1])
+
+        return streams
+
+
+    def merge(self, streams):
+        """
+        Merge the streams, each one sorted by date and pk descending, into a single sorted stream of
+        (type, object) events.
+        """
+
+        def decorated(rank, queryset):
+            kind = self.STREAMS[rank][0]
+            for obj in queryset:
+                timestamp = calendar.timegm(obj.date.utctimetuple()) * 1000000 + obj.date.microsecond
+                yield (-timestamp, rank, -obj.pk), kind, obj
+
+        for _, kind, obj in heapq.merge(*[decorated(rank, queryset) for rank, queryset in enumerate(streams)]):
+            yield kind, obj
+
+
+    def serialize(self, events):
+        """
+        Serialize the events of each type at once, keeping the order of the page.
+        """
+
+        serialized = {}
+        for kind, _, serializer_class, _ in self.STREAMS:
+            objects = [obj for event_kind, obj in events if event_kind == kind]
+            serializer = serializer_class(objects, many=True, context=self.get_serializer_context())
+            serialized[kind] = iter(serializer.data)
+
+        data = []
+        for kind, _ in events:
+            event = SortedDict([('type', kind)])
+            event.update(next(serialized[kind]))
+            data.append(event)
+
+        return data
+
+
+    def list(self, request, *args, **kwargs):
+        customer = self.get_customer()
+        page_size = self.get_paginate_by()
+        cursor = request.QUERY_PARAMS.get(self.cursor_param)
+        if cursor:
+            cursor = self.decode_cursor(cursor)
+
+        # Sources are read lazily, we only take one extra event to know if there's a next page
+        events = list(islice(self.merge(self.get_streams(customer, page_size, cursor)), page_size + 1))
+
+        next_link = None
+        if len(events) > page_size:
+            events = events[:page_size]
+            next_link = replace_query_param(request.build_absolute_uri(), self.cursor_param,
+                                            self.encode_cursor(events[-1]))
+
+        return Response({'next': next_link, 'results': self.serialize(events)})
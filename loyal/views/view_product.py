@@ -1,22 +1,34 @@
 from loyal.models import Product
-from loyal.serializers import ProductSerializer, ProductDetailSerializer
+from loyal.serializers import ProductSerializer, ProductDetailSerializer, ProductValuesSerializer
 from rest_framework import generics
+from loyal.pagination import ShardedKeysetPaginationMixin, ValuesListMixin
+from loyal.sharding import ShardedObjectMixin
 
 # Create your views here.
-class ProductListView(generics.ListCreateAPIView):
+class ProductListView(ValuesListMixin, ShardedKeysetPaginationMixin, generics.ListCreateAPIView):
     """
-    This endpoint lists the products in the system and allows creation of new products.
+    This endpoint lists the products in the system, paginated by id, and allows creation of new products.
+    With sharding it merges the catalog of products not sold yet with the products sold to the customers of
+    every shard.
+        cursor: Where to start, as given in the next link
+        page_size: Number of products per page
+        format: ndjson to stream all the products, one per line
     """
 
     queryset = Product.objects.all()
     serializer_class = ProductSerializer
-    paginate_by = 20
+    values_serializer_class = ProductValuesSerializer
 
 
-class ProductDetailView(generics.RetrieveUpdateAPIView):
+class ProductDetailView(ShardedObjectMixin, generics.RetrieveUpdateAPIView):
     """
     This endpoint gives product details and allow us to modify an existing product
+    With sharding a product can only be put in a sale of its own shard, products of the catalog are sold to the
+    customers of other shards with their checkout.
     """
 
     queryset = Product.objects.all()
     serializer_class = ProductDetailSerializer
+    other_shard_errors = {
+        'sale': "Sale of another shard, sell the product with the checkout of its customer",
+    }
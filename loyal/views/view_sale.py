@@ -1,22 +1,76 @@
-from rest_framework import generics
+from rest_framework import generics, status
+from rest_framework.fields import DateTimeField
+from rest_framework.response import Response
+from loyal.conditional import CustomerConditionalMixin
+from loyal.filters import DateRangeFilter
+from loyal.idempotency import IdempotentPostMixin
 from loyal.models import Sale, Customer
+from loyal.pagination import KeysetPaginationMixin
 from loyal.serializers import SaleSerializer
+from django.core.exceptions import ValidationError
 from django.http import Http404
 
 
-class SaleListView(generics.ListCreateAPIView):
+class SaleListView(CustomerConditionalMixin, IdempotentPostMixin, KeysetPaginationMixin, generics.ListCreateAPIView):
     """
-    This endpoint gives the sales for a given customer and allows to add sales to the customer.
+    This endpoint gives the sales for a given customer, latest first, and allows to add sales to the customer.
+    The list can be filtered by date and is paginated.
+        since: Only sales from this date on
+        until: Only sales before this date
+        cursor: Where to start, as given in the next link
+        page_size: Number of sales per page
+    Responses have an ETag, so unchanged lists can be polled with If-None-Match.
+    POSTs with an Idempotency-Key header run once, retries with the same key get the first response.
     """
 
     serializer_class = SaleSerializer
+    filter_backends = (DateRangeFilter,)
+    keyset_ordering = ('-date', '-pk')
 
     def get_queryset(self):
-        owned_by = self.kwargs.get('pk',None)
+        # The products of all the sales in the page are read with a single query
+        return self.get_customer().sale_set.prefetch_related('product_set')
 
-        try:
-            customer = Customer.objects.get(pk=owned_by)
-        except Customer.DoesNotExist:
+
+class CheckoutView(IdempotentPostMixin, generics.CreateAPIView):
+    """
+    This endpoint sells a list of products to a given customer in a single sale.
+        serial_nums: Serial numbers of the products sold
+        date: When was this purchase made (optional)
+    Widgets get their stamps and stamps are converted into vouchers as part of the sale.
+    POSTs with an Idempotency-Key header run once, retries with the same key get the first response.
+    """
+
+    serializer_class = SaleSerializer
+
+    def create(self, request, *args, **kwargs):
+        if not Customer.objects.filter(pk=self.kwargs['pk']).exists():
             raise Http404
 
-        return customer.sale_set.all()
+        if hasattr(request.DATA, 'getlist'):
+            serial_nums = request.DATA.getlist('serial_nums')
+        else:
+            serial_nums = request.DATA.get('serial_nums') or []
+
+        errors = {}
+        date = request.DATA.get('date') or None
+        if date:
+            try:
+                date = DateTimeField().from_native(date)
+            except ValidationError as e:
+                errors['date'] = e.messages
+
+        if not isinstance(serial_nums, list) or not all(isinstance(serial_num, basestring) for serial_num in serial_nums):
+            errors['serial_nums'] = ["Must be a list of serial numbers"]
+
+        if not errors:
+            try:
+                sale = Sale.checkout(self.kwargs['pk'], serial_nums, date)
+            except ValidationError as e:
+                errors['serial_nums'] = e.messages
+
+        if errors:
+            return Response(errors, status=status.HTTP_400_BAD_REQUEST)
+
+        serializer = self.get_serializer(sale)
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
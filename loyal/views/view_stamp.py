@@ -1,43 +1,59 @@
 from rest_framework import generics
-from loyal.models import Stamp, Customer
-from loyal.serializers import StampSerializer, StampListSerializer, StampDetailSerializer
-from django.http import Http404
+from loyal.conditional import CustomerConditionalMixin
+from loyal.filters import DateRangeFilter
+from loyal.idempotency import IdempotentPostMixin
+from loyal.pagination import KeysetPaginationMixin, ShardedKeysetPaginationMixin, ValuesListMixin
+from loyal.models import Stamp
+from loyal.serializers import StampSerializer, StampListSerializer, StampDetailSerializer, StampValuesSerializer
+from loyal.sharding import ShardedObjectMixin
 
 
-class StampList(generics.ListCreateAPIView):
+class StampList(CustomerConditionalMixin, IdempotentPostMixin, KeysetPaginationMixin, generics.ListCreateAPIView):
     """
-    This endpoint gives the stamps for a given customer and allows to add stamps to the customer.
+    This endpoint gives the stamps for a given customer, latest first, and allows to add stamps to the customer.
         obtained_with: The product which purchase generated this stamp
         grouped_in: In which voucher has this stamp been grouped
+    The list can be filtered by date and is paginated.
+        since: Only stamps from this date on
+        until: Only stamps before this date
+        cursor: Where to start, as given in the next link
+        page_size: Number of stamps per page
+    Responses have an ETag, so unchanged lists can be polled with If-None-Match.
+    POSTs with an Idempotency-Key header run once, retries with the same key get the first response.
     """
 
     serializer_class = StampSerializer
+    filter_backends = (DateRangeFilter,)
+    keyset_ordering = ('-date', '-pk')
 
     def get_queryset(self):
-        owned_by = self.kwargs.get('pk',None)
+        return self.get_customer().stamp_set.all()
 
-        try:
-            customer = Customer.objects.get(pk=owned_by)
-        except Customer.DoesNotExist:
-            raise Http404
 
-        return customer.stamp_set.all()
 
-
-
-class StampListAllView(generics.ListAPIView):
+class StampListAllView(ValuesListMixin, ShardedKeysetPaginationMixin, generics.ListAPIView):
     """
-    This endpoint show all stamps
+    This endpoint show all stamps, paginated by id, merging the stamps of all the shards.
+        cursor: Where to start, as given in the next link
+        page_size: Number of stamps per page
+        format: ndjson to stream all the stamps, one per line
     """
 
     queryset = Stamp.objects.all()
     serializer_class = StampListSerializer
+    values_serializer_class = StampValuesSerializer
 
 
-class StampDetailView(generics.RetrieveUpdateAPIView):
+class StampDetailView(ShardedObjectMixin, generics.RetrieveUpdateAPIView):
     """
     This endpoint gives stamp details and allows us to modify an existing stamp
+    With sharding a stamp can only be related to the rows of its own shard.
     """
 
     queryset = Stamp.objects.all()
     serializer_class = StampDetailSerializer
+    other_shard_errors = {
+        'owned_by': "Customer of another shard, stamps can't be moved to it",
+        'obtained_with': "Product of another shard, stamps are given for it by the checkout of the customer",
+        'grouped_in': "Voucher of another shard",
+    }
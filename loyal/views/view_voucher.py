@@ -1,41 +1,88 @@
-from rest_framework import generics
-from loyal.models import Voucher, Customer
-from loyal.serializers import VoucherSerializer, VoucherListSerializer, VoucherDetailSerializer
+from rest_framework import generics, status
+from rest_framework.response import Response
+from loyal.conditional import CustomerConditionalMixin
+from loyal.filters import DateRangeFilter
+from loyal.idempotency import IdempotentPostMixin
+from loyal.pagination import KeysetPaginationMixin, ShardedKeysetPaginationMixin, ValuesListMixin
+from loyal.models import Customer, Voucher
+from loyal.serializers import VoucherSerializer, VoucherListSerializer, VoucherDetailSerializer, VoucherValuesSerializer
+from loyal.sharding import ShardedObjectMixin
+from django.core.exceptions import ValidationError
 from django.http import Http404
 
 
-class VoucherListView(generics.ListCreateAPIView):
+class VoucherListView(CustomerConditionalMixin, IdempotentPostMixin, KeysetPaginationMixin, generics.ListCreateAPIView):
     """
-    This endpoint gives the vouchers for a given customer and allows adding new vouchers to the customer.
+    This endpoint gives the vouchers for a given customer, latest first, and allows adding new vouchers to the customer.
         date: When the voucher was created
         redeemed_with: with which product was this voucher redeemed
+    The list can be filtered by date and is paginated.
+        since: Only vouchers from this date on
+        until: Only vouchers before this date
+        cursor: Where to start, as given in the next link
+        page_size: Number of vouchers per page
+    Responses have an ETag, so unchanged lists can be polled with If-None-Match.
+    POSTs with an Idempotency-Key header run once, retries with the same key get the first response.
     """
 
     serializer_class = VoucherSerializer
+    filter_backends = (DateRangeFilter,)
+    keyset_ordering = ('-date', '-pk')
 
     def get_queryset(self):
-        owned_by = self.kwargs.get('pk',None)
+        return self.get_customer().voucher_set.all()
 
-        try:
-            customer = Customer.objects.get(pk=owned_by)
-        except Customer.DoesNotExist:
+
+class VoucherRedeemView(IdempotentPostMixin, generics.CreateAPIView):
+    """
+    This endpoint redeems the oldest available voucher of a given customer.
+        serial_num: Serial number of the product acquired with the voucher
+    Two tills can't redeem the same voucher, and it doesn't need listing the vouchers first.
+    POSTs with an Idempotency-Key header run once, retries with the same key get the first response.
+    """
+
+    serializer_class = VoucherListSerializer
+
+    def create(self, request, *args, **kwargs):
+        if not Customer.objects.filter(pk=self.kwargs['pk']).exists():
             raise Http404
 
-        return customer.voucher_set.all()
+        serial_num = request.DATA.get('serial_num')
+        if not isinstance(serial_num, basestring) or not serial_num:
+            return Response({'serial_num': ["Must be a serial number"]}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            voucher = Voucher.redeem(self.kwargs['pk'], serial_num)
+        except ValidationError as e:
+            return Response({'serial_num': e.messages}, status=status.HTTP_400_BAD_REQUEST)
+
+        serializer = self.get_serializer(voucher)
+        return Response(serializer.data, status=status.HTTP_200_OK)
+
 
-class VoucherListAllView(generics.ListAPIView):
+class VoucherListAllView(ValuesListMixin, ShardedKeysetPaginationMixin, generics.ListAPIView):
     """
-    This endpoint show all vouchers
+    This endpoint show all vouchers, paginated by id, merging the vouchers of all the shards.
+        cursor: Where to start, as given in the next link
+        page_size: Number of vouchers per page
+        format: ndjson to stream all the vouchers, one per line
     """
 
     queryset = Voucher.objects.all()
     serializer_class = VoucherListSerializer
+    values_serializer_class = VoucherValuesSerializer
 
 
-class VoucherDetailView(generics.RetrieveUpdateAPIView):
+class VoucherDetailView(ShardedObjectMixin, generics.RetrieveUpdateAPIView):
     """
     This endpoint gives vouchers details and allows us to modify an existing voucher
+    With sharding a voucher can only be redeemed with a product of its own shard, products of the catalog are
+    redeemed by the customers of other shards with their voucher redeem.
     """
 
     queryset = Voucher.objects.all()
     serializer_class = VoucherDetailSerializer
+    other_shard_errors = {
+        'owned_by': "Customer of another shard, vouchers can't be moved to it",
+        'redeemed_with': "Product of another shard, redeem it with the voucher redeem of the customer",
+    }
@@ -0,0 +1,14 @@
+"""
+Gunicorn settings, used with "gunicorn yoyo_test.wsgi -c yoyo_test/gunicorn_conf.py".
+
+The application is loaded and warmed up once in the master before forking the workers, see loyal.startup, and each
+worker opens its database connections as soon as it's forked.
+"""
+
+preload_app = True
+
+
+def post_fork(server, worker):
+    from loyal import startup
+    connected = startup.connect_databases()
+    server.log.info("Worker %s connected to %s", worker.pid, ", ".join(connected) or "no databases")
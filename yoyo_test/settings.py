@@ -10,6 +10,7 @@ https://docs.djangoproject.com/en/1.6/ref/settings/
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 import os
+import tempfile
 BASE_DIR = os.path.dirname(os.path.dirname(__file__))
 TEMPLATE_DIRS = [os.path.join(BASE_DIR, 'templates')]
 
@@ -49,8 +50,60 @@ MIDDLEWARE_CLASSES = (
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'loyal.middleware.ReplicaMiddleware',
+    'loyal.middleware.ShardMiddleware',
 )
 
+# Per request SQL, view and response time metrics, exposed to staff users in /metrics/
+LOYAL_METRICS = os.environ.get('LOYAL_METRICS', '').lower() in ('1', 'true', 'yes')
+LOYAL_METRICS_SLOT_SECONDS = 60
+LOYAL_METRICS_SLOTS = 5
+
+if LOYAL_METRICS:
+    MIDDLEWARE_CLASSES = ('loyal.middleware.QueryMetricsMiddleware',) + MIDDLEWARE_CLASSES
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # Shared by all the processes of the host, use memcached instead when they run on several hosts
+    'shared': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.environ.get('LOYAL_SHARED_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'yoyo_test_cache')),
+    },
+}
+
+# Cache of the customer detail payloads: 'local' for an LRU cache in each process, the alias of one of CACHES
+# to use a file based or shared cache, or empty to disable it
+LOYAL_CUSTOMER_CACHE = os.environ.get('LOYAL_CUSTOMER_CACHE', 'local')
+LOYAL_CUSTOMER_CACHE_SIZE = 10000
+
+# Seconds the responses to POSTs with an Idempotency-Key are kept, expired ones are deleted with
+# the purge_idempotency_keys command
+LOYAL_IDEMPOTENCY_TTL = 24 * 60 * 60
+
+# Convert stamps into vouchers in the run_loyalty_worker command instead of when they are added. The worker of the
+# Procfile always runs, but without it only checks every --max-interval for the jobs left from when it was enabled
+LOYAL_DEFERRED_VOUCHERS = os.environ.get('LOYAL_DEFERRED_VOUCHERS', '').lower() in ('1', 'true', 'yes')
+
+# Errors of the worker go to stderr, like the ones of gunicorn
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'level': 'INFO',
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'loyal': {
+            'handlers': ['console'],
+            'level': 'INFO',
+        },
+    },
+}
+
 ROOT_URLCONF = 'yoyo_test.urls'
 
 WSGI_APPLICATION = 'yoyo_test.wsgi.application'
@@ -74,6 +127,40 @@ if not DATABASES['default']:
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
     }
 
+# SQLite test databases are files rather than in memory, so the processes of the concurrency tests can share them
+if DATABASES['default']['ENGINE'] == 'django.db.backends.sqlite3':
+    DATABASES['default'].setdefault('TEST_NAME', os.path.join(
+        tempfile.gettempdir(), 'yoyo_test_db_{0}.sqlite3'.format(os.getpid())))
+
+# Seconds a database connection is kept open to be reused by the next requests, 0 opens one for every request.
+# Reused connections are checked with a cheap query at the start of each request unless
+# LOYAL_CONN_HEALTH_CHECKS is disabled
+DATABASES['default']['CONN_MAX_AGE'] = int(os.environ.get('LOYAL_CONN_MAX_AGE', 600))
+LOYAL_CONN_HEALTH_CHECKS = os.environ.get('LOYAL_CONN_HEALTH_CHECKS', 'true').lower() in ('1', 'true', 'yes')
+
+# Read replicas, as comma separated database URLs. GET requests read from them, except for the customers written in
+# the last LOYAL_REPLICA_STICKY_SECONDS, pinned in the LOYAL_REPLICA_PIN_CACHE cache, which must be shared by all the
+# processes, or the processes refuse to start. In tests they are mirrors of the default database.
+LOYAL_REPLICAS = []
+for number, url in enumerate(filter(None, os.environ.get('LOYAL_REPLICA_URLS', '').split(',')), 1):
+    alias = 'replica{0}'.format(number)
+    DATABASES[alias] = dict(dj_database_url.parse(url), TEST_MIRROR='default',
+                            CONN_MAX_AGE=DATABASES['default']['CONN_MAX_AGE'])
+    LOYAL_REPLICAS.append(alias)
+
+LOYAL_REPLICA_STICKY_SECONDS = 10
+LOYAL_REPLICA_PIN_CACHE = 'shared'
+
+# Shards of the customers, as comma separated database URLs. Customers are spread by id over the default database,
+# which also keeps the products not sold yet, and these ones.
+LOYAL_SHARDS = ['default']
+for number, url in enumerate(filter(None, os.environ.get('LOYAL_SHARD_URLS', '').split(',')), 1):
+    alias = 'shard{0}'.format(number)
+    DATABASES[alias] = dict(dj_database_url.parse(url), CONN_MAX_AGE=DATABASES['default']['CONN_MAX_AGE'])
+    LOYAL_SHARDS.append(alias)
+
+DATABASE_ROUTERS = ['loyal.routers.ShardRouter', 'loyal.routers.ReplicaRouter']
+
 
 # Internationalization
 # https://docs.djangoproject.com/en/1.6/topics/i18n/
@@ -103,6 +190,29 @@ REST_FRAMEWORK = {
     )
 }
 
+# API-only web processes skip the admin, sessions, messages, static files, the docs and the browsable API, so they
+# start faster. Staff users authenticate with HTTP basic auth for /metrics/.
+LOYAL_API_ONLY = os.environ.get('LOYAL_API_ONLY', '').lower() in ('1', 'true', 'yes')
+if LOYAL_API_ONLY:
+    INSTALLED_APPS = tuple(app for app in INSTALLED_APPS if app not in (
+        'django.contrib.admin',
+        'django.contrib.sessions',
+        'django.contrib.messages',
+        'django.contrib.staticfiles',
+        'rest_framework_swagger',
+    ))
+    MIDDLEWARE_CLASSES = tuple(middleware for middleware in MIDDLEWARE_CLASSES if middleware not in (
+        'django.contrib.sessions.middleware.SessionMiddleware',
+        'django.contrib.auth.middleware.AuthenticationMiddleware',
+        'django.contrib.messages.middleware.MessageMiddleware',
+    ))
+    REST_FRAMEWORK['DEFAULT_RENDERER_CLASSES'] = ('rest_framework.renderers.JSONRenderer',)
+
+# The API docs are generated once for each version of the code and stored in this file. The version is a hash of the
+# sources unless LOYAL_CODE_VERSION gives one, like the commit deployed.
+LOYAL_API_DOCS_FILE = os.path.join(BASE_DIR, 'api-docs.json')
+LOYAL_CODE_VERSION = os.environ.get('LOYAL_CODE_VERSION', '')
+
 
 # Honor the 'X-Forwarded-Proto' header for request.is_secure()
 SECURE_PROXY_SSL_HEADER = ('HTTP_X_FORWARDED_PROTO', 'https')
@@ -1,25 +1,60 @@
+from django.conf import settings
 from django.conf.urls import patterns, include, url
 
-from django.contrib import admin
-from rest_framework.decorators import api_view
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.permissions import IsAdminUser
 from rest_framework.response import Response
 from rest_framework.reverse import reverse
+from loyal.cache import customer_cache
+from loyal.connections import connection_stats
+from loyal.metrics import request_metrics
+import os
+
+
+ADMIN_ENABLED = 'django.contrib.admin' in settings.INSTALLED_APPS
+DOCS_ENABLED = 'rest_framework_swagger' in settings.INSTALLED_APPS
 
 
 @api_view(('GET',))
 def api_root(request, format=None):
+    links = {'loyal': reverse('loyal:root', request=request, format=format)}
+    if ADMIN_ENABLED:
+        links['admin'] = reverse('admin:index', request=request, format=format)
+    if DOCS_ENABLED:
+        links['docs'] = reverse('django.swagger.base.view', request=request, format=format)
+    return Response(links)
+
+
+@api_view(('GET',))
+@permission_classes((IsAdminUser,))
+def api_metrics(request, format=None):
+    """
+    Request metrics of the process serving this request, by URL name, for the last minutes,
+    and the counters of the customer detail cache and of the database connections.
+    Each worker process keeps its own metrics.
+    """
+
     return Response({
-        'loyal': reverse('loyal:root', request=request, format=format),
-        'admin': reverse('admin:index', request=request, format=format),
-        'docs': reverse('django.swagger.base.view', request=request, format=format),
+        'enabled': settings.LOYAL_METRICS,
+        'pid': os.getpid(),
+        'window_seconds': request_metrics.slot_seconds * request_metrics.slots.maxlen,
+        'endpoints': request_metrics.summary(),
+        'customer_cache': customer_cache.stats(),
+        'connections': connection_stats.stats(),
     })
 
-admin.autodiscover()
-
 
 urlpatterns = patterns('',
     url(r'^$', api_root),
+    url(r'^metrics/?$', api_metrics, name='metrics'),
     url(r'^loyal/', include('loyal.urls', namespace='loyal')),
-    url(r'^admin/', include(admin.site.urls)),
-    url(r'^docs/', include('rest_framework_swagger.urls')),
 )
+
+# Left out of API-only processes (LOYAL_API_ONLY), which start faster without them
+if ADMIN_ENABLED:
+    from django.contrib import admin
+    admin.autodiscover()
+    urlpatterns += patterns('', url(r'^admin/', include(admin.site.urls)))
+
+if DOCS_ENABLED:
+    urlpatterns += patterns('', url(r'^docs/', include('loyal.urls_docs')))
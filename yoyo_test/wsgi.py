@@ -10,7 +10,16 @@ https://docs.djangoproject.com/en/1.6/howto/deployment/wsgi/
 import os
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "yoyo_test.settings")
 
+from django.conf import settings
 from django.core.wsgi import get_wsgi_application
-from dj_static import Cling
+from loyal import startup
 
-application = Cling(get_wsgi_application())
+django_application = get_wsgi_application()
+startup.warm_up(django_application)
+
+# API-only processes don't serve static files
+if settings.LOYAL_API_ONLY:
+    application = django_application
+else:
+    from dj_static import Cling
+    application = Cling(django_application)